@@ -0,0 +1,176 @@
+"""Per-frame air timing with nfc_initiator_transceive_bytes_timed
+
+The reader counts carrier cycles (13.56 MHz) between the last bit it sent and the first bit of the tag's answer.
+Together with the frame lengths that gives the time a command spends on the air, and the wall clock time of the call
+minus the air time is the host side: Python, USB/UART and the reader firmware. The split tells whether to optimise
+the Python side or the RF side.
+
+The response time (frame delay time) of ISO14443A commands like READ is fixed by the standard, so it only varies by
+a few cycles between frames. A relay between reader and tag adds to it: a response time well above the baseline of
+that command on that tag type is a relay signal.
+
+libnfc only times frames with easy framing and CRC handling switched off, so the CRC_A is appended and checked on the
+host (see raw_frames.py). Only commands that are a single frame are timed. The two-phase commands (NTAG
+COMPATIBILITY_WRITE, Mifare Classic WRITE and the value commands) are answered with a 4-bit ACK before their data frame
+is sent, which the reader only handles with easy framing, so they are sent untimed.
+
+Switching the framing costs a round trip to the reader per property, outside the timed window. So AirTiming remembers
+what it set and only changes the properties when the next frame needs other ones. Code that changes easy framing or
+CRC handling on the device in between must call forget().
+"""
+
+import collections
+import ctypes
+import time
+
+from . import pynfc as nfc
+from .raw_frames import append_crc_a, check_crc_a
+
+CARRIER_MHZ = 13.56
+# One bit at 106 kbps lasts 128 carrier cycles. A frame is a start bit, 9 bits per byte (with parity) and an end bit
+BIT_US_106 = 128 / CARRIER_MHZ
+
+# First bytes of the single-frame commands, the only ones sent timed.
+# NTAG: READ, FAST_READ, WRITE, PWD_AUTH, READ_SIG and GET_VERSION. Mifare Classic: READ and TRANSFER
+SINGLE_FRAME_NTAG_COMMANDS = frozenset([0x30, 0x3A, 0xA2, 0x1B, 0x3C, 0x60])
+SINGLE_FRAME_MIFARE_COMMANDS = frozenset([0x30, 0xB0])
+
+FrameTiming = collections.namedtuple('FrameTiming', 'key response_us air_us total_us overhead_us')
+
+
+def cycles_to_us(cycles):
+    return cycles / CARRIER_MHZ
+
+
+def frame_air_us(length):
+    """Time on the air of a frame of length bytes at 106 kbps, in us. A 4-bit ACK/NAK is passed as length 0"""
+    bits = 4 if length == 0 else 9 * length
+    return (bits + 2) * BIT_US_106
+
+
+class AirTimingStats(object):
+    """Rolling distributions of frame timings, per key, eg. (tag type, command)"""
+
+    def __init__(self, window=256):
+        self.window = window
+        self.timings = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        self.baselines = {}
+
+    def record(self, key, tx_length, rx_length, cycles, total_seconds):
+        """
+        :param tx_length: bytes sent, including CRC
+        :param rx_length: bytes received, including CRC. 0 for a 4-bit ACK/NAK
+        :param cycles: the cycle count reported by the reader
+        :param total_seconds: wall clock time of the transceive call
+        :rtype FrameTiming
+        """
+        response_us = cycles_to_us(cycles)
+        air_us = frame_air_us(tx_length) + response_us + frame_air_us(rx_length)
+        total_us = total_seconds * 1e6
+        timing = FrameTiming(key, response_us, air_us, total_us, max(total_us - air_us, 0.0))
+        self.timings[key].append(timing)
+        return timing
+
+    @staticmethod
+    def _percentile(values, percentile):
+        ordered = sorted(values)
+        return ordered[min(int(percentile * len(ordered)), len(ordered) - 1)]
+
+    def report(self):
+        """
+        :return: dict of key -> dict with the number of frames, the median and p95 response time, the median air
+            and host overhead time (all in us) and the share of the total time spent on the host
+        """
+        report = {}
+        for key, timings in self.timings.items():
+            if not timings:
+                continue
+            response = [timing.response_us for timing in timings]
+            total = sum(timing.total_us for timing in timings)
+            report[key] = {'frames': len(timings),
+                           'response_us': self._percentile(response, 0.5),
+                           'response_p95_us': self._percentile(response, 0.95),
+                           'air_us': self._percentile([timing.air_us for timing in timings], 0.5),
+                           'overhead_us': self._percentile([timing.overhead_us for timing in timings], 0.5),
+                           'overhead_share': sum(timing.overhead_us for timing in timings) / total if total else 0.0}
+        return report
+
+    def calibrate(self):
+        """Take the current median response times as baselines, eg. after timing known-good tags on this reader"""
+        for key, timings in self.timings.items():
+            if timings:
+                self.baselines[key] = self._percentile([timing.response_us for timing in timings], 0.5)
+
+    def baseline(self, key):
+        """The calibrated baseline for key or else the fastest response seen, in us. None without any frames"""
+        if key in self.baselines:
+            return self.baselines[key]
+        timings = self.timings.get(key)
+        return min(timing.response_us for timing in timings) if timings else None
+
+    def excess_response_us(self, timing):
+        """How much slower the tag answered than the baseline of its command, in us"""
+        baseline = self.baseline(timing.key)
+        return 0.0 if baseline is None else timing.response_us - baseline
+
+    def relay_suspect(self, timing, tolerance_us=10.0):
+        """
+        Whether the response time is suspiciously long for this command, as added by a relay.
+        Only meaningful for commands with a fixed frame delay time (READ, FAST_READ, READ_SIG), not for writes
+        """
+        return self.excess_response_us(timing) > tolerance_us
+
+
+class AirTiming(object):
+    """Sends frames with nfc_initiator_transceive_bytes_timed and records their timing in an AirTimingStats"""
+
+    def __init__(self, stats=None, max_frame=264):
+        self.stats = stats if stats is not None else AirTimingStats()
+        self.last = None  # FrameTiming of the last frame
+        self._rx = (ctypes.c_uint8 * max_frame)()
+        self._cycles = ctypes.c_uint32()
+        self._timed = None  # Whether the device is set up for timed frames, None when unknown
+
+    def configure(self, device, enabled=True):
+        """Switch easy framing and CRC handling off for timed frames, or back on for untimed frames"""
+        if enabled == self._timed:
+            return
+        self._timed = None
+        if nfc.nfc_device_set_property_bool(device, nfc.NP_EASY_FRAMING, not enabled) < 0:
+            raise IOError("Error setting Easy Framing property")
+        if nfc.nfc_device_set_property_bool(device, nfc.NP_HANDLE_CRC, not enabled) < 0:
+            raise IOError("Error setting CRC handling property")
+        self._timed = enabled
+
+    def forget(self):
+        """The framing of the device was changed by other code or the device was reopened, set it on the next frame"""
+        self._timed = None
+
+    def transceive(self, device, key, frame, abtrx):
+        """
+        Send frame with its CRC_A appended and receive the answer into abtrx, without its CRC_A
+        :param key: what to record the timing under, eg. (tag type, command)
+        :param abtrx: ctypes uint8 array receiving the answer
+        :return: the number of bytes received or a negative libnfc error, like nfc_initiator_transceive_bytes
+        """
+        self.configure(device)
+        data = append_crc_a(frame)
+        tx = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+
+        start = time.perf_counter()
+        res = nfc.nfc_initiator_transceive_bytes_timed(device, tx, len(tx), self._rx, len(self._rx),
+                                                       ctypes.byref(self._cycles))
+        elapsed = time.perf_counter() - start
+        if res < 0:
+            return res
+
+        received = bytes(self._rx[:res])
+        if res >= 3:
+            if not check_crc_a(received):
+                return nfc.NFC_EIO
+            received = received[:-2]
+
+        ctypes.memmove(abtrx, received, min(len(received), len(abtrx)))
+        # A 1-byte answer is a 4-bit ACK/NAK
+        self.last = self.stats.record(key, len(data), res if res >= 3 else 0, self._cycles.value, elapsed)
+        return len(received)
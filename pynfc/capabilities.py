@@ -0,0 +1,66 @@
+"""What a device supports: modulations and, per modulation, baud rates
+
+Queried once per device with nfc_device_get_supported_modulation and nfc_device_get_supported_baud_rate, so
+callers can use the fastest bit rate of the reader instead of assuming the slowest, eg. FeliCa at 424 kbps.
+"""
+
+import ctypes
+
+from . import pynfc as nfc
+
+# Baud rates from slow to fast, NBR_UNDEFINED (0) terminates the arrays returned by libnfc
+BAUD_RATE_ORDER = (nfc.NBR_106, nfc.NBR_212, nfc.NBR_424, nfc.NBR_847)
+BAUD_RATE_KBPS = {nfc.NBR_106: 106, nfc.NBR_212: 212, nfc.NBR_424: 424, nfc.NBR_847: 847}
+
+
+def _zero_terminated(pointer):
+    values = []
+    index = 0
+    while pointer[index]:
+        values += [pointer[index]]
+        index += 1
+    return values
+
+
+class DeviceCapabilities(object):
+    """
+    Supported modulations and baud rates of a device:
+        capabilities = DeviceCapabilities.query(read_writer.device)
+        capabilities.baud_rates(nfc.NMT_FELICA)  # eg. [NBR_212, NBR_424]
+    """
+
+    def __init__(self, baud_rates):
+        """
+        :param baud_rates: dict of modulation type -> list of supported baud rates
+        """
+        self._baud_rates = {nmt: sorted(rates, key=BAUD_RATE_ORDER.index) for nmt, rates in baud_rates.items()}
+
+    def __repr__(self):
+        return "DeviceCapabilities({})".format({nmt: [BAUD_RATE_KBPS[rate] for rate in rates]
+                                                for nmt, rates in sorted(self._baud_rates.items())})
+
+    @classmethod
+    def query(cls, device, mode=nfc.N_INITIATOR):
+        """Ask libnfc what the device supports in the given mode"""
+        modulations = ctypes.POINTER(nfc.nfc_modulation_type)()
+        if nfc.nfc_device_get_supported_modulation(device, mode, ctypes.byref(modulations)) < 0:
+            raise IOError("Error querying the supported modulations")
+
+        baud_rates = {}
+        for nmt in _zero_terminated(modulations):
+            rates = ctypes.POINTER(nfc.nfc_baud_rate)()
+            if nfc.nfc_device_get_supported_baud_rate(device, nmt, ctypes.byref(rates)) < 0:
+                raise IOError("Error querying the supported baud rates for modulation {}".format(nmt))
+            baud_rates[nmt] = [rate for rate in _zero_terminated(rates) if rate in BAUD_RATE_ORDER]
+        return cls(baud_rates)
+
+    @property
+    def modulations(self):
+        return sorted(self._baud_rates)
+
+    def baud_rates(self, nmt):
+        """:return: the supported baud rates for the modulation, slowest first. Empty when it is not supported"""
+        return list(self._baud_rates.get(nmt, []))
+
+    def supports(self, nmt, nbr=None):
+        return nmt in self._baud_rates and (nbr is None or nbr in self._baud_rates[nmt])
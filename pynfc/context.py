@@ -0,0 +1,163 @@
+"""One libnfc context per process and a registry of the devices found through it
+
+nfc_init parses the configuration and loads the drivers, and nfc_list_devices probes every bus, which together take
+seconds on some systems. Here the context is created once and shared by reference count, and the connstrings of the
+devices that were found are remembered, so that reopening a device (eg. after a USB hiccup) is a plain nfc_open.
+Discovery is only done again when opening a known connstring fails.
+"""
+
+import atexit
+import ctypes
+import logging
+import threading
+
+from . import pynfc as nfc
+
+MAX_DEVICES = 10
+
+_lock = threading.RLock()
+_context = None
+_references = 0
+_registry = None
+
+
+def acquire_context():
+    """
+    :return: the shared nfc_context pointer, initialised on first use. Pair every call with release_context()
+    """
+    global _context, _references
+    with _lock:
+        if _context is None:
+            context = ctypes.pointer(nfc.nfc_context())
+            nfc.nfc_init(ctypes.byref(context))
+            if not context:
+                raise IOError("Could not initialise the NFC library")
+            _context = context
+        _references += 1
+        return _context
+
+
+def release_context():
+    """
+    Give up a reference to the shared context. The context stays initialised when it is no longer referenced,
+    so the next acquire_context() is free. It is de-initialised by shutdown(), at the latest when Python exits
+    """
+    global _references
+    with _lock:
+        if _references <= 0:
+            raise ValueError("release_context() called more often than acquire_context()")
+        _references -= 1
+
+
+@atexit.register
+def shutdown():
+    """De-initialise the shared context when nothing references it anymore. Forgets the known devices too"""
+    global _context, _registry
+    with _lock:
+        if _context is not None and not _references:
+            nfc.nfc_exit(_context)
+            _context = None
+            _registry = None
+
+
+def default_registry():
+    """:rtype DeviceRegistry"""
+    global _registry
+    with _lock:
+        if _registry is None:
+            _registry = DeviceRegistry()
+        return _registry
+
+
+class DeviceRegistry(object):
+    """Connstrings of the devices found by discovery, to open them again without probing the buses"""
+
+    def __init__(self, max_devices=MAX_DEVICES, logger=logging.getLogger("device_registry")):
+        self.max_devices = max_devices
+        self.logger = logger
+        self.connstrings = []
+        self.discoveries = 0
+        self.opened = {}  # address of the nfc_device -> connstring, for the devices opened and not yet closed
+        self._lock = threading.Lock()
+        self._open_lock = threading.RLock()
+        self._buffer = None
+
+    def discover(self):
+        """
+        Probe for devices and remember their connstrings
+        :return: list of connstrings as bytes
+        """
+        context = acquire_context()
+        try:
+            with self._lock:
+                if self._buffer is None:
+                    self._buffer = (nfc.nfc_connstring * self.max_devices)()
+                found = nfc.nfc_list_devices(context, self._buffer, self.max_devices)
+                self.connstrings = [self._buffer[index].value for index in range(max(found, 0))]
+                self.discoveries += 1
+                self.logger.info("{} devices found: {}".format(len(self.connstrings), self.connstrings))
+                return list(self.connstrings)
+        finally:
+            release_context()
+
+    def _open(self, context, connstring):
+        device = nfc.nfc_open(context, connstring)
+        if not device:
+            self.logger.info("Could not open device on connstring {}".format(connstring))
+            return None
+        return device
+
+    def _candidates(self, prefer, discovered):
+        in_use = set(self.opened.values())
+        known = [connstring for connstring in self.connstrings if connstring != prefer and connstring not in in_use]
+        # After a discovery that no longer finds it, the preferred connstring is stale
+        if prefer is None or prefer in in_use or (discovered and prefer not in self.connstrings):
+            return known
+        return [prefer] + known
+
+    def _opened(self, device, connstring):
+        self.opened[ctypes.addressof(device.contents)] = connstring
+        return device, connstring
+
+    def open(self, connstring=None, prefer=None):
+        """
+        Open a device with the shared context. Known connstrings are opened directly, discovery only runs when
+        none of them opens. Devices that are open already are skipped, so opening twice gives two devices.
+        The context is referenced until close() is called for the device
+        :param connstring: open this device and no other, without discovery
+        :param prefer: try this connstring first, eg. that of the device that was open before
+        :type connstring bytes
+        :return: tuple (nfc_device pointer, connstring)
+        :raises IOError: when no device could be opened
+        """
+        context = acquire_context()
+        try:
+            with self._open_lock:
+                if connstring is not None:
+                    device = self._open(context, connstring)
+                    if device is not None:
+                        return self._opened(device, connstring)
+                    raise IOError("Could not open device on connstring {}".format(connstring))
+
+                discovered = False
+                while True:
+                    if discovered or self.connstrings or prefer is not None:
+                        for candidate in self._candidates(prefer, discovered):
+                            device = self._open(context, candidate)
+                            if device is not None:
+                                return self._opened(device, candidate)
+                    if discovered:
+                        raise IOError("No devices found")
+                    # Nothing known opens: the device may have been replugged under another connstring
+                    self.discover()
+                    discovered = True
+        except Exception:
+            release_context()
+            raise
+
+    def close(self, device):
+        """Close a device opened with open() and release its reference to the shared context"""
+        with self._open_lock:
+            self.opened.pop(ctypes.addressof(device.contents), None)
+        nfc.nfc_close(device)
+        release_context()
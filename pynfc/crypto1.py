@@ -0,0 +1,391 @@
+"""Pure Python Crypto1 cipher and card PRNG of Mifare Classic, for working with raw frames.
+
+Based on the public domain crapto1 description of the cipher. The 48-bit LFSR is kept as two 24-bit halves
+holding the odd and the even bits, so the filter function only needs the odd half.
+
+The filter function is table driven: two lookup tables cover the 5 nibbles of the 20 filter input bits.
+With NumPy installed, Crypto1Batch runs the same cipher for many states at once, vectorised across the states,
+eg. to check many candidate keys against an authentication trace.
+
+Crypto1Session authenticates and reads/writes a Mifare Classic card with the cipher running on the host,
+through a raw_frames.RawFrameEngine, ie. with CRC and parity handling of the reader switched off.
+This works with readers that have no hardware Crypto1 support and it allows checking authentication traces.
+
+Run "python -m pynfc.crypto1" for a throughput benchmark.
+"""
+
+import os
+import time
+
+from .raw_frames import RawFrameEngine, append_crc_a, check_crc_a, odd_parity, parity_bits
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LF_POLY_ODD = 0x29CE5C
+LF_POLY_EVEN = 0x870804
+STATE_MASK = 0xFFFFFF
+
+
+def _filter_reference(x):
+    """The nonlinear filter function on the 20 low bits of the odd half, as written in crapto1"""
+    f = (0xf22c0 >> (x & 0xf)) & 16
+    f |= (0x6c9c0 >> ((x >> 4) & 0xf)) & 8
+    f |= (0x3c8b0 >> ((x >> 8) & 0xf)) & 4
+    f |= (0x1e458 >> ((x >> 12) & 0xf)) & 2
+    f |= (0x0d938 >> ((x >> 16) & 0xf)) & 1
+    return (0xEC57E80A >> f) & 1
+
+
+# The 5-bit index into 0xEC57E80A is built from the filter layer outputs of nibbles 0-2 (low 12 bits) and
+# nibbles 3-4 (bits 12-19), so two tables give the index with a single OR
+_FILTER_LOW = [((0xf22c0 >> (x & 0xf)) & 16) | ((0x6c9c0 >> ((x >> 4) & 0xf)) & 8) | ((0x3c8b0 >> ((x >> 8) & 0xf)) & 4)
+               for x in range(1 << 12)]
+_FILTER_HIGH = [((0x1e458 >> (x & 0xf)) & 2) | ((0x0d938 >> ((x >> 4) & 0xf)) & 1) for x in range(1 << 8)]
+_FILTER_OUT = [(0xEC57E80A >> f) & 1 for f in range(32)]
+
+_PARITY8 = [bin(x).count('1') & 1 for x in range(256)]
+
+
+def filter_bit(x):
+    """Table driven filter function"""
+    return _FILTER_OUT[_FILTER_LOW[x & 0xFFF] | _FILTER_HIGH[(x >> 12) & 0xFF]]
+
+
+def _parity24(x):
+    return _PARITY8[(x ^ (x >> 8) ^ (x >> 16)) & 0xFF]
+
+
+def _swap_endian(x):
+    return ((x >> 24) & 0xFF) | ((x >> 8) & 0xFF00) | ((x & 0xFF00) << 8) | ((x & 0xFF) << 24)
+
+
+def prng_successor(x, n):
+    """The card PRNG: the 32-bit nonce that follows x after n shifts of the 16-bit LFSR"""
+    x = _swap_endian(x)
+    for _ in range(n):
+        x = (x >> 1) | ((((x >> 16) ^ (x >> 18) ^ (x >> 19) ^ (x >> 21)) & 1) << 31)
+    return _swap_endian(x)
+
+
+def is_valid_nonce(nt):
+    """Whether the 32 bits of a card nonce are consistent with the 16-bit LFSR of the card PRNG"""
+    x = _swap_endian(nt)
+    for k in range(16, 32):
+        if ((x >> k) ^ (x >> (k - 16)) ^ (x >> (k - 14)) ^ (x >> (k - 13)) ^ (x >> (k - 11))) & 1:
+            return False
+    return True
+
+
+def _key_to_int(key):
+    if isinstance(key, int):
+        return key
+    return int.from_bytes(bytes(key), byteorder='big')
+
+
+def _split_key(key):
+    key = _key_to_int(key)
+    odd = even = 0
+    for i in range(47, 0, -2):
+        odd = (odd << 1) | ((key >> ((i - 1) ^ 7)) & 1)
+        even = (even << 1) | ((key >> (i ^ 7)) & 1)
+    return odd, even
+
+
+class Crypto1(object):
+    """A Crypto1 cipher state"""
+
+    def __init__(self, key):
+        """
+        :param key: the 6-byte sector key, as bytes or as a 48-bit int
+        """
+        self.odd, self.even = _split_key(key)
+
+    def bit(self, in_bit=0, encrypted=False):
+        """Clock the cipher once, feeding in_bit. With encrypted, in_bit is ciphertext that is decrypted first.
+        :return: the keystream bit"""
+        odd = self.odd
+        ret = _FILTER_OUT[_FILTER_LOW[odd & 0xFFF] | _FILTER_HIGH[(odd >> 12) & 0xFF]]
+        feedin = (ret & encrypted) ^ (in_bit & 1)
+        feedin ^= _parity24((LF_POLY_ODD & odd) ^ (LF_POLY_EVEN & self.even))
+        self.odd = ((self.even << 1) | feedin) & STATE_MASK
+        self.even = odd
+        return ret
+
+    def byte(self, in_byte=0, encrypted=False):
+        """Clock the cipher 8 times, feeding in_byte LSB first
+        :return: the keystream byte"""
+        ret = 0
+        for i in range(8):
+            ret |= self.bit(in_byte >> i, encrypted) << i
+        return ret
+
+    def word(self, in_word=0, encrypted=False):
+        """Clock the cipher 32 times, feeding in_word as 4 big-endian bytes, each LSB first
+        :return: the keystream word"""
+        ret = 0
+        for i in range(32):
+            ret |= self.bit(in_word >> (i ^ 24), encrypted) << (i ^ 24)
+        return ret
+
+    def peek(self):
+        """The keystream bit for the next clock, without clocking. Used to encrypt parity bits"""
+        return filter_bit(self.odd)
+
+    def encrypt(self, data):
+        """
+        Encrypt plain bytes sent to the card
+        :return: tuple (encrypted bytes, encrypted parity bits)
+        """
+        encrypted = bytearray(len(data))
+        parity = bytearray(len(data))
+        for index, byte in enumerate(data):
+            encrypted[index] = byte ^ self.byte()
+            parity[index] = odd_parity(byte) ^ self.peek()
+        return bytes(encrypted), bytes(parity)
+
+    def decrypt(self, data, parity=None):
+        """
+        Decrypt bytes received from the card
+        :param parity: if given, the received parity bits are checked
+        :return: the plain bytes
+        """
+        plain = bytearray(len(data))
+        for index, byte in enumerate(data):
+            plain[index] = byte ^ self.byte()
+            if parity is not None and parity[index] != odd_parity(plain[index]) ^ self.peek():
+                raise IOError("Parity error in byte {} of the card response".format(index))
+        return bytes(plain)
+
+    def decrypt_bits(self, value, bits):
+        """Decrypt a short response of less than a byte, eg. the 4-bit ACK/NAK"""
+        return value ^ sum(self.bit() << i for i in range(bits))
+
+
+def reader_auth_response(key, uid, nt, nr):
+    """
+    Compute the reader's part of a Mifare Classic authentication
+    :param uid: the 4 UID bytes used for authentication, as int
+    :param nt: the card nonce
+    :param nr: the reader nonce
+    :return: tuple (cipher, {nr}{ar} as 8 bytes, their 8 encrypted parity bits)
+    """
+    cipher = Crypto1(key)
+    cipher.word(uid ^ nt)
+
+    plain = nr.to_bytes(4, byteorder='big') + prng_successor(nt, 64).to_bytes(4, byteorder='big')
+    encrypted = bytearray(8)
+    parity = bytearray(8)
+    for index, byte in enumerate(plain):
+        # The reader nonce is fed into the LFSR, the reader answer is not
+        encrypted[index] = byte ^ cipher.byte(byte if index < 4 else 0)
+        parity[index] = odd_parity(byte) ^ cipher.peek()
+    return cipher, bytes(encrypted), bytes(parity)
+
+
+def verify_auth_trace(key, uid, nt, nr_encrypted, ar_encrypted, at_encrypted):
+    """
+    Check a sniffed authentication against a key, from the card's point of view
+    :param uid: the 4 UID bytes used for authentication, as int
+    :param nt: the plain card nonce
+    :param nr_encrypted: encrypted reader nonce, as int
+    :param ar_encrypted: encrypted reader answer, as int
+    :param at_encrypted: encrypted card answer, as int
+    :return: tuple (reader answer correct, card answer correct, decrypted reader nonce)
+    """
+    cipher = Crypto1(key)
+    cipher.word(uid ^ nt)
+    nr = nr_encrypted ^ cipher.word(nr_encrypted, True)
+    ar = ar_encrypted ^ cipher.word()
+    at = at_encrypted ^ cipher.word()
+    return ar == prng_successor(nt, 64), at == prng_successor(nt, 96), nr
+
+
+class Crypto1Batch(object):
+    """
+    Many Crypto1 states clocked in lockstep with NumPy, one state per array element.
+    Useful to generate the keystreams of many keys, eg. to check candidate keys against a trace.
+    """
+
+    def __init__(self, keys):
+        """
+        :param keys: iterable of keys, as bytes or 48-bit ints
+        """
+        if numpy is None:
+            raise ImportError("Crypto1Batch requires numpy")
+        halves = [_split_key(key) for key in keys]
+        self.odd = numpy.array([odd for odd, _ in halves], dtype=numpy.uint32)
+        self.even = numpy.array([even for _, even in halves], dtype=numpy.uint32)
+        self._filter_low = numpy.array(_FILTER_LOW, dtype=numpy.uint8)
+        self._filter_high = numpy.array(_FILTER_HIGH, dtype=numpy.uint8)
+        self._filter_out = numpy.array(_FILTER_OUT, dtype=numpy.uint8)
+
+    def __len__(self):
+        return len(self.odd)
+
+    @staticmethod
+    def _parity(x):
+        x = x ^ (x >> 16)
+        x ^= x >> 8
+        x ^= x >> 4
+        return (numpy.uint32(0x6996) >> (x & 0xF)) & 1
+
+    def bit(self, in_bits=0, encrypted=False):
+        """Clock all states once. in_bits is a scalar or an array with a bit per state
+        :return: array of keystream bits"""
+        odd = self.odd
+        ret = self._filter_out[self._filter_low[odd & 0xFFF] | self._filter_high[(odd >> 12) & 0xFF]].astype(numpy.uint32)
+        feedin = numpy.bitwise_and(numpy.asarray(in_bits, dtype=numpy.uint32), 1)
+        if encrypted:
+            feedin = feedin ^ ret
+        feedin = feedin ^ self._parity((odd & LF_POLY_ODD) ^ (self.even & LF_POLY_EVEN))
+        self.odd = ((self.even << 1) | feedin) & STATE_MASK
+        self.even = odd
+        return ret
+
+    def word(self, in_words=0, encrypted=False):
+        """Clock all states 32 times, like Crypto1.word
+        :return: array of keystream words"""
+        in_words = numpy.asarray(in_words, dtype=numpy.uint32)
+        ret = numpy.zeros(len(self.odd), dtype=numpy.uint32)
+        for i in range(32):
+            shift = numpy.uint32(i ^ 24)
+            ret |= self.bit(in_words >> shift, encrypted) << shift
+        return ret
+
+
+class Crypto1Session(object):
+    """
+    Mifare Classic authentication, reads and writes with Crypto1 running on the host.
+
+    The reader only transports raw frames: CRC, parity and Crypto1 handling of the reader are switched off,
+    and frames go through a RawFrameEngine with the (encrypted) parity bits passed separately.
+    The card must be selected already, eg. with NFCReader.select_card.
+    """
+
+    MC_AUTH_A = 0x60
+    MC_AUTH_B = 0x61
+    MC_READ = 0x30
+    MC_WRITE = 0xA0
+    ACK = 0x0A
+
+    def __init__(self, device, uid):
+        """
+        :param device: an opened nfc_device pointer
+        :param uid: UID of the selected card. The first 4 bytes are used for authentication
+        """
+        from . import pynfc as nfc
+
+        self.device = device
+        self.uid = int.from_bytes(bytes(uid[:4]), byteorder='big')
+        self.cipher = None
+        self.trace = []  # (direction, bytes) of the last authentication, for debugging
+
+        if nfc.nfc_device_set_property_bool(device, nfc.NP_ACTIVATE_CRYPTO1, False) < 0:
+            raise IOError("Error setting Crypto1 disabled")
+        self.engine = RawFrameEngine(device, host_parity=True)
+
+    def authenticate(self, block, key, use_b_key=False, nr=None):
+        """
+        Authenticate to the sector of block
+        :param nr: reader nonce, random by default
+        :return: True when the card answered correctly
+        """
+        command = [self.MC_AUTH_B if use_b_key else self.MC_AUTH_A, block]
+        if self.cipher is None:
+            frame = append_crc_a(command)
+            parity = parity_bits(frame)
+        else:
+            # Nested authentication: the command is sent encrypted with the current session
+            frame, parity = self.cipher.encrypt(append_crc_a(command))
+
+        received, _, bits = self.engine.transceive_raw(frame, parity)
+        if bits != 32:
+            raise IOError("Expected a 32-bit card nonce, got {} bits".format(bits))
+        nt = int.from_bytes(received, byteorder='big')
+        if self.cipher is not None:
+            # The nested nonce is encrypted with the keystream of the new key, fed with uid ^ nt
+            cipher = Crypto1(key)
+            nt = nt ^ cipher.word(self.uid ^ nt, True)
+            self.cipher = None
+
+        nr = int.from_bytes(os.urandom(4), byteorder='big') if nr is None else nr
+        cipher, nr_ar, nr_ar_parity = reader_auth_response(key, self.uid, nt, nr)
+
+        received, received_parity, bits = self.engine.transceive_raw(nr_ar, nr_ar_parity)
+        self.trace = [('T', nt.to_bytes(4, 'big')), ('R', nr_ar), ('T', received)]
+        if bits != 32:
+            return False
+
+        at = cipher.decrypt(received)
+        if int.from_bytes(at, byteorder='big') != prng_successor(nt, 96):
+            return False
+
+        self.cipher = cipher
+        return True
+
+    def transceive(self, data):
+        """
+        Send an encrypted command (CRC appended) and decrypt the response
+        :return: the plain response; for a 4-bit answer, an int with the ACK/NAK nibble
+        """
+        if self.cipher is None:
+            raise IOError("Not authenticated")
+        frame, parity = self.cipher.encrypt(append_crc_a(data))
+        received, received_parity, bits = self.engine.transceive_raw(frame, parity)
+        if bits == 4:
+            return self.cipher.decrypt_bits(received[0], 4)
+        return self.cipher.decrypt(received, received_parity)
+
+    def read_block(self, block):
+        """Read a block of the authenticated sector
+        :rtype bytes"""
+        response = self.transceive([self.MC_READ, block])
+        if isinstance(response, int) or len(response) != 18:
+            raise IOError("Reading block {} failed".format(block))
+        if not check_crc_a(response):
+            raise IOError("CRC error reading block {}".format(block))
+        return response[:16]
+
+    def write_block(self, block, data):
+        """Write 16 bytes to a block of the authenticated sector, in the two steps of the Mifare WRITE command"""
+        if len(data) != 16:
+            raise ValueError("Data value to be written must be 16 bytes.")
+        if self.transceive([self.MC_WRITE, block]) != self.ACK:
+            raise IOError("Card refused writing block {}".format(block))
+        if self.transceive(bytes(data)) != self.ACK:
+            raise IOError("Writing block {} failed".format(block))
+
+
+def benchmark(seconds=1.0, batch_size=4096):
+    """
+    Measure keystream throughput of the scalar cipher and, when NumPy is installed, of Crypto1Batch
+    :return: dict of path -> keystream bits per second
+    """
+    results = {}
+
+    cipher = Crypto1(0xA0A1A2A3A4A5)
+    bits = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        cipher.word()
+        bits += 32
+    results['scalar'] = bits / (time.time() - start)
+
+    if numpy is not None:
+        batch = Crypto1Batch(range(0xA0A1A2A3A4A5, 0xA0A1A2A3A4A5 + batch_size))
+        bits = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            batch.word()
+            bits += 32 * batch_size
+        results['numpy batch of {}'.format(batch_size)] = bits / (time.time() - start)
+
+    return results
+
+
+if __name__ == "__main__":
+    for path, rate in sorted(benchmark().items()):
+        print("{:>24}: {:>14,.0f} keystream bits/s".format(path, rate))
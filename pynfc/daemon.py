@@ -0,0 +1,402 @@
+"""A local daemon that owns the readers and serves many client processes over a Unix socket
+
+Only one process can open a USB or UART reader. The daemon opens every reader once, as an NTagReadWrite, and keeps them
+open, so clients get no init/open cost and a restarting client does not reset the reader:
+    $ python -m pynfc.daemon --socket /tmp/pynfc.sock
+
+Protocol: every frame is a header (body length, request id, op or status, reader index; see HEADER) and a body.
+Clients may send many requests without waiting for the responses (pipelining). Every reader executes its requests in
+order in its own thread, and responses carry the request id, so responses for different readers can arrive out of
+order. An identical READ that is still waiting for or busy with the reader gets the same response instead of being
+sent to the tag again, unless another command for that reader came in between.
+
+Subscribing to a reader makes the daemon scan it for tags when it is idle, and report tags that arrive and leave as
+EVENT frames with the request id of the subscription. Use pynfc.daemon_client.DaemonClient to talk to the daemon.
+"""
+
+import argparse
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+from .context import default_registry
+from .ntag_read import NTagReadWrite
+
+DEFAULT_SOCKET = '/tmp/pynfc.sock'
+
+# body length, request id, op (request) or status (response), reader index
+HEADER = struct.Struct('>IIBB')
+MAX_BODY = 64 * 1024
+ALL_READERS = 0xFF
+
+OP_READERS = 0x01      # -> connstrings of the readers, separated by newlines
+OP_POLL = 0x02         # -> UID of the tag found, empty when there is none
+OP_READ = 0x03         # start page, end page (>HH) -> the pages
+OP_WRITE = 0x04        # page (>H) and the data, a multiple of 4 bytes -> empty
+OP_AUTH = 0x05         # password (4 bytes) and acknowledge (2 bytes) -> 0x01 when accepted, else 0x00
+OP_SUBSCRIBE = 0x06    # -> empty, then EVENT frames with the request id of this request
+OP_UNSUBSCRIBE = 0x07  # request id of the subscription (>I) -> empty
+
+STATUS_OK = 0x00
+STATUS_ERROR = 0x01    # body is the error message, UTF-8
+STATUS_EVENT = 0x02    # body is the event kind and the UID
+
+EVENT_ARRIVED = 0x01
+EVENT_LEFT = 0x02
+
+READ_RANGE = struct.Struct('>HH')
+PAGE = struct.Struct('>H')
+SUBSCRIPTION = struct.Struct('>I')
+
+
+def encode_frame(request_id, code, reader, body=b''):
+    """:param code: op for requests, status for responses"""
+    if len(body) > MAX_BODY:
+        raise ValueError("Frame body of {} bytes exceeds the maximum of {}".format(len(body), MAX_BODY))
+    return HEADER.pack(len(body), request_id, code, reader) + body
+
+
+def read_frame(stream):
+    """
+    Read one frame from a binary file object, eg. socket.makefile('rb')
+    :return: tuple (request_id, code, reader, body) or None at the end of the stream
+    :raises IOError: on a truncated or oversized frame
+    """
+    header = stream.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise IOError("Connection closed halfway a frame header")
+    length, request_id, code, reader = HEADER.unpack(header)
+    if length > MAX_BODY:
+        raise IOError("Frame body of {} bytes exceeds the maximum of {}".format(length, MAX_BODY))
+    body = stream.read(length) if length else b''
+    if len(body) < length:
+        raise IOError("Connection closed halfway a frame body")
+    return request_id, code, reader, body
+
+
+class Connection(object):
+    """A client connection. Frames are sent from the reader threads too, so sending is serialised"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.subscriptions = {}  # request id of the subscription -> reader index or ALL_READERS
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, request_id, status, reader, body=b''):
+        frame = encode_frame(request_id, status, reader, body)
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.closed = True
+
+    def error(self, request_id, reader, message):
+        self.send(request_id, STATUS_ERROR, reader, str(message).encode('utf-8'))
+
+
+_WAKE = object()  # Put in the job queue of a reader thread to wake it up
+
+
+class Job(object):
+    """A request for a reader, and everyone waiting for its response"""
+
+    def __init__(self, op, body, connection, request_id):
+        self.op = op
+        self.body = body
+        self.waiters = [(connection, request_id)]
+
+
+class ReaderWorker(threading.Thread):
+    """Executes the requests for one reader in order, and scans for tags in between when there are subscribers"""
+
+    def __init__(self, index, session, server, scan_interval=0.2, scan_holdoff=1.0):
+        """
+        :param session: an opened NTagReadWrite
+        :param server: the ReaderDaemon, which gets the events
+        :param scan_interval: seconds between scans for tags when there are subscribers
+        :param scan_holdoff: seconds without requests before scanning, so scanning does not deselect a tag
+            halfway a sequence like AUTH and WRITE
+        """
+        super(ReaderWorker, self).__init__(name="pynfc-reader-{}".format(index), daemon=True)
+        self.index = index
+        self.session = session
+        self.server = server
+        self.scan_interval = scan_interval
+        self.scan_holdoff = scan_holdoff
+        self.jobs = queue.Queue()
+        self.requests = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._pending_reads = {}  # body of a READ -> Job that has not been answered yet
+        self._last_request = 0.0
+        self._next_scan = 0.0
+        self._present_uid = None
+
+    def submit(self, op, body, connection, request_id):
+        with self._lock:
+            if op == OP_READ:
+                job = self._pending_reads.get(body)
+                if job is not None:
+                    job.waiters += [(connection, request_id)]
+                    self.coalesced += 1
+                    return
+                job = self._pending_reads[body] = Job(op, body, connection, request_id)
+            else:
+                # Reads after this request may see what it changes, so they must not join an earlier read
+                self._pending_reads.clear()
+                job = Job(op, body, connection, request_id)
+        self.jobs.put(job)
+
+    def wake(self):
+        """Re-evaluate whether to scan, eg. after a subscription was added"""
+        self.jobs.put(_WAKE)
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def _execute(self, op, body):
+        session = self.session
+        if op == OP_POLL:
+            return session.setup_target() or b''
+        if op == OP_READ:
+            start_page, end_page = READ_RANGE.unpack(body)
+            if end_page < start_page:
+                raise ValueError("End page {} before start page {}".format(end_page, start_page))
+            result = session.read_pages_resumable(start_page, end_page, uid=session.uid)
+            if not result.complete:
+                raise IOError("Could not read pages {}".format(result.missing_ranges()))
+            return result.data
+        if op == OP_WRITE:
+            page, = PAGE.unpack(body[:PAGE.size])
+            data = body[PAGE.size:]
+            if not data or len(data) % 4:
+                raise ValueError("Data to write must be a multiple of 4 bytes, not {}".format(len(data)))
+            for offset in range(0, len(data), 4):
+                session.write_page(page + offset // 4, data[offset:offset + 4])
+            return b''
+        if op == OP_AUTH:
+            if len(body) != 6:
+                raise ValueError("AUTH takes a 4-byte password and a 2-byte acknowledge")
+            return b'\x01' if session.authenticate(body[:4], body[4:]) else b'\x00'
+        raise ValueError("Unknown op {:#04x}".format(op))
+
+    def _run_job(self, job):
+        self.requests += 1
+        try:
+            status, response = STATUS_OK, self._execute(job.op, job.body)
+        except Exception as error:  # Whatever goes wrong, the reader thread must keep serving
+            self.server.logger.info("Request {:#04x} on reader {} failed: {}".format(job.op, self.index, error))
+            status, response = STATUS_ERROR, str(error).encode('utf-8')
+
+        with self._lock:
+            if job.op == OP_READ and self._pending_reads.get(job.body) is job:
+                del self._pending_reads[job.body]
+            waiters = list(job.waiters)
+        self._last_request = time.monotonic()
+        for connection, request_id in waiters:
+            connection.send(request_id, status, self.index, response)
+
+    def _scan(self):
+        self._next_scan = time.monotonic() + self.scan_interval
+        session = self.session
+        try:
+            # Selecting again would send REQA, which an active tag answers by falling back to IDLE without a reply.
+            # So a tag that is still there is only checked for, and only an empty field is scanned
+            if self._present_uid is not None and session.uid == self._present_uid and session.target_is_present():
+                return
+            uid = session.select_target()
+        except IOError as error:
+            self.server.logger.info("Scanning reader {} failed: {}".format(self.index, error))
+            return
+        if uid == self._present_uid:
+            return
+        if self._present_uid is not None:
+            self.server.publish(self.index, EVENT_LEFT, self._present_uid)
+        if uid is not None:
+            self.server.publish(self.index, EVENT_ARRIVED, uid)
+        self._present_uid = uid
+        session.uid = uid  # Reads check the tag against it
+
+    def _scan_due(self):
+        now = time.monotonic()
+        if now < self._next_scan or now - self._last_request < self.scan_holdoff:
+            return max(self._next_scan, self._last_request + self.scan_holdoff) - now
+        return 0.0
+
+    def run(self):
+        while True:
+            wait = None
+            if self.server.has_subscribers(self.index):
+                wait = self._scan_due()
+                if wait <= 0:
+                    self._scan()
+                    continue
+            try:
+                job = self.jobs.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if job is None:
+                return
+            if job is not _WAKE:
+                self._run_job(job)
+
+
+class ReaderDaemon(object):
+    """Serves opened reader sessions over a Unix socket, see the module documentation for the protocol"""
+
+    def __init__(self, sessions, path=DEFAULT_SOCKET, scan_interval=0.2, logger=logging.getLogger("pynfc_daemon")):
+        """
+        :param sessions: list of opened NTagReadWrite objects, one per reader. The index in the list is the reader
+            index of the protocol
+        :param path: path of the Unix socket
+        """
+        self.sessions = sessions
+        self.path = path
+        self.logger = logger
+        self.workers = [ReaderWorker(index, session, self, scan_interval) for index, session in enumerate(sessions)]
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stopped = threading.Event()
+
+    def has_subscribers(self, reader):
+        with self._lock:
+            return any(subscribed in (reader, ALL_READERS)
+                       for connection in self.connections for subscribed in connection.subscriptions.values())
+
+    def publish(self, reader, kind, uid):
+        with self._lock:
+            subscriptions = [(connection, request_id) for connection in self.connections
+                             for request_id, subscribed in connection.subscriptions.items()
+                             if subscribed in (reader, ALL_READERS)]
+        for connection, request_id in subscriptions:
+            connection.send(request_id, STATUS_EVENT, reader, bytes([kind]) + uid)
+
+    def _dispatch(self, connection, request_id, op, reader, body):
+        if op == OP_READERS:
+            connstrings = [session.connstring or b'' for session in self.sessions]
+            connection.send(request_id, STATUS_OK, reader, b'\n'.join(connstrings))
+        elif op == OP_SUBSCRIBE:
+            if reader != ALL_READERS and reader >= len(self.workers):
+                connection.error(request_id, reader, "No reader {}".format(reader))
+                return
+            with self._lock:
+                connection.subscriptions[request_id] = reader
+            connection.send(request_id, STATUS_OK, reader)
+            for worker in self.workers:
+                worker.wake()
+        elif op == OP_UNSUBSCRIBE:
+            if len(body) != SUBSCRIPTION.size:
+                connection.error(request_id, reader, "UNSUBSCRIBE takes the request id of the subscription")
+                return
+            with self._lock:
+                connection.subscriptions.pop(SUBSCRIPTION.unpack(body)[0], None)
+            connection.send(request_id, STATUS_OK, reader)
+        elif reader >= len(self.workers):
+            connection.error(request_id, reader, "No reader {}".format(reader))
+        else:
+            self.workers[reader].submit(op, body, connection, request_id)
+
+    def _serve_connection(self, sock):
+        connection = Connection(sock)
+        with self._lock:
+            self.connections.add(connection)
+        try:
+            with sock.makefile('rb') as stream:
+                while True:
+                    frame = read_frame(stream)
+                    if frame is None:
+                        break
+                    request_id, op, reader, body = frame
+                    self._dispatch(connection, request_id, op, reader, body)
+        except (IOError, OSError) as error:
+            self.logger.info("Dropping connection: {}".format(error))
+        finally:
+            with self._lock:
+                self.connections.discard(connection)
+            connection.closed = True
+            sock.close()
+
+    def start(self):
+        """Start listening and the reader threads. serve_forever() accepts the connections"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(16)
+        for worker in self.workers:
+            worker.start()
+        self.logger.info("Serving {} readers on {}".format(len(self.workers), self.path))
+
+    def serve_forever(self):
+        if self._sock is None:
+            self.start()
+        while not self._stopped.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break  # The socket was closed by stop()
+            threading.Thread(target=self._serve_connection, args=(sock,), daemon=True).start()
+
+    def stop(self):
+        """Stop serving, after the requests already queued for the readers. The sessions are not closed"""
+        self._stopped.set()
+        if self._sock is not None:
+            self._sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
+
+
+def open_sessions(count=None, logger=logging.getLogger("pynfc_daemon")):
+    """
+    Open an NTagReadWrite on count readers, or on every reader found
+    :rtype list
+    """
+    if count is None:
+        count = len(default_registry().connstrings or default_registry().discover())
+    sessions = []
+    for _ in range(count):
+        sessions += [NTagReadWrite(logger=logger)]
+    return sessions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve NFC readers to local clients over a Unix socket")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="path of the Unix socket")
+    parser.add_argument('--readers', type=int, default=None, help="number of readers to open, all by default")
+    parser.add_argument('--scan-interval', type=float, default=0.2, help="seconds between scans for subscribers")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    sessions = open_sessions(args.readers)
+    if not sessions:
+        raise IOError("No devices found")
+
+    daemon = ReaderDaemon(sessions, path=args.socket, scan_interval=args.scan_interval)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        for session in sessions:
+            session.close()
+
+
+if __name__ == "__main__":
+    main()
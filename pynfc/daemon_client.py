@@ -0,0 +1,175 @@
+"""Client for pynfc.daemon
+
+Requests are pipelined: the *_async methods send a request and return a concurrent.futures.Future right away, the
+other methods wait for the response:
+    with DaemonClient() as client:
+        uid = client.poll(0)
+        futures = [client.read_async(0, page, page + 15) for page in range(4, 132, 16)]
+        data = b''.join(future.result() for future in futures)
+
+Events of subscriptions go to a callback, or else to the events queue as tuples (reader, kind, uid).
+"""
+
+import concurrent.futures
+import itertools
+import queue
+import socket
+import threading
+
+from .daemon import (ALL_READERS, DEFAULT_SOCKET, OP_AUTH, OP_POLL, OP_READ, OP_READERS, OP_SUBSCRIBE,
+                     OP_UNSUBSCRIBE, OP_WRITE, PAGE, READ_RANGE, STATUS_ERROR, STATUS_EVENT, SUBSCRIPTION,
+                     encode_frame, read_frame)
+
+
+class DaemonClient(object):
+    """A connection to a pynfc daemon. Safe to use from many threads"""
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        """
+        :param path: path of the daemon's Unix socket
+        :param timeout: default seconds to wait for a response in the blocking methods, None to wait forever
+        """
+        self.timeout = timeout
+        self.events = queue.Queue()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._stream = self._sock.makefile('rb')
+        self._ids = itertools.count(1)
+        self._pending = {}  # request id -> Future
+        self._callbacks = {}  # request id of a subscription -> callback, or None for the events queue
+        self._lock = threading.Lock()
+        self._closed = False
+        self._receiver = threading.Thread(target=self._receive, name="pynfc-daemon-client", daemon=True)
+        self._receiver.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _receive(self):
+        error = IOError("Connection to the daemon closed")
+        try:
+            while True:
+                frame = read_frame(self._stream)
+                if frame is None:
+                    break
+                request_id, status, reader, body = frame
+                if status == STATUS_EVENT:
+                    self._event(request_id, reader, body)
+                    continue
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if status == STATUS_ERROR:
+                    future.set_exception(IOError(body.decode('utf-8', 'replace')))
+                else:
+                    future.set_result(body)
+        except (IOError, OSError) as failure:
+            error = failure
+        finally:
+            with self._lock:
+                self._closed = True
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(error)
+
+    def _event(self, request_id, reader, body):
+        with self._lock:
+            if request_id not in self._callbacks:
+                return
+            callback = self._callbacks[request_id]
+        event = (reader, body[0], bytes(body[1:]))
+        if callback is None:
+            self.events.put(event)
+        else:
+            callback(*event)
+
+    def request(self, op, reader=0, body=b''):
+        """
+        Send a request without waiting for the response
+        :rtype concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise IOError("Connection to the daemon closed")
+            request_id = next(self._ids) & 0xFFFFFFFF
+            self._pending[request_id] = future
+            # Sending under the lock keeps the frames of concurrent callers apart
+            self._sock.sendall(encode_frame(request_id, op, reader, body))
+        future.request_id = request_id
+        return future
+
+    def _call(self, op, reader=0, body=b''):
+        return self.request(op, reader, body).result(self.timeout)
+
+    def readers(self):
+        """:return: the connstrings of the readers of the daemon, in reader index order"""
+        body = self._call(OP_READERS)
+        return body.split(b'\n') if body else []
+
+    def poll_async(self, reader):
+        return self.request(OP_POLL, reader)
+
+    def poll(self, reader=0):
+        """:return: the UID of the tag on the reader, or None"""
+        return self.poll_async(reader).result(self.timeout) or None
+
+    def read_async(self, reader, start_page, end_page):
+        return self.request(OP_READ, reader, READ_RANGE.pack(start_page, end_page))
+
+    def read(self, reader, start_page, end_page):
+        """:return: the pages from start_page up to and including end_page"""
+        return self.read_async(reader, start_page, end_page).result(self.timeout)
+
+    def write_async(self, reader, page, data):
+        return self.request(OP_WRITE, reader, PAGE.pack(page) + bytes(data))
+
+    def write(self, reader, page, data):
+        """Write data, a multiple of 4 bytes, from page on"""
+        self.write_async(reader, page, data).result(self.timeout)
+
+    def authenticate(self, reader, password, acknowledge=b'\x00\x00'):
+        """:return: whether the tag accepted the password"""
+        return self._call(OP_AUTH, reader, bytes(password) + bytes(acknowledge)) == b'\x01'
+
+    def subscribe(self, reader=ALL_READERS, callback=None):
+        """
+        Get an event for every tag that arrives on or leaves the reader
+        :param callback: called with (reader, kind, uid) from the receiving thread. Without one, the events are put
+            in the events queue
+        :return: the subscription id, for unsubscribe()
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise IOError("Connection to the daemon closed")
+            request_id = next(self._ids) & 0xFFFFFFFF
+            # Registered before sending, so no event can arrive for an unknown subscription
+            self._callbacks[request_id] = callback
+            self._pending[request_id] = future
+            self._sock.sendall(encode_frame(request_id, OP_SUBSCRIBE, reader))
+        try:
+            future.result(self.timeout)
+        except IOError:
+            with self._lock:
+                self._callbacks.pop(request_id, None)
+            raise
+        return request_id
+
+    def unsubscribe(self, subscription):
+        self._call(OP_UNSUBSCRIBE, body=SUBSCRIPTION.pack(subscription))
+        with self._lock:
+            self._callbacks.pop(subscription, None)
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._receiver.join()
+        self._stream.close()
@@ -0,0 +1,232 @@
+"""A pool of opened reader sessions, shared by many threads
+
+An NTagReadWrite owns one device and is not thread-safe: two threads transceiving at the same time mix up each
+other's frames. A DevicePool opens one session per reader once and hands them out to one thread at a time:
+    pool = DevicePool(size=2)
+    with pool.session() as read_writer:
+        uid = read_writer.setup_target()
+        data = read_writer.read_user_memory(tag_type)
+
+Sessions stay open between checkouts. A session that was idle for a while is health-checked before it is handed out
+and reopened when the reader does not respond, so a request never gets a dead device.
+"""
+
+import collections
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+from . import pynfc as nfc
+from .context import default_registry
+from .ntag_read import NTagReadWrite
+
+
+def check_device(session):
+    """Default health check: a round trip to the reader that does not change its state"""
+    return nfc.nfc_device_set_property_bool(session.device, nfc.NP_ACTIVATE_FIELD, True) >= 0
+
+
+class PooledSession(object):
+    """A session and its lock. The lock is held by the thread that has the session checked out"""
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.checkouts = 0
+        self.broken = False  # Checked in after a failure, reopened on the next checkout
+        self.closed = False  # Closed by a reopen that failed, so it must not be closed again
+        self.owner = None  # The thread that has the session checked out
+
+
+class DevicePool(object):
+    """Opened sessions, eg. NTagReadWrite objects, checked out by one thread at a time"""
+
+    def __init__(self, size=None, factory=None, health_check=check_device, check_after=5.0, wait_window=1024,
+                 logger=logging.getLogger("device_pool")):
+        """
+        :param size: number of sessions, at most one per reader. By default one for every reader found
+        :param factory: callable that opens a new session, NTagReadWrite by default. The session needs a close()
+            and an open() that reopens it
+        :param health_check: callable taking a session, returning whether it still works. None to never check
+        :param check_after: only check sessions that were idle for this many seconds
+        :param wait_window: number of most recent queue wait times to keep for report()
+        """
+        self.factory = factory if factory is not None else lambda: NTagReadWrite(logger=logger)
+        self.health_check = health_check
+        self.check_after = check_after
+        self.logger = logger
+
+        if size is None:
+            size = len(default_registry().connstrings or default_registry().discover())
+        if size < 1:
+            raise IOError("No devices found for the pool")
+
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.entries = []
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.health_failures = 0
+        self.reopens = 0
+        self.waits = collections.deque(maxlen=wait_window)
+
+        try:
+            for _ in range(size):
+                entry = PooledSession(self.factory())
+                self.entries += [entry]
+                self._idle.put(entry)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _healthy(self, entry):
+        if entry.broken:
+            return False
+        if self.health_check is None or time.monotonic() - entry.last_used < self.check_after:
+            return True
+        try:
+            return self.health_check(entry.session)
+        except IOError:
+            return False
+
+    def _reopen(self, entry):
+        """Reopen the session of entry. The context and known connstrings make this cheap, see pynfc.context"""
+        with self._lock:
+            self.reopens += 1
+        # Stays broken until open() succeeds, so a failed reopen is retried on the next checkout
+        entry.broken = True
+        if not entry.closed:
+            try:
+                entry.session.close()
+            except IOError as error:
+                self.logger.info("Closing a broken session failed: {}".format(error))
+            entry.closed = True
+        entry.session.open()
+        entry.closed = False
+        entry.broken = False
+
+    def checkout(self, timeout=None):
+        """
+        Wait for an idle session and lock it for the calling thread. Give it back with checkin(), from the same thread
+        :param timeout: seconds to wait for a session, None to wait as long as it takes
+        :raises IOError: when no session became available in time, or the session is broken and does not reopen
+        """
+        if self._closed:
+            raise IOError("Device pool is closed")
+        start = time.perf_counter()
+        try:
+            entry = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            with self._lock:
+                self.checkout_timeouts += 1
+            raise IOError("No device available within {} s".format(timeout))
+        entry.lock.acquire()
+        entry.owner = threading.current_thread()
+        wait = time.perf_counter() - start
+
+        with self._lock:
+            self.waits.append(wait)
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+        try:
+            if not self._healthy(entry):
+                if not entry.broken:
+                    with self._lock:
+                        self.health_failures += 1
+                    self.logger.warning("Session failed its health check, reopening")
+                self._reopen(entry)
+        except Exception:
+            self._release(entry)
+            raise
+
+        entry.checkouts += 1
+        return entry.session
+
+    def _entry(self, session):
+        for entry in self.entries:
+            if entry.session is session:
+                return entry
+        raise ValueError("Session does not belong to this pool")
+
+    def _release(self, entry):
+        entry.owner = None
+        entry.last_used = time.monotonic()
+        with self._lock:
+            self.in_use -= 1
+        entry.lock.release()
+        self._idle.put(entry)
+
+    def checkin(self, session, broken=False):
+        """
+        Give back a checked-out session
+        :param broken: the session failed, eg. with an IOError from the device. It is reopened before its next use
+        """
+        entry = self._entry(session)
+        # A late or second checkin must not release the session while another thread has it checked out
+        if entry.owner is not threading.current_thread():
+            raise ValueError("Session is not checked out by this thread")
+        if broken:
+            entry.broken = True
+            self.logger.info("Session checked in as broken")
+        self._release(entry)
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        """Check out a session for the duration of a with block. An IOError inside the block marks it broken"""
+        session = self.checkout(timeout)
+        try:
+            yield session
+        except IOError:
+            self.checkin(session, broken=True)
+            raise
+        except BaseException:
+            self.checkin(session)
+            raise
+        self.checkin(session)
+
+    @staticmethod
+    def _percentile(values, percentile):
+        ordered = sorted(values)
+        return ordered[min(int(percentile * len(ordered)), len(ordered) - 1)]
+
+    def report(self):
+        """
+        :return: dict with the pool size, sessions in use now and at most, number of checkouts, checkouts that timed
+            out, failed health checks, reopens and the median, p95 and maximum queue wait time in ms
+        """
+        with self._lock:
+            waits = [wait * 1000 for wait in self.waits]
+            report = {'size': len(self.entries), 'in_use': self.in_use, 'peak_in_use': self.peak_in_use,
+                      'checkouts': self.checkouts, 'checkout_timeouts': self.checkout_timeouts,
+                      'health_failures': self.health_failures, 'reopens': self.reopens}
+        report['wait_p50_ms'] = self._percentile(waits, 0.5) if waits else None
+        report['wait_p95_ms'] = self._percentile(waits, 0.95) if waits else None
+        report['wait_max_ms'] = max(waits) if waits else None
+        return report
+
+    def close(self):
+        """Close all sessions, waiting for the ones that are checked out to be checked in"""
+        self._closed = True
+        for entry in self.entries:
+            with entry.lock:
+                if entry.closed:
+                    continue
+                try:
+                    entry.session.close()
+                except IOError as error:
+                    self.logger.info("Closing a session failed: {}".format(error))
+        self.entries = []
@@ -0,0 +1,144 @@
+"""Per-tag diversification of NTAG passwords from the UID and a master secret.
+
+A diversifier derives the 4-byte password and 2-byte PACK for a tag, see NTagReadWrite.authenticate and
+NTagReadWrite.set_password. Derived values are kept in an LRU cache and can be precomputed for a known batch of UIDs
+before a provisioning run, so the key derivation is not done while a tag is in the field.
+
+Two derivations are available:
+- HmacSha256Diversifier: HMAC-SHA256(master, label || UID || info), standard library only
+- AesCmacDiversifier: AES-CMAC(master, 0x01 || UID || info), in the spirit of NXP AN10922.
+  This needs the 'cryptography' package
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import threading
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import cmac
+    from cryptography.hazmat.primitives.ciphers import algorithms
+except ImportError:
+    cmac = None
+
+PASSWORD_LENGTH = 4
+PACK_LENGTH = 2
+
+
+class PasswordDiversifier(object):
+    """
+    Base class for diversifiers. Subclasses implement _derive_key_material, returning at least 6 bytes for a UID:
+    the first 4 are the password, the next 2 the PACK.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes only need the key material, not the cache
+        state = self.__dict__.copy()
+        state['_cache'] = collections.OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _derive_key_material(self, uid):
+        raise NotImplementedError
+
+    def _derive(self, uid):
+        material = self._derive_key_material(uid)
+        return material[:PASSWORD_LENGTH], material[PASSWORD_LENGTH:PASSWORD_LENGTH + PACK_LENGTH]
+
+    def _remember(self, uid, derived):
+        with self._lock:
+            self._cache[uid] = derived
+            self._cache.move_to_end(uid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def derive(self, uid):
+        """
+        :param uid: UID of the tag
+        :type uid bytes
+        :return: tuple (password, pack) of 4 and 2 bytes
+        """
+        uid = bytes(uid)
+        with self._lock:
+            derived = self._cache.get(uid)
+            if derived is not None:
+                self._cache.move_to_end(uid)
+                return derived
+
+        derived = self._derive(uid)
+        self._remember(uid, derived)
+        return derived
+
+    def precompute(self, uids, processes=None, chunksize=256):
+        """
+        Derive and cache the passwords for a batch of UIDs, eg. the UIDs of a roll of tags before a provisioning run.
+        When the batch is larger than cache_size, cache_size is raised to the size of the batch and stays there,
+        so the batch is not evicted by the next derivations.
+
+        :param processes: spread the derivations over this many worker processes. None or 1 derives in this process
+        :return: dict of UID -> (password, pack)
+        """
+        uids = [bytes(uid) for uid in uids]
+        self.cache_size = max(self.cache_size, len(uids))
+
+        if processes and processes > 1 and len(uids) > chunksize:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+                derived = list(pool.map(self._derive, uids, chunksize=chunksize))
+        else:
+            derived = [self._derive(uid) for uid in uids]
+
+        for uid, values in zip(uids, derived):
+            self._remember(uid, values)
+        return dict(zip(uids, derived))
+
+
+class HmacSha256Diversifier(PasswordDiversifier):
+    """password || PACK = first 6 bytes of HMAC-SHA256(master_key, label || UID || info)"""
+
+    def __init__(self, master_key, info=b'', label=b'NTAG21x-PWD', **kwargs):
+        """
+        :param master_key: the master secret, at least 16 bytes
+        :param info: optional extra diversification input, eg. an application identifier
+        """
+        super(HmacSha256Diversifier, self).__init__(**kwargs)
+        if len(master_key) < 16:
+            raise ValueError("Master key must be at least 16 bytes")
+        self.master_key = bytes(master_key)
+        self.info = bytes(info)
+        self.label = bytes(label)
+
+    def _derive_key_material(self, uid):
+        return hmac.new(self.master_key, self.label + uid + self.info, hashlib.sha256).digest()
+
+
+class AesCmacDiversifier(PasswordDiversifier):
+    """password || PACK = first 6 bytes of AES-CMAC(master_key, 0x01 || UID || info)"""
+
+    def __init__(self, master_key, info=b'', **kwargs):
+        """
+        :param master_key: AES key of 16, 24 or 32 bytes
+        :param info: optional extra diversification input, eg. an application identifier
+        """
+        if cmac is None:
+            raise ImportError("AES-CMAC diversification requires the 'cryptography' package")
+        super(AesCmacDiversifier, self).__init__(**kwargs)
+        if len(master_key) not in (16, 24, 32):
+            raise ValueError("Master key must be an AES key of 16, 24 or 32 bytes")
+        self.master_key = bytes(master_key)
+        self.info = bytes(info)
+
+    def _derive_key_material(self, uid):
+        mac = cmac.CMAC(algorithms.AES(self.master_key), backend=default_backend())
+        mac.update(b'\x01' + uid + self.info)
+        return mac.finalize()
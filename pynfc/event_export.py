@@ -0,0 +1,427 @@
+"""Export scan records from many reader hosts to one aggregator
+
+An EventExporter collects scan records (timestamp, reader, UID, tag type and a digest of the payload) and sends them
+in batches: one length-prefixed, zlib-compressed frame per batch, so the cost of the socket and of compressing is
+shared by all records in the batch. Frames go over TCP or a Unix socket to an EventAggregator, which merges the
+streams of all hosts by timestamp.
+
+When the aggregator cannot be reached, the exporter appends the frames to a spool file and sends them first once it
+is back. Without a spool, or when the spool is full, the exporter stops taking records from its queue, so publish()
+blocks: the scanner slows down instead of losing records silently.
+
+    exporter = EventExporter(('aggregator.local', 7010), spool_dir='/var/spool/pynfc')
+    read_writer = NTagReadWrite(event_ring=exporter)  # or exporter.publish(uid, tag_type, payload)
+
+    aggregator = EventAggregator(('0.0.0.0', 7010), on_record=print)
+    aggregator.serve_forever()
+
+Frames are handed to the socket without acknowledgement, so the frames in flight when a connection breaks can be lost.
+"""
+
+import collections
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+
+# body length, flags
+FRAME_HEADER = struct.Struct('>IB')
+FLAG_ZLIB = 0x01
+MAX_FRAME = 16 * 1024 * 1024
+
+# number of records, length of the source name
+BATCH_HEADER = struct.Struct('>IB')
+# timestamp, reader, UID length, tag type length. Followed by the UID, the tag type and the digest
+RECORD_HEADER = struct.Struct('>dHBB')
+DIGEST_SIZE = 16
+
+ScanRecord = collections.namedtuple('ScanRecord', 'timestamp reader uid tag_type digest')
+
+
+def payload_digest(payload):
+    return hashlib.blake2b(bytes(payload), digest_size=DIGEST_SIZE).digest()
+
+
+def encode_batch(source, records, level=6):
+    """
+    :param source: name of the sending host, at most 255 bytes in UTF-8
+    :param records: list of ScanRecord
+    :param level: zlib compression level, 0 to not compress
+    :return: a complete frame
+    """
+    name = source.encode('utf-8')[:255]
+    parts = [BATCH_HEADER.pack(len(records), len(name)), name]
+    for record in records:
+        tag_type = (record.tag_type or '').encode('utf-8')[:255]
+        parts += [RECORD_HEADER.pack(record.timestamp, record.reader, len(record.uid), len(tag_type)),
+                  bytes(record.uid), tag_type, record.digest]
+    body = b''.join(parts)
+
+    flags = 0
+    if level:
+        compressed = zlib.compress(body, level)
+        if len(compressed) < len(body):
+            body, flags = compressed, FLAG_ZLIB
+    return FRAME_HEADER.pack(len(body), flags) + body
+
+
+def decode_batch(flags, body):
+    """
+    :return: tuple (source, list of ScanRecord)
+    :raises ValueError: when the batch is malformed or decompresses to more than MAX_FRAME bytes
+    """
+    if flags & FLAG_ZLIB:
+        # The body comes from a peer, so bound what it may expand to
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(body, MAX_FRAME)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Batch decompresses to more than {} bytes".format(MAX_FRAME))
+        if not decompressor.eof:
+            raise ValueError("Compressed batch is truncated")
+    count, name_length = BATCH_HEADER.unpack_from(body, 0)
+    offset = BATCH_HEADER.size
+    source = body[offset:offset + name_length].decode('utf-8', 'replace')
+    offset += name_length
+
+    records = []
+    for _ in range(count):
+        timestamp, reader, uid_length, type_length = RECORD_HEADER.unpack_from(body, offset)
+        offset += RECORD_HEADER.size
+        uid = body[offset:offset + uid_length]
+        offset += uid_length
+        tag_type = body[offset:offset + type_length].decode('utf-8', 'replace') or None
+        offset += type_length
+        digest = body[offset:offset + DIGEST_SIZE]
+        offset += DIGEST_SIZE
+        records += [ScanRecord(timestamp, reader, uid, tag_type, digest)]
+    if offset != len(body):
+        raise ValueError("Batch has {} bytes after its {} records".format(len(body) - offset, count))
+    return source, records
+
+
+def read_frame(stream):
+    """
+    Read one frame from a binary file object
+    :return: tuple (flags, body), or None at the end of the stream
+    :raises IOError: on a truncated or oversized frame
+    """
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise IOError("Stream ends halfway a frame header")
+    length, flags = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise IOError("Frame of {} bytes exceeds the maximum of {}".format(length, MAX_FRAME))
+    body = stream.read(length)
+    if len(body) < length:
+        raise IOError("Stream ends halfway a frame")
+    return flags, body
+
+
+def _socket_for(address):
+    """A TCP socket for a (host, port) tuple, a Unix socket for a path"""
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+class EventExporter(object):
+    """Batches scan records and ships them to an EventAggregator from a background thread"""
+
+    def __init__(self, address, source=None, batch_size=256, max_delay=1.0, max_queue=10000, block_timeout=5.0,
+                 spool_dir=None, max_spool_bytes=64 * 1024 * 1024, retry_interval=1.0, compress_level=6,
+                 logger=logging.getLogger("event_export")):
+        """
+        :param address: (host, port) of a TCP aggregator, or the path of a Unix socket
+        :param source: name of this host in the records, the host name by default
+        :param batch_size: send a batch when it has this many records
+        :param max_delay: or when its first record waited this many seconds
+        :param max_queue: records waiting to be batched. When full, publish() blocks
+        :param block_timeout: seconds publish() blocks on a full queue before it drops the record. None to block
+            as long as it takes
+        :param spool_dir: directory for the spool file. None to not spool: while the aggregator cannot be reached,
+            the batch being sent is retried and publish() blocks once the queue is full
+        :param max_spool_bytes: stop spooling beyond this size, which makes publish() block
+        :param retry_interval: seconds between attempts to reach the aggregator
+        """
+        self.address = address
+        self.source = source or socket.gethostname()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.block_timeout = block_timeout
+        self.max_spool_bytes = max_spool_bytes
+        self.retry_interval = retry_interval
+        self.compress_level = compress_level
+        self.logger = logger
+        self.spool_path = os.path.join(spool_dir, "{}.spool".format(self.source)) if spool_dir else None
+
+        self.records = 0
+        self.dropped = 0
+        self.batches = 0
+        self.bytes_raw = 0
+        self.bytes_sent = 0
+        self.spooled_frames = 0
+        self.connects = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._sock = None
+        self._next_attempt = 0.0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pynfc-event-export", daemon=True)
+        self._thread.start()
+
+    def publish(self, uid, tag_type=None, payload=b'', kind=None, reader=0, timestamp=None):
+        """
+        Queue a scan record. Takes the arguments of EventRing.publish, so an exporter can be passed as the
+        event_ring of an NTagReadWrite or NFCReader
+        :return: whether the record was queued, False when it was dropped after block_timeout
+        """
+        record = ScanRecord(timestamp if timestamp is not None else time.time(), reader, bytes(uid), tag_type,
+                            payload_digest(payload))
+        try:
+            self._queue.put(record, timeout=self.block_timeout)
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning("Export queue full, dropped the record of {}".format(bytes(uid).hex()))
+            return False
+        self.records += 1
+        return True
+
+    def _collect(self):
+        """Wait for a batch: batch_size records, or what arrived within max_delay of the first record"""
+        try:
+            batch = [self._queue.get(timeout=self.max_delay)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch += [self._queue.get(timeout=max(remaining, 0)) if remaining > 0 else self._queue.get_nowait()]
+            except queue.Empty:
+                break
+        return batch
+
+    def _connect(self):
+        if self._sock is not None:
+            return True
+        if time.monotonic() < self._next_attempt:
+            return False
+        sock = _socket_for(self.address)
+        try:
+            sock.connect(self.address)
+        except OSError as error:
+            sock.close()
+            self._next_attempt = time.monotonic() + self.retry_interval
+            self.logger.info("Aggregator {} unreachable: {}".format(self.address, error))
+            return False
+        self._sock = sock
+        self.connects += 1
+        return True
+
+    def _send(self, frame):
+        if not self._connect():
+            return False
+        try:
+            self._sock.sendall(frame)
+        except OSError as error:
+            self.logger.info("Lost the connection to aggregator {}: {}".format(self.address, error))
+            self._sock.close()
+            self._sock = None
+            self._next_attempt = time.monotonic() + self.retry_interval
+            return False
+        self.bytes_sent += len(frame)
+        return True
+
+    def _spool_size(self):
+        try:
+            return os.path.getsize(self.spool_path) if self.spool_path else 0
+        except OSError:
+            return 0
+
+    def _spool(self, frame):
+        if self.spool_path is None or self._spool_size() + len(frame) > self.max_spool_bytes:
+            return False
+        with open(self.spool_path, 'ab') as spool:
+            spool.write(frame)
+        self.spooled_frames += 1
+        return True
+
+    def _replay(self):
+        """Send the spooled frames. :return: whether the spool is empty now"""
+        if not self._spool_size():
+            return True
+        if not self._connect():
+            return False
+        with open(self.spool_path, 'rb') as spool:
+            frames = []
+            while True:
+                try:
+                    frame = read_frame(spool)
+                except IOError:
+                    self.logger.warning("Spool ends with a truncated frame, skipping it")
+                    break
+                if frame is None:
+                    break
+                flags, body = frame
+                frames += [FRAME_HEADER.pack(len(body), flags) + body]
+        for index, frame in enumerate(frames):
+            if not self._send(frame):
+                # Keep what was not sent, in order
+                with open(self.spool_path, 'wb') as spool:
+                    spool.write(b''.join(frames[index:]))
+                return False
+        os.remove(self.spool_path)
+        self.logger.info("Sent {} spooled batches".format(len(frames)))
+        return True
+
+    def _deliver(self, frame):
+        """Send frame after the spooled ones, or spool it. Without room to spool, retry until it is sent"""
+        while True:
+            if self._replay() and self._send(frame):
+                return
+            if self._spool(frame):
+                return
+            if self._stopped.is_set():
+                self.logger.warning("Exporter stopped with an unsent batch")
+                return
+            time.sleep(self.retry_interval)
+
+    def _run(self):
+        while not (self._stopped.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if not batch:
+                self._replay()
+                continue
+            frame = encode_batch(self.source, batch, self.compress_level)
+            self.batches += 1
+            self.bytes_raw += sum(RECORD_HEADER.size + len(record.uid) + len(record.tag_type or '') + DIGEST_SIZE
+                                  for record in batch)
+            self._deliver(frame)
+
+    def report(self):
+        """:return: dict with the number of records queued, dropped and in the queue, batches, bytes and spooling"""
+        return {'records': self.records, 'dropped': self.dropped, 'queued': self._queue.qsize(),
+                'batches': self.batches, 'records_per_batch': self.records / self.batches if self.batches else None,
+                'bytes_raw': self.bytes_raw, 'bytes_sent': self.bytes_sent, 'spooled_frames': self.spooled_frames,
+                'spool_bytes': self._spool_size(), 'connects': self.connects}
+
+    def close(self, timeout=None):
+        """Send what is queued, then stop. Batches that cannot be sent stay in the spool"""
+        self._stopped.set()
+        self._thread.join(timeout)
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class EventAggregator(object):
+    """Receives batches from EventExporters and merges the records of all sources by timestamp"""
+
+    def __init__(self, address, lateness=1.0, on_record=None, logger=logging.getLogger("event_aggregator")):
+        """
+        :param address: (host, port) to listen on with TCP, or the path of a Unix socket
+        :param lateness: seconds to hold records back, so records of slower sources can be merged in before them
+        :param on_record: called with (source, ScanRecord) for every record, in timestamp order. Without it,
+            take the records with poll()
+        """
+        self.address = address
+        self.lateness = lateness
+        self.on_record = on_record
+        self.logger = logger
+        self.received = collections.Counter()  # source -> number of records
+        self.frames = 0
+        self.released = 0
+
+        self._heap = []
+        self._order = itertools.count()  # Keeps records with the same timestamp in arrival order
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._sock = _socket_for(self.address)
+        if isinstance(self.address, tuple):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self.address)
+        self._sock.listen(64)
+        threading.Thread(target=self._accept, name="pynfc-aggregator", daemon=True).start()
+        if self.on_record is not None:
+            threading.Thread(target=self._release_loop, name="pynfc-aggregator-release", daemon=True).start()
+
+    @property
+    def bound_address(self):
+        """The address listened on, eg. to find the port after binding to port 0"""
+        return self._sock.getsockname()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break  # Closed by stop()
+            threading.Thread(target=self._receive, args=(sock,), daemon=True).start()
+
+    def _receive(self, sock):
+        try:
+            with sock.makefile('rb') as stream:
+                while True:
+                    frame = read_frame(stream)
+                    if frame is None:
+                        break
+                    source, records = decode_batch(*frame)
+                    with self._lock:
+                        self.frames += 1
+                        self.received[source] += len(records)
+                        for record in records:
+                            heapq.heappush(self._heap, (record.timestamp, next(self._order), source, record))
+        except (IOError, OSError, ValueError, zlib.error, struct.error) as error:
+            self.logger.warning("Dropping exporter connection: {}".format(error))
+        finally:
+            sock.close()
+
+    def poll(self, now=None):
+        """
+        :return: the records older than lateness, as (source, ScanRecord) tuples in timestamp order
+        """
+        watermark = (now if now is not None else time.time()) - self.lateness
+        released = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= watermark:
+                _, _, source, record = heapq.heappop(self._heap)
+                released += [(source, record)]
+            self.released += len(released)
+        return released
+
+    def flush(self):
+        """:return: all records held back, in timestamp order"""
+        return self.poll(now=float('inf'))
+
+    def _release_loop(self):
+        while not self._stopped.wait(min(self.lateness, 0.1) or 0.1):
+            for source, record in self.poll():
+                self.on_record(source, record)
+
+    def serve_forever(self):
+        if self._sock is None:
+            self.start()
+        self._stopped.wait()
+
+    def stop(self):
+        self._stopped.set()
+        if self._sock is not None:
+            self._sock.close()
+            if not isinstance(self.address, tuple) and os.path.exists(self.address):
+                os.unlink(self.address)
+        if self.on_record is not None:
+            for source, record in self.flush():
+                self.on_record(source, record)
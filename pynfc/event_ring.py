@@ -0,0 +1,254 @@
+"""Scan events in a shared memory ring buffer, for any number of consumer processes
+
+The scanning process writes every event once, as a fixed-layout record in a slot of a multiprocessing.shared_memory
+block. Consumers attach to the block by name and read the records in place at their own pace, so adding a consumer
+adds no copying or serialising for the writer.
+
+Every event gets a sequence number, starting at 1. The header holds the sequence number of the next event to write;
+a slot holds event n in slot n % slots. The writer zeroes the sequence number of a slot before it writes the record
+and sets it when the record is complete, so a consumer can tell a complete record from one that is being written.
+A consumer that falls more than the number of slots behind has lost events: it counts them in overruns and continues
+with the oldest event still in the ring.
+
+    ring = EventRing.create(name='pynfc-events')                 # in the scanning process
+    read_writer = NTagReadWrite(event_ring=ring)
+
+    consumer = EventRingReader('pynfc-events')                    # in any other process
+    for event in consumer.events():
+        print(event.uid.hex(), event.tag_type, bytes(event.payload))
+"""
+
+import collections
+import struct
+import sys
+import time
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+
+MAGIC = b'PNFCRING'
+VERSION = 1
+
+# magic, version, slot size, number of slots, sequence number of the next event to write
+RING_HEADER = struct.Struct('<8sHHIQ')
+RING_HEADER_SIZE = 64
+NEXT_SEQUENCE_OFFSET = 16
+
+# sequence number, timestamp, reader id, kind, flags, UID length, UID, tag type, payload length
+SLOT_HEADER = struct.Struct('<QdHBBB10s16sI')
+SLOT_HEADER_SIZE = 64
+SEQUENCE = struct.Struct('<Q')
+
+EVENT_TAG = 0x01   # A tag was found, the payload is empty or what was read right away
+EVENT_NDEF = 0x02  # The NDEF message of a tag was read, it is the payload
+
+FLAG_TRUNCATED = 0x01  # The payload did not fit in the slot and was cut off
+
+ScanEvent = collections.namedtuple('ScanEvent', 'sequence timestamp reader kind flags uid tag_type payload')
+
+
+_created = set()  # Names of the rings created by this process
+
+
+def _require_shared_memory():
+    if shared_memory is None:
+        raise ImportError("The event ring needs multiprocessing.shared_memory, Python 3.8 or newer")
+
+
+def _attach(name):
+    """Open an existing shared memory block without making this process responsible for removing it"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Before Python 3.13, attaching registers the block with the resource tracker of this process, which removes it
+    # when this process exits, while the creator still uses it. So the registration is undone, unless this process
+    # (or the process it was forked from) created the block: then the tracker is shared and the registration is the
+    # creator's own. A process spawned by the creator also shares its tracker, there the creator loses the clean-up
+    # after a crash
+    memory = shared_memory.SharedMemory(name=name)
+    if memory.name not in _created:
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory
+
+
+class RingOverrun(Exception):
+    """A record was overwritten while it was being read"""
+
+
+class EventRing(object):
+    """The writing side of the ring. There must be only one writer per ring"""
+
+    def __init__(self, memory, owner=False):
+        """Use create() or attach()"""
+        self.memory = memory
+        self.owner = owner
+        magic, version, self.slot_size, self.slots, self.next_sequence = RING_HEADER.unpack_from(memory.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Shared memory {} does not hold an event ring".format(memory.name))
+        self.next_sequence = max(self.next_sequence, 1)
+        self.published = 0
+
+    @classmethod
+    def create(cls, name=None, slots=1024, slot_size=1024):
+        """
+        :param name: name of the shared memory block, generated when not given. Consumers attach by name
+        :param slots: number of events the ring holds. A consumer that falls further behind loses events
+        :param slot_size: bytes per event, of which SLOT_HEADER_SIZE are the record header. Longer payloads are cut off
+        """
+        _require_shared_memory()
+        if slot_size <= SLOT_HEADER_SIZE:
+            raise ValueError("Slot size must be more than {} bytes".format(SLOT_HEADER_SIZE))
+        memory = shared_memory.SharedMemory(name=name, create=True, size=RING_HEADER_SIZE + slots * slot_size)
+        RING_HEADER.pack_into(memory.buf, 0, MAGIC, VERSION, slot_size, slots, 1)
+        _created.add(memory.name)
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Continue writing to an existing ring, eg. after the scanning process restarted"""
+        _require_shared_memory()
+        return cls(_attach(name))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def payload_capacity(self):
+        return self.slot_size - SLOT_HEADER_SIZE
+
+    def publish(self, uid, tag_type=None, payload=b'', kind=EVENT_TAG, reader=0, timestamp=None):
+        """
+        Write an event into the next slot
+        :param uid: UID of the tag, at most 10 bytes
+        :param tag_type: name of the tag type, eg. 'NTAG_213', at most 16 characters
+        :param payload: eg. the NDEF message. Cut off at payload_capacity bytes, which sets FLAG_TRUNCATED
+        :return: the sequence number of the event
+        """
+        sequence = self.next_sequence
+        offset = RING_HEADER_SIZE + (sequence % self.slots) * self.slot_size
+        buf = self.memory.buf
+
+        payload = memoryview(payload)
+        flags = 0
+        if len(payload) > self.payload_capacity:
+            payload = payload[:self.payload_capacity]
+            flags |= FLAG_TRUNCATED
+        uid = bytes(uid)[:10]
+        name = (tag_type or '').encode('ascii', 'replace')[:16]
+
+        # Zero the sequence number first: a consumer never takes a half-written record for a complete one
+        SEQUENCE.pack_into(buf, offset, 0)
+        SLOT_HEADER.pack_into(buf, offset, 0, timestamp if timestamp is not None else time.time(), reader, kind,
+                              flags, len(uid), uid, name, len(payload))
+        start = offset + SLOT_HEADER_SIZE
+        buf[start:start + len(payload)] = payload
+        SEQUENCE.pack_into(buf, offset, sequence)
+
+        self.next_sequence = sequence + 1
+        SEQUENCE.pack_into(buf, NEXT_SEQUENCE_OFFSET, self.next_sequence)
+        self.published += 1
+        return sequence
+
+    def close(self):
+        """Detach. The ring is removed when its creator closes it"""
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            _created.discard(self.memory.name)
+
+
+class EventRingReader(object):
+    """
+    A consumer of a ring, attached by name. Every reader has its own position, so consumers do not slow down each
+    other or the writer
+    """
+
+    def __init__(self, name, from_start=False):
+        """
+        :param name: name of the ring's shared memory block
+        :param from_start: begin with the oldest event still in the ring instead of the next new one
+        """
+        _require_shared_memory()
+        self.memory = _attach(name)
+        magic, version, self.slot_size, self.slots, _ = RING_HEADER.unpack_from(self.memory.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Shared memory {} does not hold an event ring".format(name))
+
+        head = self.head
+        self.position = max(1, head - self.slots) if from_start else head
+        self.overruns = 0  # Events lost because this reader fell behind or a record changed while being read
+        self.received = 0
+
+    @property
+    def head(self):
+        """Sequence number of the next event the writer will publish"""
+        return SEQUENCE.unpack_from(self.memory.buf, NEXT_SEQUENCE_OFFSET)[0]
+
+    def _offset(self, sequence):
+        return RING_HEADER_SIZE + (sequence % self.slots) * self.slot_size
+
+    def intact(self, event):
+        """Whether the slot of event still holds it, ie. its payload view was not overwritten in the meantime"""
+        return SEQUENCE.unpack_from(self.memory.buf, self._offset(event.sequence))[0] == event.sequence
+
+    def read(self, sequence):
+        """
+        The event with the given sequence number, its payload a memoryview into the ring
+        :return: ScanEvent, or None when the slot no longer (or not yet) holds a complete record of that event
+        """
+        offset = self._offset(sequence)
+        stored, timestamp, reader, kind, flags, uid_length, uid, tag_type, length = \
+            SLOT_HEADER.unpack_from(self.memory.buf, offset)
+        if stored != sequence:
+            return None
+        start = offset + SLOT_HEADER_SIZE
+        event = ScanEvent(sequence, timestamp, reader, kind, flags, uid[:uid_length],
+                          tag_type.rstrip(b'\x00').decode('ascii', 'replace') or None,
+                          self.memory.buf[start:start + min(length, self.slot_size - SLOT_HEADER_SIZE)])
+        # The header fields were copied, check they belong to the same record
+        return event if self.intact(event) else None
+
+    def poll(self, max_events=None):
+        """
+        The events published since the last call, oldest first. Their payloads are views into the ring: use or
+        copy them before the writer laps this reader, or check with intact() afterwards
+        :rtype list
+        """
+        head = self.head
+        if head - self.position > self.slots:
+            lost = head - self.slots - self.position
+            self.overruns += lost
+            self.position = head - self.slots
+
+        events = []
+        while self.position < head and (max_events is None or len(events) < max_events):
+            event = self.read(self.position)
+            if event is None:
+                self.overruns += 1  # Overwritten by an event that lapped this reader
+            else:
+                events += [event]
+            self.position += 1
+        self.received += len(events)
+        return events
+
+    def events(self, interval=0.01, stop=None):
+        """
+        Generate events as they are published, checking for new ones every interval seconds.
+        An event whose payload was overwritten while the consumer handled it raises RingOverrun
+        :param stop: threading.Event or anything with is_set(), to end the generator
+        """
+        while stop is None or not stop.is_set():
+            events = self.poll()
+            for event in events:
+                yield event
+                if not self.intact(event):
+                    self.overruns += 1
+                    raise RingOverrun("Event {} was overwritten while it was being handled".format(event.sequence))
+            if not events:
+                time.sleep(interval)
+
+    def close(self):
+        """Detach. Drop all events first: their payloads are views that keep the shared memory mapped"""
+        self.memory.close()
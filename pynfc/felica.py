@@ -0,0 +1,316 @@
+"""FeliCa tags and NFC Forum Type 3 NDEF
+
+FeliCa frames start with a length byte that counts itself, followed by the command code and, for all commands but
+Polling, the 8-byte IDm of the card. Read Without Encryption (CHECK) and Write Without Encryption (UPDATE) take a list
+of blocks, so many 16-byte blocks are transferred per frame: the NDEF Attribute Information Block tells how many the
+card accepts (Nbr for reading, Nbw for writing), which is what makes FeliCa reads fast enough for gates.
+
+See NFC Forum "Type 3 Tag Operation Specification", NFCForum-TS-Type-3-Tag_1.1
+"""
+
+import collections
+import ctypes
+import logging
+
+from . import pynfc as nfc
+from .capabilities import BAUD_RATE_KBPS, BAUD_RATE_ORDER, DeviceCapabilities
+
+# Commands. The response code is the command code + 1
+FELICA_POLLING = 0x00
+FELICA_READ_WITHOUT_ENCRYPTION = 0x06
+FELICA_WRITE_WITHOUT_ENCRYPTION = 0x08
+
+SYSTEM_CODE_WILDCARD = 0xFFFF
+SYSTEM_CODE_NDEF = 0x12FC
+SERVICE_NDEF_READ = 0x000B
+SERVICE_NDEF_WRITE = 0x0009
+
+POLLING_REQUEST_NONE = 0x00
+POLLING_REQUEST_SYSTEM_CODE = 0x01
+
+BLOCK_SIZE = 16
+IDM_LENGTH = 8
+# The length byte of a frame counts itself, so a frame is at most 255 bytes
+MAX_FRAME_LENGTH = 255
+# A response of 15 blocks (13 + 240 bytes) is the most that fits in a frame
+MAX_BLOCKS_PER_FRAME = 15
+
+WRITE_IN_PROGRESS = 0x0F
+ACCESS_READ_ONLY = 0x00
+ACCESS_READ_WRITE = 0x01
+
+AttributeInformation = collections.namedtuple('AttributeInformation',
+                                              'version max_read_blocks max_write_blocks max_ndef_blocks '
+                                              'write_flag access length')
+
+
+def parse_attribute_block(block):
+    """
+    Parse the NDEF Attribute Information Block, block 0 of the NDEF service
+    :rtype AttributeInformation
+    :raises ValueError: on a checksum mismatch
+    """
+    block = bytes(block)
+    if len(block) != BLOCK_SIZE:
+        raise ValueError("Attribute block is {} bytes, expected {}".format(len(block), BLOCK_SIZE))
+    checksum = int.from_bytes(block[14:16], byteorder='big')
+    if sum(block[:14]) != checksum:
+        raise ValueError("Attribute block checksum mismatch: stored {:#06x}, computed {:#06x}".format(checksum,
+                                                                                                   sum(block[:14])))
+    return AttributeInformation(version=block[0], max_read_blocks=block[1], max_write_blocks=block[2],
+                                max_ndef_blocks=int.from_bytes(block[3:5], byteorder='big'),
+                                write_flag=block[9], access=block[10],
+                                length=int.from_bytes(block[11:14], byteorder='big'))
+
+
+def encode_attribute_block(attributes):
+    """:param attributes: AttributeInformation. :return: the 16 bytes of the block, with checksum"""
+    block = bytes([attributes.version, attributes.max_read_blocks, attributes.max_write_blocks]) + \
+        attributes.max_ndef_blocks.to_bytes(2, byteorder='big') + bytes(4) + \
+        bytes([attributes.write_flag, attributes.access]) + attributes.length.to_bytes(3, byteorder='big')
+    return block + sum(block).to_bytes(2, byteorder='big')
+
+
+def block_list(blocks, service_index=0):
+    """
+    Encode a block list: 2-byte elements for block numbers below 256, 3-byte elements otherwise
+    :param service_index: index of the service in the service code list of the command
+    """
+    encoded = bytearray()
+    for block in blocks:
+        if block < 0x100:
+            encoded += bytes([0x80 | service_index, block])
+        else:
+            encoded += bytes([service_index]) + block.to_bytes(2, byteorder='little')
+    return bytes(encoded)
+
+
+def command_length(payload):
+    """Length of the frame of a command with payload: length byte, command code, IDm and payload"""
+    return 2 + IDM_LENGTH + len(payload)
+
+
+def block_payload(service_code, blocks, data=b''):
+    """Payload of a Read or Write Without Encryption command for blocks of a single service"""
+    return b'\x01' + service_code.to_bytes(2, byteorder='little') + bytes([len(blocks)]) + block_list(blocks) + \
+        bytes(data)
+
+
+def write_chunks(blocks, max_blocks=MAX_BLOCKS_PER_FRAME):
+    """
+    Split blocks into runs of at most max_blocks whose Write Without Encryption command fits in a frame:
+    13 blocks with 2-byte block list elements, 12 once the block numbers need 3-byte elements
+    :return: list of lists of block numbers
+    """
+    chunks = []
+    chunk = []
+    for block in blocks:
+        candidate = chunk + [block]
+        if chunk and (len(candidate) > max_blocks or
+                      command_length(block_payload(0, candidate, bytes(len(candidate) * BLOCK_SIZE))) >
+                      MAX_FRAME_LENGTH):
+            chunks += [chunk]
+            candidate = [block]
+        chunk = candidate
+    if chunk:
+        chunks += [chunk]
+    return chunks
+
+
+class FelicaTag(object):
+    """
+    Read and write FeliCa cards on an opened device, eg. the one of an NTagReadWrite:
+        tag = FelicaTag(read_writer.device)
+        tag.poll(felica.SYSTEM_CODE_NDEF)
+        message = tag.read_ndef_message_bytes()
+    """
+
+    def __init__(self, device, fallback_errors=3, logger=logging.getLogger("felica")):
+        """
+        :param device: an opened and initiator-initialised nfc_device pointer
+        :param fallback_errors: after this many failed commands in a row, poll() uses the next slower baud rate
+        :param logger: logging.Logger
+        """
+        self.device = device
+        self.fallback_errors = fallback_errors
+        self.logger = logger
+        self.idm = None
+        self.pmm = None
+        self.system_code = None
+        self.attributes = None  # AttributeInformation as of the last read_attributes()
+        self.baud_rate = None
+        self.max_baud_rate = None  # Lowered after transmission errors, None for no limit
+        self.capabilities = None
+        self._errors = 0
+
+    def poll(self, system_code=SYSTEM_CODE_WILDCARD, baud_rate=None):
+        """
+        Select a card that has the given system, eg. SYSTEM_CODE_NDEF for Type 3 tags
+        :param baud_rate: nfc.NBR_212 or nfc.NBR_424. By default the baud rates the device supports are tried
+            fastest first, so a 424 kbps card is used at 424 kbps, up to max_baud_rate
+        :return: the 8-byte IDm of the card or None when there is no such card in the field
+        """
+        if baud_rate is not None:
+            return self._poll(system_code, baud_rate)
+
+        for rate in reversed(self._baud_rates(self.max_baud_rate)):
+            idm = self._poll(system_code, rate)
+            if idm is not None:
+                return idm
+        return None
+
+    def _baud_rates(self, ceiling=None):
+        """The FeliCa baud rates of the device up to ceiling, slowest first"""
+        if self.capabilities is None:
+            self.capabilities = DeviceCapabilities.query(self.device)
+        rates = self.capabilities.baud_rates(nfc.NMT_FELICA) or [nfc.NBR_212]
+        if ceiling is None:
+            return rates
+        return [rate for rate in rates if BAUD_RATE_ORDER.index(rate) <= BAUD_RATE_ORDER.index(ceiling)] or rates[:1]
+
+    def _transmission_error(self):
+        """Count a failed command and lower max_baud_rate for the next poll() when they keep failing"""
+        self._errors += 1
+        if self._errors < self.fallback_errors:
+            return
+        self._errors = 0
+        slower = [rate for rate in self._baud_rates()
+                  if BAUD_RATE_ORDER.index(rate) < BAUD_RATE_ORDER.index(self.baud_rate)]
+        if slower:
+            self.max_baud_rate = slower[-1]
+            self.logger.warning("Transmission errors at {} kbps, polling at {} kbps from now on".format(
+                BAUD_RATE_KBPS[self.baud_rate], BAUD_RATE_KBPS[self.max_baud_rate]))
+
+    def _poll(self, system_code, baud_rate):
+        modulation = nfc.nfc_modulation()
+        modulation.nmt = nfc.NMT_FELICA
+        modulation.nbr = baud_rate
+
+        # The initiator data is the Polling payload: system code, request code and time slot
+        polling = bytes([FELICA_POLLING]) + system_code.to_bytes(2, byteorder='big') + \
+            bytes([POLLING_REQUEST_SYSTEM_CODE, 0x00])
+        init_data = (ctypes.c_uint8 * len(polling)).from_buffer_copy(polling)
+
+        nt = nfc.nfc_target()
+        res = nfc.nfc_initiator_select_passive_target(self.device, modulation, init_data, len(polling),
+                                                      ctypes.byref(nt))
+        if res <= 0:
+            return None
+
+        if nfc.nfc_device_set_property_bool(self.device, nfc.NP_EASY_FRAMING, True) < 0:
+            raise IOError("Error setting Easy Framing property")
+
+        nfi = nt.nti.nfi
+        self.idm = bytes(nfi.abtId)
+        self.pmm = bytes(nfi.abtPad)
+        self.system_code = int.from_bytes(bytes(nfi.abtSysCode), byteorder='big')
+        self.baud_rate = baud_rate
+        self.attributes = None
+        self._errors = 0
+        return self.idm
+
+    def transceive(self, command, payload, receive_length):
+        """
+        Send a command to the selected card, with the length byte and IDm added
+        :return: the response after its length byte, response code and IDm
+        """
+        if self.idm is None:
+            raise IOError("No FeliCa card selected")
+        length = 2 + len(self.idm) + len(payload)
+        if length > MAX_FRAME_LENGTH:
+            raise ValueError("FeliCa command {:#04x} of {} bytes does not fit in a frame".format(command, length))
+        frame = bytes([length, command]) + self.idm + bytes(payload)
+        tx = (ctypes.c_uint8 * len(frame)).from_buffer_copy(frame)
+        rx = (ctypes.c_uint8 * (10 + receive_length))()
+        res = nfc.nfc_initiator_transceive_bytes(self.device, tx, len(tx), rx, len(rx), 0)
+        if res < 0:
+            self._transmission_error()
+            raise IOError("Error transceiving FeliCa command {:#04x}: {}".format(command, res))
+
+        response = bytes(rx[:res])
+        if res < 10 or response[1] != command + 1 or response[2:10] != self.idm:
+            self._transmission_error()
+            raise IOError("Unexpected response to FeliCa command {:#04x}: {}".format(command, response))
+        self._errors = 0
+        return response[10:]
+
+    @staticmethod
+    def _check_status(response, action):
+        if len(response) < 2:
+            raise IOError("{} failed: response has no status flags".format(action))
+        if response[0] != 0x00:
+            raise IOError("{} failed with status flags {:#04x} {:#04x}".format(action, response[0], response[1]))
+
+    def read_blocks(self, blocks, service_code=SERVICE_NDEF_READ, max_blocks=MAX_BLOCKS_PER_FRAME):
+        """
+        Read Without Encryption, packing up to max_blocks blocks in every command
+        :param blocks: block numbers to read
+        :return: the contents of the blocks, concatenated
+        """
+        blocks = list(blocks)
+        max_blocks = max(1, min(max_blocks, MAX_BLOCKS_PER_FRAME))
+
+        data = bytearray()
+        for index in range(0, len(blocks), max_blocks):
+            chunk = blocks[index:index + max_blocks]
+            payload = block_payload(service_code, chunk)
+            response = self.transceive(FELICA_READ_WITHOUT_ENCRYPTION, payload, 3 + len(chunk) * BLOCK_SIZE)
+            self._check_status(response, "Reading blocks {}-{}".format(chunk[0], chunk[-1]))
+            if len(response) != 3 + len(chunk) * BLOCK_SIZE:
+                raise IOError("Reading blocks {}-{} returned {} bytes".format(chunk[0], chunk[-1], len(response) - 3))
+            data += response[3:]
+        return bytes(data)
+
+    def write_blocks(self, first_block, data, service_code=SERVICE_NDEF_WRITE, max_blocks=MAX_BLOCKS_PER_FRAME):
+        """
+        Write Without Encryption of consecutive blocks, packing up to max_blocks blocks in every command, fewer when
+        the command would not fit in a frame (see write_chunks). data is padded with zeroes to a whole number of blocks
+        """
+        data = bytes(data)
+        if len(data) % BLOCK_SIZE:
+            data += bytes(BLOCK_SIZE - len(data) % BLOCK_SIZE)
+
+        blocks = range(first_block, first_block + len(data) // BLOCK_SIZE)
+        index = 0
+        for chunk in write_chunks(blocks, max(1, max_blocks)):
+            chunk_data = data[index * BLOCK_SIZE:(index + len(chunk)) * BLOCK_SIZE]
+            index += len(chunk)
+            payload = block_payload(service_code, chunk, chunk_data)
+            response = self.transceive(FELICA_WRITE_WITHOUT_ENCRYPTION, payload, 2)
+            self._check_status(response, "Writing blocks {}-{}".format(chunk[0], chunk[-1]))
+
+    def read_attributes(self):
+        """:rtype AttributeInformation"""
+        self.attributes = parse_attribute_block(self.read_blocks([0], max_blocks=1))
+        return self.attributes
+
+    def read_ndef_message_bytes(self):
+        """Read the NDEF message, as many blocks per command as the card allows"""
+        attributes = self.read_attributes()
+        if attributes.write_flag == WRITE_IN_PROGRESS:
+            raise ValueError("NDEF message is incomplete: a write was interrupted")
+        if not attributes.length:
+            return b''
+
+        block_count = (attributes.length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        data = self.read_blocks(range(1, 1 + block_count), max_blocks=attributes.max_read_blocks)
+        return data[:attributes.length]
+
+    def write_ndef_message_bytes(self, message_bytes):
+        """
+        Write an NDEF message. The attribute block is marked as 'write in progress' during the write,
+        so readers do not take a half-written message as valid
+        """
+        attributes = self.read_attributes()
+        if attributes.access != ACCESS_READ_WRITE:
+            raise ValueError("Tag is read-only")
+        block_count = (len(message_bytes) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        if block_count > attributes.max_ndef_blocks:
+            raise ValueError("NDEF area of {} blocks too small for a message of {} blocks".format(
+                attributes.max_ndef_blocks, block_count))
+
+        self.write_blocks(0, encode_attribute_block(attributes._replace(write_flag=WRITE_IN_PROGRESS)), max_blocks=1)
+        self.write_blocks(1, message_bytes, max_blocks=attributes.max_write_blocks)
+
+        self.attributes = attributes._replace(write_flag=0x00, length=len(message_bytes))
+        self.write_blocks(0, encode_attribute_block(self.attributes), max_blocks=1)
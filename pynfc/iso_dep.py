@@ -0,0 +1,377 @@
+"""ISO-DEP (ISO14443-4) transport for ISO 7816-4 APDUs
+
+libnfc activates the target (RATS) when NP_AUTO_ISO14443_4 is set and stores the ATS in nfc_iso14443a_info.abtAts.
+The block protocol itself is run on the host with easy framing switched off, so that:
+- the frame size (FSC) and frame waiting time (FWT) of the card are taken from the ATS
+- long commands are sent as chained I-blocks of at most FSC bytes and chained responses are collected with R(ACK)
+- waiting time extension requests (S(WTX)) of the card are answered, stretching the timeout for that one exchange
+- transmission errors are recovered with R(NAK) and retransmission
+
+The session always runs at 106 kbps. libnfc's PN53x driver selects every ISO14443A target at 106 kbps, whatever baud
+rate is asked for, and has no call to switch the reader to another rate after a PPS sent by the host. So no PPS is
+sent, whatever TA(1) of the ATS allows.
+
+See ISO/IEC 14443-4 and ISO/IEC 7816-4
+"""
+
+import collections
+import ctypes
+import logging
+
+from . import pynfc as nfc
+
+# Frame sizes for FSCI 0-12 of the ATS
+FSC_TABLE = (16, 24, 32, 40, 48, 64, 96, 128, 256, 512, 1024, 2048, 4096)
+
+# One elementary time unit of the frame waiting time is 256 * 16 / fc
+FWT_UNIT = 256 * 16 / 13.56e6
+DEFAULT_FWI = 4
+
+# Protocol control bytes
+PCB_I_BLOCK = 0x02
+PCB_R_ACK = 0xA2
+PCB_R_NAK = 0xB2
+PCB_S_DESELECT = 0xC2
+PCB_S_WTX = 0xF2
+PCB_CHAINING = 0x10
+PCB_BLOCK_NUMBER = 0x01
+
+SW_OK = 0x9000
+MAX_SHORT_LE = 256
+MAX_EXTENDED_LE = 65536
+
+Ats = collections.namedtuple('Ats', 'fsc fwi fwt sfgi ta cid_supported nad_supported historical_bytes')
+
+
+def parse_ats(ats):
+    """
+    Parse the ATS as stored by libnfc, ie. starting at the format byte T0 (the length byte TL is not included)
+    :rtype Ats
+    """
+    ats = bytes(ats)
+    if not ats:
+        raise ValueError("Empty ATS")
+    t0 = ats[0]
+    interface_bytes = bin(t0 & 0x70).count('1')
+    if len(ats) < 1 + interface_bytes:
+        raise ValueError("ATS {} is shorter than its format byte announces".format(ats.hex()))
+    fsc = FSC_TABLE[min(t0 & 0x0F, len(FSC_TABLE) - 1)]
+    offset = 1
+    ta = None
+    fwi, sfgi = DEFAULT_FWI, 0
+    cid_supported, nad_supported = True, False
+
+    if t0 & 0x10:  # TA(1): supported bit rates
+        ta = ats[offset]
+        offset += 1
+    if t0 & 0x20:  # TB(1): FWI and SFGI
+        fwi = ats[offset] >> 4
+        sfgi = ats[offset] & 0x0F
+        offset += 1
+        if fwi == 15:  # RFU, treated as the default
+            fwi = DEFAULT_FWI
+    if t0 & 0x40:  # TC(1): CID and NAD support
+        cid_supported = bool(ats[offset] & 0x02)
+        nad_supported = bool(ats[offset] & 0x01)
+        offset += 1
+
+    return Ats(fsc=fsc, fwi=fwi, fwt=FWT_UNIT * (1 << fwi), sfgi=sfgi, ta=ta, cid_supported=cid_supported,
+               nad_supported=nad_supported, historical_bytes=ats[offset:])
+
+
+def command_apdu(cla, ins, p1, p2, data=b'', le=None, extended=None):
+    """
+    Encode a command APDU, as short APDU when possible
+    :param le: expected response length, None when no response data is expected. 256 (short) or 65536 (extended)
+        are encoded as 0
+    :param extended: force (True) or forbid (False) the extended length encoding. By default it is used only when
+        data or le do not fit a short APDU
+    """
+    data = bytes(data)
+    if extended is None:
+        extended = len(data) > 255 or (le is not None and le > MAX_SHORT_LE)
+    if not extended and (len(data) > 255 or (le is not None and le > MAX_SHORT_LE)):
+        raise ValueError("Data of {} bytes or Le {} needs an extended length APDU".format(len(data), le))
+    if len(data) > 65535 or (le is not None and not 0 < le <= MAX_EXTENDED_LE):
+        raise ValueError("Data of {} bytes or Le {} does not fit an APDU".format(len(data), le))
+
+    apdu = bytes([cla, ins, p1, p2])
+    if extended:
+        if data:
+            apdu += b'\x00' + len(data).to_bytes(2, byteorder='big') + data
+        if le is not None:
+            apdu += (b'' if data else b'\x00') + (le % MAX_EXTENDED_LE).to_bytes(2, byteorder='big')
+    else:
+        if data:
+            apdu += bytes([len(data)]) + data
+        if le is not None:
+            apdu += bytes([le % MAX_SHORT_LE])
+    return apdu
+
+
+class ResponseApdu(collections.namedtuple('ResponseApdu', 'data sw1 sw2')):
+    @property
+    def sw(self):
+        return (self.sw1 << 8) | self.sw2
+
+    @property
+    def ok(self):
+        return self.sw == SW_OK
+
+
+class ApduError(IOError):
+    """An APDU that was answered with a status word other than 9000"""
+
+    def __init__(self, message, response):
+        super(ApduError, self).__init__(message)
+        self.response = response
+
+
+class IsoDepTransport(object):
+    """
+    Exchange APDUs with an ISO14443-4 card on an opened device, eg. the one of an NTagReadWrite:
+        transport = IsoDepTransport(read_writer.device)
+        transport.activate()
+        response = transport.transmit(iso_dep.command_apdu(0x00, 0xA4, 0x04, 0x00, aid, le=256))
+    """
+
+    def __init__(self, device, extended_length=False, max_frame=256, retries=2, timeouts=None,
+                 logger=logging.getLogger("iso_dep")):
+        """
+        :param device: an opened and initiator-initialised nfc_device pointer
+        :param extended_length: whether the card accepts extended length APDUs, which allows reading up to 64KiB with
+            one command
+        :param max_frame: largest frame the reader handles, frames are limited to the smaller of this and FSC
+        :param retries: how often a block is retransmitted (or requested again with R(NAK)) after a transmission error
+        :param timeouts: the pynfc.timeouts.TimeoutManager of the device, when other code shares the device with one.
+            The block timeout itself always follows the FWT of the card
+        :param logger: logging.Logger
+        """
+        self.device = device
+        self.extended_length = extended_length
+        self.max_frame = max_frame
+        self.retries = retries
+        self.timeouts = timeouts
+        self.logger = logger
+
+        self.uid = None
+        self.ats = None
+        self.block_number = 0
+        self.baud_rate = None
+        self._timeout = None
+
+        # Allocated once and reused by every exchange
+        self._rx = (ctypes.c_uint8 * (max_frame + 8))()
+
+    def activate(self, uid=None):
+        """
+        Select an ISO14443-4 capable target and set up the session from its ATS
+        :param uid: if given, only the target with this UID is selected
+        :return: the Ats of the card or None when there is no (matching) target in the field
+        """
+        if nfc.nfc_device_set_property_bool(self.device, nfc.NP_AUTO_ISO14443_4, True) < 0:
+            raise IOError("Error enabling ISO14443-4 activation")
+
+        modulation = nfc.nfc_modulation()
+        modulation.nmt = nfc.NMT_ISO14443A
+        modulation.nbr = nfc.NBR_106
+
+        nt = nfc.nfc_target()
+        if uid:
+            init_data = (ctypes.c_uint8 * len(uid))(*uid)
+            res = nfc.nfc_initiator_select_passive_target(self.device, modulation, init_data, len(uid), ctypes.byref(nt))
+        else:
+            res = nfc.nfc_initiator_select_passive_target(self.device, modulation, None, 0, ctypes.byref(nt))
+        if res <= 0:
+            return None
+
+        nai = nt.nti.nai
+        if not nai.szAtsLen:
+            raise IOError("Target does not support ISO14443-4: no ATS received")
+
+        self.uid = bytes(nai.abtUid[:nai.szUidLen])
+        self.ats = parse_ats(bytes(nai.abtAts[:nai.szAtsLen]))
+        self.block_number = 0
+        self.baud_rate = modulation.nbr
+
+        for prop, value in ((nfc.NP_EASY_FRAMING, False), (nfc.NP_HANDLE_CRC, True),
+                            (nfc.NP_HANDLE_PARITY, True), (nfc.NP_ACTIVATE_CRYPTO1, False)):
+            if nfc.nfc_device_set_property_bool(self.device, prop, value) < 0:
+                raise IOError("Error setting device property {} to {}".format(prop, value))
+        self._set_timeout(self.ats.fwt)
+
+        self.logger.info("Activated {} at 106 kbps: FSC {} bytes, FWT {:.1f} ms".format(
+            self.uid.hex(), self.ats.fsc, self.ats.fwt * 1000))
+        return self.ats
+
+    @property
+    def max_information_size(self):
+        """Most INF bytes per I-block: the frame size minus PCB and CRC"""
+        return min(self.ats.fsc, self.max_frame) - 3
+
+    def _set_timeout(self, seconds):
+        # Whole milliseconds, with some slack for the reader's own processing
+        timeout = int(seconds * 1000) + 10
+        if self.timeouts is not None:
+            self.timeouts.set_timeout(timeout)
+        elif timeout != self._timeout:
+            if nfc.nfc_device_set_property_int(self.device, nfc.NP_TIMEOUT_COMMAND, timeout) < 0:
+                raise IOError("Error setting command timeout")
+            self._timeout = timeout
+
+    def _transceive_frame(self, frame):
+        tx = (ctypes.c_uint8 * len(frame)).from_buffer_copy(frame)
+        res = nfc.nfc_initiator_transceive_bytes(self.device, tx, len(tx), self._rx, len(self._rx), 0)
+        if res < 0:
+            raise IOError("Error transceiving ISO-DEP block: {}".format(res))
+        if res == 0:
+            raise IOError("Empty ISO-DEP block received")
+        return bytes(self._rx[:res])
+
+    def _exchange_block(self, frame):
+        """
+        Send a block and return the answer, handling S(WTX) requests and retransmitting on errors
+        :return: the answer block, an I-block or R-block
+        """
+        is_i_block = frame[0] & 0xE2 == PCB_I_BLOCK
+        attempt = 0
+        sent = frame
+        while True:
+            try:
+                block = self._transceive_frame(sent)
+            except IOError:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                # After an I-block, R(NAK) makes the card repeat its last block or acknowledge an I-block it missed.
+                # An R-block is simply sent again
+                sent = bytes([PCB_R_NAK | self.block_number]) if is_i_block else frame
+                self.logger.debug("ISO-DEP transmission error, sending {}".format(sent.hex()))
+                continue
+
+            pcb = block[0]
+            if pcb & 0xF7 == PCB_S_WTX:
+                wtxm = block[1] & 0x3F
+                self._set_timeout(self.ats.fwt * max(wtxm, 1))
+                sent = bytes([PCB_S_WTX, wtxm])
+                continue
+
+            self._set_timeout(self.ats.fwt)
+            if is_i_block and pcb & 0xE6 == 0xA2 and pcb & PCB_BLOCK_NUMBER != self.block_number:
+                # R(ACK) with the previous block number: the card did not receive our I-block
+                attempt += 1
+                if attempt > self.retries:
+                    raise IOError("ISO-DEP block not received by the card")
+                sent = frame
+                continue
+            return block
+
+    def exchange(self, data):
+        """
+        Send data as one or more chained I-blocks and return the complete, unchained response
+        :type data bytes
+        :rtype bytes
+        """
+        if self.ats is None:
+            raise IOError("No ISO14443-4 target activated")
+        size = self.max_information_size
+        data = bytes(data)
+
+        chunks = [data[offset:offset + size] for offset in range(0, len(data), size)] or [b'']
+        for index, chunk in enumerate(chunks):
+            chaining = index < len(chunks) - 1
+            pcb = PCB_I_BLOCK | self.block_number | (PCB_CHAINING if chaining else 0)
+            block = self._exchange_block(bytes([pcb]) + chunk)
+            if chaining:
+                if block[0] & 0xF6 != PCB_R_ACK or block[0] & PCB_BLOCK_NUMBER != self.block_number:
+                    raise IOError("Card did not acknowledge chained block: {}".format(block.hex()))
+                self.block_number ^= 1
+
+        response = bytearray()
+        while True:
+            if block[0] & 0xE2 != PCB_I_BLOCK:
+                raise IOError("Expected an I-block, received {}".format(block.hex()))
+            self.block_number ^= 1
+            response += block[1:]
+            if not block[0] & PCB_CHAINING:
+                return bytes(response)
+            block = self._exchange_block(bytes([PCB_R_ACK | self.block_number]))
+
+    def transmit(self, apdu, check=False):
+        """
+        Send a command APDU and return the response. 61xx is followed by GET RESPONSE and 6Cxx by a retry with the
+        Le the card asked for
+        :param check: raise an ApduError for a status word other than 9000
+        :rtype ResponseApdu
+        """
+        apdu = bytes(apdu)
+        response = self.exchange(apdu)
+        if len(response) < 2:
+            raise IOError("Response APDU of {} bytes has no status word".format(len(response)))
+
+        data = bytearray(response[:-2])
+        sw1, sw2 = response[-2], response[-1]
+        while True:
+            if sw1 == 0x6C:
+                # Wrong Le, the card tells the right one
+                response = self.exchange(apdu[:4] + (apdu[4:-1] if len(apdu) > 4 else b'') + bytes([sw2]))
+            elif sw1 == 0x61:
+                response = self.exchange(bytes([apdu[0], 0xC0, 0x00, 0x00, sw2]))
+            else:
+                break
+            data += response[:-2]
+            sw1, sw2 = response[-2], response[-1]
+
+        result = ResponseApdu(bytes(data), sw1, sw2)
+        if check and not result.ok:
+            raise ApduError("APDU {} failed with status {:04X}".format(apdu[:4].hex(), result.sw), result)
+        return result
+
+    def transmit_many(self, apdus, check=False, stop_on_error=True):
+        """
+        Send a batch of APDUs in one session, without reconfiguring the device in between
+        :param stop_on_error: stop at the first response with a status word other than 9000
+        :return: list of ResponseApdu, one per APDU that was sent
+        """
+        responses = []
+        for apdu in apdus:
+            response = self.transmit(apdu, check)
+            responses += [response]
+            if stop_on_error and not response.ok:
+                break
+        return responses
+
+    @property
+    def max_le(self):
+        return MAX_EXTENDED_LE if self.extended_length else MAX_SHORT_LE
+
+    def select_file(self, identifier, by_name=False):
+        """SELECT by file identifier (2 bytes) or, with by_name, by DF name/AID"""
+        return self.transmit(command_apdu(0x00, 0xA4, 0x04 if by_name else 0x00, 0x0C, identifier), check=True)
+
+    def read_binary(self, length, offset=0):
+        """
+        Read length bytes of the selected transparent EF with READ BINARY, asking for as many bytes per command as
+        the card supports (up to 65536 with extended length APDUs, 256 otherwise)
+        """
+        data = bytearray()
+        while len(data) < length:
+            position = offset + len(data)
+            if position > 0x7FFF:
+                raise ValueError("Offset {} does not fit in READ BINARY".format(position))
+            le = min(length - len(data), self.max_le)
+            response = self.transmit(command_apdu(0x00, 0xB0, position >> 8, position & 0xFF, le=le), check=True)
+            if not response.data:
+                break
+            data += response.data
+        return bytes(data[:length])
+
+    def deselect(self):
+        """Send S(DESELECT) and release the target"""
+        if self.ats is not None:
+            try:
+                self._transceive_frame(bytes([PCB_S_DESELECT]))
+            except IOError:
+                self.logger.debug("No answer to S(DESELECT)")
+        self.ats = None
+        nfc.nfc_initiator_deselect_target(self.device)
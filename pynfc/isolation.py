@@ -0,0 +1,241 @@
+"""Device I/O in a worker process, so a wedged reader cannot hang the caller
+
+A reader that stops responding can block nfc_initiator_transceive_bytes or nfc_initiator_poll_target forever, and a
+thread stuck in a ctypes call cannot be interrupted. An IsolatedReader drives the device from a child process that
+owns an NTagReadWrite, and gives every command a deadline. When a command misses its deadline the worker is killed,
+a new one reopens the device and the commands that were waiting continue on it; the command that hung fails with
+an IOError, it is not repeated because it may not be safe to repeat (eg. a write).
+
+    reader = IsolatedReader(deadlines={'setup_target': 5.0})
+    uid = reader.setup_target()        # Any NTagReadWrite method, executed in the worker
+    data = reader.read_user_memory(TagType.NTAG_213)
+    reader.report()                    # Restarts and recovery times
+    uid = reader.call('uid')           # Attributes of the session are read with call()
+
+A replacement worker reopens the device the first worker opened, also when no connstring was given, so a host with
+several readers does not switch to another reader after a restart.
+
+Commands and results go over a multiprocessing Pipe as (request id, method name, args, kwargs) and
+(request id, ok, result or (exception name, message)) tuples.
+"""
+
+import collections
+import logging
+import multiprocessing
+import threading
+import time
+
+DEFAULT_DEADLINES = {
+    'setup_target': 5.0,  # Polls for up to 3 seconds
+    'read_user_memory': 5.0,
+    'read_user_memory_resumable': 5.0,
+    'write_user_memory': 10.0,
+    'write_ndef_message_bytes': 10.0,
+}
+DEFAULT_DEADLINE = 2.0
+OPEN_DEADLINE = 30.0
+
+_READY = 0  # Request id of the message a worker sends once its device is open
+
+# Data attributes of NTagReadWrite. They are not proxied as methods, read them with call()
+SESSION_ATTRIBUTES = frozenset(['uid', 'connstring', 'fixed_connstring', 'device', 'context', 'modulations',
+                                'tag_type', 'timeouts', 'adaptive_timeouts', 'air_timing', 'event_ring', 'reader_id',
+                                'logger'])
+
+
+def _open_session(connstring, session_kwargs):
+    from .ntag_read import NTagReadWrite
+    return NTagReadWrite(connstring=connstring, **session_kwargs)
+
+
+def _worker_main(conn, factory, connstring, session_kwargs):
+    """Runs in the worker process: open the session, then execute commands until told to stop"""
+    try:
+        session = factory(connstring, session_kwargs)
+    except Exception as error:
+        conn.send((_READY, False, "{}: {}".format(type(error).__name__, error)))
+        return
+    conn.send((_READY, True, session.connstring))
+
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break  # The parent went away
+            if request is None:
+                break
+            request_id, method, args, kwargs = request
+            try:
+                if method.startswith('_'):
+                    raise ValueError("{} is not a public method".format(method))
+                attribute = getattr(session, method)
+                result = attribute(*args, **kwargs) if callable(attribute) else attribute
+                conn.send((request_id, True, result))
+            except Exception as error:
+                conn.send((request_id, False, (type(error).__name__, str(error))))
+    finally:
+        try:
+            session.close()
+        except Exception:
+            pass
+
+
+class IsolatedReader(object):
+    """
+    An NTagReadWrite in a worker process, with per-command deadlines. Calls from many threads are executed one at a
+    time, in the order they get the lock
+    """
+
+    def __init__(self, connstring=None, deadlines=None, default_deadline=DEFAULT_DEADLINE,
+                 open_deadline=OPEN_DEADLINE, factory=_open_session, logger=logging.getLogger("isolated_reader"),
+                 **session_kwargs):
+        """
+        :param connstring: device for the worker to open, by default the first one it finds
+        :param deadlines: dict of method name -> seconds, added to DEFAULT_DEADLINES
+        :param default_deadline: seconds for the methods without a deadline of their own
+        :param open_deadline: seconds a (re)started worker gets to open the device
+        :param factory: module-level callable (connstring, session_kwargs) that opens the session in the worker
+        :param session_kwargs: passed to NTagReadWrite in the worker, eg. adaptive_timeouts=True
+        """
+        self.connstring = connstring
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.default_deadline = default_deadline
+        self.open_deadline = open_deadline
+        self.factory = factory
+        self.session_kwargs = session_kwargs
+        self.logger = logger
+
+        self.device_connstring = None  # As reported by the worker
+        self.calls = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.restarts = 0
+        self.recovery_times = collections.deque(maxlen=256)
+
+        self._mp = multiprocessing.get_context('spawn')  # Never fork a process with reader threads
+        self._lock = threading.Lock()
+        self._request_ids = 0
+        self._process = None
+        self._conn = None
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in SESSION_ATTRIBUTES:
+            raise AttributeError("{} is an attribute of the session, read it with call('{}')".format(name, name))
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def _start(self):
+        # After the first start, stay on the device that worker opened
+        connstring = self.connstring if self.device_connstring is None else self.device_connstring
+        parent_conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(target=_worker_main, name="pynfc-isolated-reader",
+                                   args=(child_conn, self.factory, connstring, self.session_kwargs), daemon=True)
+        process.start()
+        child_conn.close()
+        self._process, self._conn = process, parent_conn
+
+        if not parent_conn.poll(self.open_deadline):
+            self._kill()
+            raise IOError("Worker did not open the device within {} s".format(self.open_deadline))
+        try:
+            _, ok, result = parent_conn.recv()
+        except EOFError:
+            self._kill()
+            raise IOError("Worker exited while opening the device")
+        if not ok:
+            self._kill()
+            raise IOError("Worker could not open the device: {}".format(result))
+        self.device_connstring = result
+
+    def _kill(self):
+        process, self._process = self._process, None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if process is None:
+            return
+        process.terminate()
+        process.join(0.5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _restart(self, reason):
+        """Replace the worker. The time from now until the new worker has the device open is the recovery time"""
+        start = time.monotonic()
+        self.logger.warning("Restarting the reader worker: {}".format(reason))
+        self._kill()
+        self.restarts += 1
+        try:
+            self._start()
+        finally:
+            self.recovery_times.append(time.monotonic() - start)
+
+    def deadline(self, method):
+        return self.deadlines.get(method, self.default_deadline)
+
+    def call(self, method, *args, **kwargs):
+        """
+        Execute a method of the NTagReadWrite in the worker, or return the value of one of its attributes
+        :raises IOError: when the method raised one, or did not complete in time and the worker was restarted
+        """
+        deadline = self.deadline(method)
+        with self._lock:
+            if self._process is None:
+                self._restart("no worker")
+            self.calls += 1
+            self._request_ids += 1
+            request_id = self._request_ids
+            try:
+                self._conn.send((request_id, method, args, kwargs))
+                ready = self._conn.poll(deadline)
+                response = self._conn.recv() if ready else None
+            except (EOFError, OSError) as error:
+                self.crashes += 1
+                self._restart("worker died: {}".format(error))
+                raise IOError("Reader worker died during {}".format(method))
+
+            if response is None:
+                self.timeouts += 1
+                self._restart("{} missed its deadline of {} s".format(method, deadline))
+                raise IOError("{} did not complete within {} s, the reader worker was restarted".format(method,
+                                                                                                       deadline))
+
+        response_id, ok, result = response
+        if response_id != request_id:
+            raise IOError("Response {} to request {}".format(response_id, request_id))
+        if not ok:
+            name, message = result
+            # Argument errors stay ValueErrors, everything else that went wrong with the device is an IOError
+            raise (ValueError if name == 'ValueError' else IOError)(message)
+        return result
+
+    def report(self):
+        """:return: dict with the number of calls, timeouts, crashes, restarts and the recovery times in ms"""
+        recoveries = [recovery * 1000 for recovery in self.recovery_times]
+        return {'calls': self.calls, 'timeouts': self.timeouts, 'crashes': self.crashes, 'restarts': self.restarts,
+                'recovery_mean_ms': sum(recoveries) / len(recoveries) if recoveries else None,
+                'recovery_max_ms': max(recoveries) if recoveries else None,
+                'connstring': self.device_connstring}
+
+    def close(self):
+        """Let the worker close the device and exit, or kill it when it does not"""
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self._process.join(self.default_deadline)
+            self._kill()
@@ -0,0 +1,232 @@
+"""Memory layout of Mifare Classic cards, the Mifare Application Directory (MAD) and planning of card writes
+
+See NXP application note AN10787 "MIFARE Application Directory (MAD)"
+"""
+
+import collections
+
+BLOCK_SIZE = 16
+
+# Well known keys
+DEFAULT_KEY = b'\xff\xff\xff\xff\xff\xff'
+MAD_KEY_A = b'\xa0\xa1\xa2\xa3\xa4\xa5'
+NDEF_KEY_A = b'\xd3\xf7\xd3\xf7\xd3\xf7'
+
+# Application identifiers with a special meaning in the MAD
+AID_FREE = 0x0000
+AID_DEFECT = 0x0001
+AID_RESERVED = 0x0002
+AID_ADDITIONAL_DIRECTORY_INFO = 0x0003
+AID_CARD_HOLDER_INFO = 0x0004
+AID_NOT_APPLICABLE = 0x0005
+AID_NDEF = 0xE103  # Function cluster 0xE1 (NFC Forum), application code 0x03
+
+MAD2_SECTOR = 16
+
+
+def sector_of_block(block):
+    """The sector a block belongs to. Sectors 32 and up on a 4K card have 16 blocks"""
+    if block < 128:
+        return block // 4
+    return 32 + (block - 128) // 16
+
+
+def first_block(sector):
+    if sector < 32:
+        return sector * 4
+    return 128 + (sector - 32) * 16
+
+
+def blocks_in_sector(sector):
+    return 4 if sector < 32 else 16
+
+
+def trailer_block(sector):
+    """The sector trailer, holding the keys and access bits, is the last block of every sector"""
+    return first_block(sector) + blocks_in_sector(sector) - 1
+
+
+def is_trailer_block(block):
+    return block == trailer_block(sector_of_block(block))
+
+
+def data_blocks(sector):
+    """The blocks of a sector other than its trailer. Block 0 (manufacturer block) is included for sector 0"""
+    return list(range(first_block(sector), trailer_block(sector)))
+
+
+def mad_crc(data):
+    """CRC-8 of the MAD: polynomial x^8 + x^4 + x^3 + x^2 + 1, preset 0xC7, over the info byte and the AIDs"""
+    crc = 0xC7
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1D) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+class MadError(ValueError):
+    pass
+
+
+class Mad(object):
+    """
+    Parsed Mifare Application Directory: which application (AID) lives in which sector
+    """
+
+    def __init__(self, version, aids, card_publisher_sector=None):
+        """
+        :param version: 1 or 2
+        :param aids: dict of sector -> AID
+        :param card_publisher_sector: sector pointed to by the info byte, if any
+        """
+        self.version = version
+        self.aids = aids
+        self.card_publisher_sector = card_publisher_sector
+
+    def __repr__(self):
+        return "Mad(version={}, aids={})".format(self.version, {sector: "{:04X}".format(aid)
+                                                                 for sector, aid in sorted(self.aids.items())})
+
+    def sectors_for(self, aid):
+        """:return: sorted list of the sectors assigned to the application"""
+        return sorted(sector for sector, sector_aid in self.aids.items() if sector_aid == aid)
+
+    @property
+    def applications(self):
+        """AIDs of the applications on the card, without the reserved values"""
+        return sorted(set(aid for aid in self.aids.values() if aid > AID_NOT_APPLICABLE))
+
+    @staticmethod
+    def version_from_trailer(trailer):
+        """
+        The General Purpose Byte (byte 9 of the sector 0 trailer) tells whether there is a MAD and which version
+        :return: 0 when there is no MAD, otherwise 1 or 2
+        """
+        gpb = trailer[9]
+        if not gpb & 0x80:  # DA: MAD available
+            return 0
+        return gpb & 0x03
+
+    @staticmethod
+    def _parse_directory(data, first_sector, skip_sectors=()):
+        if mad_crc(data[1:]) != data[0]:
+            raise MadError("MAD CRC mismatch: stored {:#04x}, computed {:#04x}".format(data[0], mad_crc(data[1:])))
+
+        info = data[1] & 0x3F
+        aids = {}
+        sector = first_sector
+        for offset in range(2, len(data), 2):
+            while sector in skip_sectors:
+                sector += 1
+            aids[sector] = data[offset] | (data[offset + 1] << 8)
+            sector += 1
+        return info, aids
+
+    @classmethod
+    def parse(cls, mad1, mad2=None):
+        """
+        :param mad1: blocks 1 and 2 of sector 0, 32 bytes
+        :param mad2: blocks 0, 1 and 2 of sector 16 on a 4K card with MAD2, 48 bytes
+        :rtype Mad
+        """
+        if len(mad1) != 2 * BLOCK_SIZE:
+            raise MadError("MAD1 is {} bytes, expected {}".format(len(mad1), 2 * BLOCK_SIZE))
+        info, aids = cls._parse_directory(mad1, 1)
+        version = 1
+
+        if mad2 is not None:
+            if len(mad2) != 3 * BLOCK_SIZE:
+                raise MadError("MAD2 is {} bytes, expected {}".format(len(mad2), 3 * BLOCK_SIZE))
+            _, aids2 = cls._parse_directory(mad2, 17, skip_sectors=(MAD2_SECTOR,))
+            aids.update(aids2)
+            version = 2
+
+        return cls(version, aids, info or None)
+
+
+def encode_value_block(value, address=0):
+    """
+    Format a value block: the signed 32-bit value stored 3 times (once inverted) and the address byte 4 times
+    (twice inverted), so the card can check its integrity for INCREMENT, DECREMENT and RESTORE.
+    :param value: signed 32-bit value
+    :param address: byte that can be used to store the block address of a backup block
+    :rtype bytes
+    """
+    if not -0x80000000 <= value <= 0x7FFFFFFF:
+        raise ValueError("Value {} does not fit in a signed 32-bit value block".format(value))
+    value_bytes = (value & 0xFFFFFFFF).to_bytes(4, byteorder='little')
+    inverted = bytes(byte ^ 0xFF for byte in value_bytes)
+    return value_bytes + inverted + value_bytes + bytes([address, address ^ 0xFF, address, address ^ 0xFF])
+
+
+def decode_value_block(data):
+    """
+    :return: tuple (value, address)
+    :raises ValueError: when data is not a valid value block
+    """
+    data = bytes(data)
+    if len(data) != BLOCK_SIZE:
+        raise ValueError("Value block is {} bytes, expected {}".format(len(data), BLOCK_SIZE))
+    value_bytes = data[0:4]
+    if data[8:12] != value_bytes or data[4:8] != bytes(byte ^ 0xFF for byte in value_bytes):
+        raise ValueError("Not a valid value block: value fields do not match")
+    address = data[12]
+    if data[13] != address ^ 0xFF or data[14] != address or data[15] != address ^ 0xFF:
+        raise ValueError("Not a valid value block: address fields do not match")
+    return int.from_bytes(value_bytes, byteorder='little', signed=True), address
+
+
+def split_blocks(image):
+    """
+    Normalize a card image into a list of blocks.
+    :param image: bytes of a complete dump, or a list with one item per block: bytes, a str of chr()'s as returned by
+        NFCReader.auth_and_read, or ''/None for a block whose content is unknown
+    :return: list of 16-byte bytes objects, None for unknown blocks
+    """
+    if isinstance(image, (bytes, bytearray)):
+        if len(image) % BLOCK_SIZE:
+            raise ValueError("Card image of {} bytes is not a whole number of blocks".format(len(image)))
+        return [bytes(image[offset:offset + BLOCK_SIZE]) for offset in range(0, len(image), BLOCK_SIZE)]
+
+    blocks = []
+    for block in image:
+        if not block:
+            blocks += [None]
+        elif isinstance(block, str):
+            blocks += [block.encode('latin-1')]
+        else:
+            blocks += [bytes(block)]
+    return blocks
+
+
+def plan_writes(previous, desired, allow_trailers=False):
+    """
+    Work out which blocks must be written to turn a card with content previous into desired, grouped per sector,
+    so that every sector needs to be authenticated only once.
+
+    Block 0 (manufacturer data) is never written. Sector trailers hold the keys and access bits, so a mistake there
+    can lock a sector forever: a changed trailer raises a ValueError unless allow_trailers is set.
+    Trailers are always written as the last block of their sector.
+
+    :param previous: the last known content of the card, see split_blocks. None when unknown, so all blocks are written
+    :param desired: the wanted content of the card, see split_blocks. Blocks that are None are left alone
+    :return: OrderedDict of sector -> list of (block, 16 bytes) tuples, in ascending order
+    """
+    desired = split_blocks(desired)
+    previous = split_blocks(previous) if previous is not None else []
+
+    plan = collections.OrderedDict()
+    for block, content in enumerate(desired):
+        if content is None or block == 0:
+            continue
+        if len(content) != BLOCK_SIZE:
+            raise ValueError("Block {} is {} bytes, expected {}".format(block, len(content), BLOCK_SIZE))
+        if block < len(previous) and previous[block] == content:
+            continue
+        if is_trailer_block(block) and not allow_trailers:
+            raise ValueError("Refusing to write sector trailer block {}, pass allow_trailers=True to allow it".format(block))
+
+        plan.setdefault(sector_of_block(block), []).append((block, content))
+
+    return plan
@@ -24,6 +24,10 @@ import ctypes
 import string
 import pynfc as nfc
 import binascii
+from pynfc import mifare_classic, tlv
+from pynfc.air_timing import SINGLE_FRAME_MIFARE_COMMANDS, AirTiming
+from pynfc.context import acquire_context, default_registry, release_context
+from pynfc.timeouts import TimeoutManager, mifare_command_key
 
 
 def hex_dump(string):
@@ -38,17 +42,35 @@ class NFCReader(object):
     MC_AUTH_B = 0x61
     MC_READ = 0x30
     MC_WRITE = 0xA0
+    MC_DECREMENT = 0xC0
+    MC_INCREMENT = 0xC1
+    MC_RESTORE = 0xC2
+    MC_TRANSFER = 0xB0
     card_timeout = 10
 
-    def __init__(self, logger):
+    def __init__(self, logger, adaptive_timeouts=False, event_ring=None, reader_id=0):
+        """
+        :param logger: callable taking a message
+        :param adaptive_timeouts: use per-command timeouts learned from the latency of this reader, see pynfc.timeouts
+        :param event_ring: pynfc.event_ring.EventRing, or pynfc.event_export.EventExporter, to publish every newly
+            read card to
+        :param reader_id: identifies this reader in the published events
+        """
+        self.event_ring = event_ring
+        self.reader_id = reader_id
         self.__context = None
         self.__device = None
         self.log = logger
+        self.adaptive_timeouts = adaptive_timeouts
+        self.timeouts = None
+        self.air_timing = None
 
         self._card_present = False
         self._card_last_seen = None
         self._card_uid = None
         self._clean_card()
+        self._mad_cache = {}
+        self._card_dumps = {}
 
         mods = [(nfc.NMT_ISO14443A, nfc.NBR_106)]
 
@@ -63,25 +85,29 @@ class NFCReader(object):
         # break 119
         # break 240
         # break 208
-        self.__context = ctypes.pointer(nfc.nfc_context())
-        nfc.nfc_init(ctypes.byref(self.__context))
+        # The context and the connstring of the device are kept between runs, so restarting after an error
+        # does not initialise libnfc and probe for devices again
+        self.__context = acquire_context()
         loop = True
         try:
             self._clean_card()
-            conn_strings = (nfc.nfc_connstring * 10)()
-            devices_found = nfc.nfc_list_devices(
-                self.__context, conn_strings, 10)
-            if devices_found >= 1:
-                self.__device = nfc.nfc_open(self.__context, conn_strings[0])
+            try:
+                self.__device, _ = default_registry().open()
+            except IOError:
+                self.log("NFC Waiting for device.")
+                time.sleep(5)
+            else:
+                if self.adaptive_timeouts:
+                    if self.timeouts is None:
+                        self.timeouts = TimeoutManager(self.__device)
+                    else:
+                        self.timeouts.reset_device(self.__device)
                 try:
                     _ = nfc.nfc_initiator_init(self.__device)
                     while True:
                         self._poll_loop()
                 finally:
-                    nfc.nfc_close(self.__device)
-            else:
-                self.log("NFC Waiting for device.")
-                time.sleep(5)
+                    default_registry().close(self.__device)
         except (KeyboardInterrupt, SystemExit):
             loop = False
         except IOError as e:
@@ -91,7 +117,7 @@ class NFCReader(object):
         # loop = True
         #    print "[!]", str(e)
         finally:
-            nfc.nfc_exit(self.__context)
+            release_context()
             self.log("NFC Clean shutdown called")
         return loop
 
@@ -122,7 +148,11 @@ class NFCReader(object):
                 if not ((self._card_uid and self._card_present and uid == self._card_uid) and
                         time.mktime(time.gmtime()) <= self._card_last_seen + self.card_timeout):
                     self._setup_device()
-                    self.read_card(uid)
+                    data = self.read_card(uid)
+                    if self.event_ring is not None:
+                        # read_card gives the blocks as strings of chr(byte)
+                        self.event_ring.publish(uid, 'MIFARE_CLASSIC', ''.join(data).encode('latin-1'),
+                                                reader=self.reader_id)
             self._card_uid = uid
             self._card_present = True
             self._card_last_seen = time.mktime(time.gmtime())
@@ -155,46 +185,96 @@ class NFCReader(object):
         if nfc.nfc_device_set_property_bool(self.__device, nfc.NP_HANDLE_PARITY, True) < 0:
             raise Exception("Error setting Easy Framing property")
 
+    def _set_easy_framing(self):
+        """Easy framing for the next command. With air timing, _transceive sets the framing of every frame itself"""
+        if self.air_timing is None and nfc.nfc_device_set_property_bool(self.__device, nfc.NP_EASY_FRAMING, True) < 0:
+            raise Exception("Error setting Easy Framing property")
+
+    def _transceive(self, abttx, abtrx):
+        """Sends a command frame and receives the answer into abtrx
+
+           Returns the libnfc result, negative on error
+        """
+        command = mifare_command_key(abttx)
+        if self.air_timing is not None and abttx[0] in SINGLE_FRAME_MIFARE_COMMANDS:
+            transceive = lambda: self.air_timing.transceive(self.__device, ('MIFARE_CLASSIC', command), bytes(abttx),
+                                                            abtrx)
+        else:
+            if self.air_timing is not None:
+                # AUTH, WRITE and the value commands take more than one frame, which the reader only handles with easy
+                # framing and its own CRC handling, so they are not timed
+                self.air_timing.configure(self.__device, enabled=False)
+            # -1: use the command timeout of the device, which the timeout manager sets for this command
+            transceive = lambda: nfc.nfc_initiator_transceive_bytes(self.__device, ctypes.pointer(abttx), len(abttx),
+                                                                    ctypes.pointer(abtrx), len(abtrx),
+                                                                    0 if self.timeouts is None else -1)
+        return transceive() if self.timeouts is None else self.timeouts.call(command, transceive)
+
+    def enable_air_timing(self, stats=None):
+        """Time READ and TRANSFER frames with nfc_initiator_transceive_bytes_timed, see pynfc.air_timing
+
+           Returns the AirTimingStats the timings are recorded in
+        """
+        self.air_timing = AirTiming(stats)
+        return self.air_timing.stats
+
+    def disable_air_timing(self):
+        if self.air_timing is not None:
+            self.air_timing.configure(self.__device, enabled=False)
+            self.air_timing = None
+
     def _read_block(self, block):
         """Reads a block from a Mifare Card after authentication
 
            Returns the data read or raises an exception
         """
-        if nfc.nfc_device_set_property_bool(self.__device, nfc.NP_EASY_FRAMING, True) < 0:
-            raise Exception("Error setting Easy Framing property")
+        return "".join([chr(byte) for byte in self._read_block_bytes(block)])
+
+    def _read_block_bytes(self, block):
+        """Reads a block from a Mifare Card after authentication
+
+           Returns the data read as bytes or raises an exception
+        """
+        self._set_easy_framing()
         abttx = (ctypes.c_uint8 * 2)()
         abttx[0] = self.MC_READ
         abttx[1] = block
         abtrx = (ctypes.c_uint8 * 250)()
-        res = nfc.nfc_initiator_transceive_bytes(self.__device, ctypes.pointer(abttx), len(abttx),
-                                                 ctypes.pointer(abtrx), len(abtrx), 0)
+        res = self._transceive(abttx, abtrx)
         if res < 0:
             raise IOError("Error reading data")
-        return "".join([chr(abtrx[i]) for i in range(res)])
+        return bytes(abtrx[:res])
 
     def __write_block(self, block, data):
         """Writes a block of data to a Mifare Card after authentication
 
            Raises an exception on error
         """
-        if nfc.nfc_device_set_property_bool(self.__device, nfc.NP_EASY_FRAMING, True) < 0:
-            raise Exception("Error setting Easy Framing property")
+        self._set_easy_framing()
         if len(data) > 16:
             raise ValueError(
                 "Data value to be written cannot be more than 16 characters.")
+        return self._write_block_bytes(block, (data + "\x00" * (16 - len(data))).encode('latin-1'))
+
+    def _write_block_bytes(self, block, data):
+        """Writes 16 bytes to a block of a Mifare Card after authentication
+
+           Returns the libnfc result, negative on error
+        """
+        self._set_easy_framing()
+        if len(data) != 16:
+            raise ValueError("Data value to be written must be 16 bytes.")
         abttx = (ctypes.c_uint8 * 18)()
         abttx[0] = self.MC_WRITE
         abttx[1] = block
         abtrx = (ctypes.c_uint8 * 250)()
         for i in range(16):
-            abttx[i + 2] = ord((data + "\x00" * (16 - len(data)))[i])
-        return nfc.nfc_initiator_transceive_bytes(self.__device, ctypes.pointer(abttx), len(abttx),
-                                                  ctypes.pointer(abtrx), len(abtrx), 0)
+            abttx[i + 2] = data[i]
+        return self._transceive(abttx, abtrx)
 
     def _authenticate(self, block, uid, key="\xff\xff\xff\xff\xff\xff", use_b_key=False):
         """Authenticates to a particular block using a specified key"""
-        if nfc.nfc_device_set_property_bool(self.__device, nfc.NP_EASY_FRAMING, True) < 0:
-            raise Exception("Error setting Easy Framing property")
+        self._set_easy_framing()
         abttx = (ctypes.c_uint8 * 12)()
         abttx[0] = self.MC_AUTH_A if not use_b_key else self.MC_AUTH_B
         abttx[1] = block
@@ -203,8 +283,7 @@ class NFCReader(object):
         for i in range(4):
             abttx[i + 8] = uid[i]
         abtrx = (ctypes.c_uint8 * 250)()
-        transceived = nfc.nfc_initiator_transceive_bytes(self.__device, ctypes.pointer(abttx), len(abttx),
-                                                  ctypes.pointer(abtrx), len(abtrx), 0)
+        transceived = self._transceive(abttx, abtrx)
         return transceived
 
     def auth_and_read(self, block, uid, key="\xff\xff\xff\xff\xff\xff"):
@@ -244,10 +323,260 @@ class NFCReader(object):
             #     [x if x in string.printable else "." for x in data]))
             all_data += [data]
         print("read_card: '{}'".format(''.join(all_data)))
+        self._card_dumps[bytes(uid)] = all_data
+        return all_data
+
+    def read_sector(self, sector, uid, key=mifare_classic.DEFAULT_KEY, use_b_key=False, include_trailer=False):
+        """Authenticates once and reads all data blocks of a sector
+
+           Returns a list of bytes, one item per block, or raises an IOError when the authentication failed
+        """
+        res = self._authenticate(mifare_classic.first_block(sector), uid, key, use_b_key)
+        if res < 0:
+            self.select_card()
+            raise IOError("Authentication to sector {} failed".format(sector))
+
+        blocks = mifare_classic.data_blocks(sector)
+        if include_trailer:
+            blocks += [mifare_classic.trailer_block(sector)]
+        return [self._read_block_bytes(block) for block in blocks]
+
+    def read_mad(self, uid, key=mifare_classic.MAD_KEY_A, refresh=False):
+        """Reads and parses the Mifare Application Directory from sector 0, and from sector 16 for a MAD2 on a 4K card
+
+           The result is cached per UID, pass refresh=True to read it again
+           Returns a mifare_classic.Mad, raises a mifare_classic.MadError when the card has no (valid) MAD
+        """
+        uid = bytes(uid)
+        if not refresh and uid in self._mad_cache:
+            return self._mad_cache[uid]
+
+        sector0 = self.read_sector(0, uid, key, include_trailer=True)
+        version = mifare_classic.Mad.version_from_trailer(sector0[3])
+        if not version:
+            raise mifare_classic.MadError("Card {} has no MAD".format(binascii.hexlify(uid)))
+
+        mad2 = None
+        if version == 2:
+            mad2 = b''.join(self.read_sector(mifare_classic.MAD2_SECTOR, uid, key))
+
+        mad = mifare_classic.Mad.parse(sector0[1] + sector0[2], mad2)
+        self._mad_cache[uid] = mad
+        return mad
+
+    def read_application(self, aid, uid, key=mifare_classic.DEFAULT_KEY, use_b_key=False,
+                         mad_key=mifare_classic.MAD_KEY_A):
+        """Reads only the sectors the MAD assigns to an application, authenticating once per sector
+
+           Returns the data blocks of those sectors concatenated, trailers left out
+        """
+        sectors = self.read_mad(uid, mad_key).sectors_for(aid)
+        if not sectors:
+            raise mifare_classic.MadError("Application {:04X} is not on card {}".format(aid, binascii.hexlify(bytes(uid))))
+
+        data = b''
+        for sector in sectors:
+            data += b''.join(self.read_sector(sector, uid, key, use_b_key))
+        return data
+
+    def read_ndef_classic(self, uid, key=mifare_classic.NDEF_KEY_A):
+        """Reads the NDEF message of a Mifare Classic card formatted according to NXP AN1304 (NFC Type MIFARE Classic Tag)
+
+           Returns the NDEF message bytes
+        """
+        return tlv.find_ndef_message(self.read_application(mifare_classic.AID_NDEF, uid, key))
+
+    def _value_command(self, command, block, operand=0):
+        """Sends INCREMENT, DECREMENT or RESTORE for a value block after authentication.
+           The result ends up in the card's transfer buffer, a TRANSFER writes it to a block
+
+           Returns the libnfc result, negative on error
+        """
+        self._set_easy_framing()
+        abttx = (ctypes.c_uint8 * 6)()
+        abttx[0] = command
+        abttx[1] = block
+        for i, byte in enumerate((operand & 0xFFFFFFFF).to_bytes(4, byteorder='little')):
+            abttx[i + 2] = byte
+        abtrx = (ctypes.c_uint8 * 250)()
+        return self._transceive(abttx, abtrx)
+
+    def _transfer(self, block):
+        """Writes the card's transfer buffer to a block after authentication
+
+           Returns the libnfc result, negative on error
+        """
+        abttx = (ctypes.c_uint8 * 2)()
+        abttx[0] = self.MC_TRANSFER
+        abttx[1] = block
+        abtrx = (ctypes.c_uint8 * 250)()
+        return self._transceive(abttx, abtrx)
+
+    def format_value_block(self, block, uid, value, address=None, key=mifare_classic.DEFAULT_KEY, use_b_key=False):
+        """Authenticates and turns a block into a value block holding value
+
+           address defaults to the block itself. Raises an IOError on failure
+        """
+        data = mifare_classic.encode_value_block(value, block if address is None else address)
+        if self._authenticate(block, uid, key, use_b_key) < 0:
+            self.select_card()
+            raise IOError("Authentication to block {} failed".format(block))
+        if self._write_block_bytes(block, data) < 0:
+            self.select_card()
+            raise IOError("Writing value block {} failed".format(block))
+
+    def read_value(self, block, uid, key=mifare_classic.DEFAULT_KEY, use_b_key=False):
+        """Authenticates and reads a value block
+
+           Returns the tuple (value, address), raises a ValueError when the block is not a value block
+        """
+        if self._authenticate(block, uid, key, use_b_key) < 0:
+            self.select_card()
+            raise IOError("Authentication to block {} failed".format(block))
+        return mifare_classic.decode_value_block(self._read_block_bytes(block))
+
+    def value_session(self, sector, uid, key=mifare_classic.DEFAULT_KEY, use_b_key=False):
+        """Returns a ValueSession to batch value block operations within a sector:
+
+               with reader.value_session(1, uid, key) as session:
+                   session.decrement(4, 250)
+                   session.copy(4, 5)  # backup
+        """
+        return ValueSession(self, sector, uid, key, use_b_key)
+
+    def write_card(self, uid, data, previous=None, keys=None, key=mifare_classic.DEFAULT_KEY, use_b_key=False,
+                   allow_trailers=False, progress=None):
+        """Accepts data of the recently read card with UID uid, and writes any changes necessary to it
+
+           Only the changed blocks are written, grouped per sector so every sector is authenticated once.
+           See mifare_classic.plan_writes for the accepted forms of data and previous.
+
+           previous defaults to what read_card last returned for this UID, otherwise every block in data is written.
+           keys is an optional dict of sector -> (key, use_b_key) for sectors that do not use the default key.
+           progress is called as progress(sector, sectors done, sectors planned) after every sector.
+
+           Returns a dict of sector -> error message for the sectors that could not be written, empty on success
+        """
+        if previous is None:
+            previous = self._card_dumps.get(bytes(uid))
+        plan = mifare_classic.plan_writes(previous, data, allow_trailers)
+
+        dump = self._card_dumps.get(bytes(uid))
+        if dump is not None:
+            dump = mifare_classic.split_blocks(dump)
+
+        failed = {}
+        for done, (sector, blocks) in enumerate(plan.items(), 1):
+            sector_key, sector_use_b_key = (keys or {}).get(sector, (key, use_b_key))
+            if self._authenticate(mifare_classic.first_block(sector), uid, sector_key, sector_use_b_key) < 0:
+                failed[sector] = "Authentication failed"
+                self.select_card()
+            else:
+                for block, content in blocks:
+                    if self._write_block_bytes(block, content) < 0:
+                        failed[sector] = "Writing block {} failed".format(block)
+                        self.select_card()
+                        break
+                    if dump is not None and block < len(dump):
+                        # Keep the cached dump in line with the card, so the next write_card only sends new changes
+                        dump[block] = content
+
+            if progress:
+                progress(sector, done, len(plan))
+
+        if dump is not None:
+            self._card_dumps[bytes(uid)] = dump
+        return failed
+
+
+class ValueSession(object):
+    """Batches value block operations on the blocks of one sector.
+
+       Operations are queued and sent by commit() within a single authentication. Consecutive increments and
+       decrements of the same block are combined into one INCREMENT or DECREMENT, followed by one TRANSFER,
+       so the card applies the net change atomically without a read-modify-write round trip through the host.
+       Used as a context manager, the session commits when the block exits without an exception.
+    """
+
+    def __init__(self, reader, sector, uid, key, use_b_key=False):
+        self.reader = reader
+        self.sector = sector
+        self.uid = uid
+        self.key = key
+        self.use_b_key = use_b_key
+        self._operations = []  # [kind, source block, target block, amount]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._operations = []
+
+    def _check_block(self, block):
+        if mifare_classic.sector_of_block(block) != self.sector or mifare_classic.is_trailer_block(block):
+            raise ValueError("Block {} is not a data block of sector {}".format(block, self.sector))
+
+    def _add_delta(self, block, amount):
+        self._check_block(block)
+        for operation in reversed(self._operations):
+            if operation[0] == 'delta' and operation[1] == block:
+                operation[3] += amount
+                return
+            if block in operation[1:3]:
+                break
+        self._operations += [['delta', block, block, amount]]
+
+    def increment(self, block, amount):
+        """Queue adding amount to value block block"""
+        if amount < 0:
+            raise ValueError("Amount must not be negative, use decrement")
+        self._add_delta(block, amount)
+
+    def decrement(self, block, amount):
+        """Queue subtracting amount from value block block"""
+        if amount < 0:
+            raise ValueError("Amount must not be negative, use increment")
+        self._add_delta(block, -amount)
+
+    def copy(self, source, target):
+        """Queue copying value block source to target (RESTORE + TRANSFER), eg. to keep a backup"""
+        self._check_block(source)
+        self._check_block(target)
+        self._operations += [['copy', source, target, 0]]
+
+    def commit(self):
+        """Authenticate once and send all queued operations
+
+           Returns the number of commands sent, raises an IOError when the card refuses one
+        """
+        operations = [operation for operation in self._operations if operation[0] == 'copy' or operation[3]]
+        self._operations = []
+        if not operations:
+            return 0
+
+        if self.reader._authenticate(mifare_classic.first_block(self.sector), self.uid, self.key, self.use_b_key) < 0:
+            self.reader.select_card()
+            raise IOError("Authentication to sector {} failed".format(self.sector))
+
+        commands = 0
+        for kind, source, target, amount in operations:
+            if kind == 'copy':
+                res = self.reader._value_command(NFCReader.MC_RESTORE, source)
+            elif amount > 0:
+                res = self.reader._value_command(NFCReader.MC_INCREMENT, source, amount)
+            else:
+                res = self.reader._value_command(NFCReader.MC_DECREMENT, source, -amount)
+            if res >= 0:
+                res = self.reader._transfer(target)
+            if res < 0:
+                self.reader.select_card()
+                raise IOError("Value operation on block {} failed".format(source))
+            commands += 2
+        return commands
 
-    def write_card(self, uid, data):
-        """Accepts data of the recently read card with UID uid, and writes any changes necessary to it"""
-        raise NotImplementedError
 
 if __name__ == '__main__':
     logger = logging.getLogger("cardhandler").info
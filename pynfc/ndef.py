@@ -0,0 +1,463 @@
+"""Encoding and decoding of NDEF messages, as specified in the NFC Forum "NFC Data Exchange Format" (NDEF)
+and the URI, Text and Smart Poster Record Type Definitions.
+
+Parsing is lazy and works on a memoryview of the message: the type, id and payload of a record are memoryview
+slices of the original buffer, so no payload is copied unless it is decoded (eg. into a str) or is chunked.
+"""
+
+import math
+import struct
+import zlib
+
+from .ntag_read import NTagReadWrite, NTagInfo, TagType
+
+# Type Name Format, the 3 lowest bits of the record header
+TNF_EMPTY = 0x00
+TNF_WELL_KNOWN = 0x01
+TNF_MIME = 0x02
+TNF_ABSOLUTE_URI = 0x03
+TNF_EXTERNAL = 0x04
+TNF_UNKNOWN = 0x05
+TNF_UNCHANGED = 0x06
+
+# Record header flags
+FLAG_MB = 0x80  # Message Begin
+FLAG_ME = 0x40  # Message End
+FLAG_CF = 0x20  # Chunk Flag
+FLAG_SR = 0x10  # Short Record, ie. a 1 byte payload length
+FLAG_IL = 0x08  # ID Length field present
+
+RTD_URI = b'U'
+RTD_TEXT = b'T'
+RTD_SMART_POSTER = b'Sp'
+RTD_ACTION = b'act'
+
+# URI identifier codes, see table 3 of the NFC Forum URI Record Type Definition. The index is the code.
+URI_PREFIXES = (
+    '', 'http://www.', 'https://www.', 'http://', 'https://', 'tel:', 'mailto:', 'ftp://anonymous:anonymous@',
+    'ftp://ftp.', 'ftps://', 'sftp://', 'smb://', 'nfs://', 'ftp://', 'dav://', 'news:', 'telnet://', 'imap:',
+    'rtsp://', 'urn:', 'pop:', 'sip:', 'sips:', 'tftp:', 'btspp://', 'btl2cap://', 'btgoep://', 'tcpobex://',
+    'irdaobex://', 'file://', 'urn:epc:id:', 'urn:epc:tag:', 'urn:epc:pat:', 'urn:epc:raw:', 'urn:epc:', 'urn:nfc:',
+)
+
+# Smart Poster recommended actions
+ACTION_DO = 0x00
+ACTION_SAVE = 0x01
+ACTION_EDIT = 0x02
+
+
+class NdefDecodeError(ValueError):
+    """Raised when bytes cannot be decoded as an NDEF message"""
+    pass
+
+
+def best_uri_prefix(uri):
+    """
+    Find the URI identifier code that abbreviates the most of the given URI
+    :return: tuple (code, remainder of the URI)
+    """
+    best = 0
+    for code, prefix in enumerate(URI_PREFIXES):
+        if prefix and uri.startswith(prefix) and len(prefix) > len(URI_PREFIXES[best]):
+            best = code
+    return best, uri[len(URI_PREFIXES[best]):]
+
+
+class Record(object):
+    """
+    A single NDEF record.
+
+    Records created by parse_message refer to the buffer they were parsed from: type, id and payload
+    are memoryviews into it. Records created directly hold whatever was passed in.
+    """
+
+    def __init__(self, tnf, record_type=b'', payload=b'', record_id=b''):
+        self.tnf = tnf
+        self.type = record_type
+        self.payload = payload
+        self.id = record_id
+
+    def __repr__(self):
+        return "Record(tnf={}, type={!r}, id={!r}, {} payload bytes)".format(self.tnf, bytes(self.type),
+                                                                           bytes(self.id), len(self.payload))
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and (self.tnf, bytes(self.type), bytes(self.id), bytes(self.payload)) == \
+            (other.tnf, bytes(other.type), bytes(other.id), bytes(other.payload))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def is_type(self, tnf, record_type):
+        return self.tnf == tnf and self.type == record_type
+
+    @property
+    def uri(self):
+        """The complete URI of a URI record, or of an absolute-URI record"""
+        if self.tnf == TNF_ABSOLUTE_URI:
+            return bytes(self.type).decode('utf-8')
+        if not self.is_type(TNF_WELL_KNOWN, RTD_URI):
+            raise ValueError("Not a URI record: {!r}".format(self))
+        code = self.payload[0]
+        prefix = URI_PREFIXES[code] if code < len(URI_PREFIXES) else ''
+        return prefix + bytes(self.payload[1:]).decode('utf-8')
+
+    @property
+    def text(self):
+        """The text of a Text record"""
+        if not self.is_type(TNF_WELL_KNOWN, RTD_TEXT):
+            raise ValueError("Not a Text record: {!r}".format(self))
+        status = self.payload[0]
+        encoding = 'utf-16' if status & 0x80 else 'utf-8'
+        return bytes(self.payload[1 + (status & 0x3F):]).decode(encoding)
+
+    @property
+    def language(self):
+        """The IANA language code of a Text record"""
+        if not self.is_type(TNF_WELL_KNOWN, RTD_TEXT):
+            raise ValueError("Not a Text record: {!r}".format(self))
+        status = self.payload[0]
+        return bytes(self.payload[1:1 + (status & 0x3F)]).decode('ascii')
+
+    @property
+    def mime_type(self):
+        if self.tnf != TNF_MIME:
+            raise ValueError("Not a MIME record: {!r}".format(self))
+        return bytes(self.type).decode('ascii')
+
+    def records(self):
+        """The nested records of a Smart Poster, parsed lazily from the payload"""
+        if not self.is_type(TNF_WELL_KNOWN, RTD_SMART_POSTER):
+            raise ValueError("Not a Smart Poster record: {!r}".format(self))
+        return parse_message(self.payload)
+
+    def encode(self, message_begin=True, message_end=True, chunk_size=None):
+        """
+        Encode this record. Short-record format is used when the payload fits in 255 bytes.
+        :param chunk_size: split the payload into chunked records of at most this many bytes
+        :rtype bytes
+        """
+        payload = self.payload
+        if chunk_size and len(payload) > chunk_size:
+            chunks = [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+            encoded = [_encode_record(self.tnf, self.type, self.id, chunks[0], message_begin, False, True)]
+            for chunk in chunks[1:-1]:
+                encoded += [_encode_record(TNF_UNCHANGED, b'', b'', chunk, False, False, True)]
+            encoded += [_encode_record(TNF_UNCHANGED, b'', b'', chunks[-1], False, message_end, False)]
+            return b''.join(encoded)
+
+        return _encode_record(self.tnf, self.type, self.id, payload, message_begin, message_end, False)
+
+
+def _encode_record(tnf, record_type, record_id, payload, message_begin, message_end, chunk):
+    header = tnf
+    if message_begin:
+        header |= FLAG_MB
+    if message_end:
+        header |= FLAG_ME
+    if chunk:
+        header |= FLAG_CF
+    if record_id:
+        header |= FLAG_IL
+
+    if len(payload) <= 0xFF:
+        header |= FLAG_SR
+        head = struct.pack('>BBB', header, len(record_type), len(payload))
+    else:
+        head = struct.pack('>BBI', header, len(record_type), len(payload))
+
+    if record_id:
+        head += bytes([len(record_id)])
+
+    return b''.join((head, bytes(record_type), bytes(record_id), bytes(payload)))
+
+
+def parse_message(data):
+    """
+    Lazily parse an NDEF message. Records are yielded one by one; their type, id and payload are memoryview slices
+    of data, so nothing is copied. Only chunked records are reassembled into a new bytes object.
+
+    :param data: the NDEF message, eg. as returned by NTagReadWrite.read_ndef_message_bytes
+    :type data bytes, bytearray or memoryview
+    :return: generator of Record objects
+    """
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    offset = 0
+    size = len(view)
+    chunks = None
+    chunked_record = None
+
+    while offset < size:
+        try:
+            header = view[offset]
+            type_length = view[offset + 1]
+            if header & FLAG_SR:
+                payload_length = view[offset + 2]
+                offset += 3
+            else:
+                payload_length = struct.unpack_from('>I', view, offset + 2)[0]
+                offset += 6
+            if header & FLAG_IL:
+                id_length = view[offset]
+                offset += 1
+            else:
+                id_length = 0
+        except (IndexError, struct.error):
+            raise NdefDecodeError("Truncated record header at offset {}".format(offset))
+
+        end = offset + type_length + id_length + payload_length
+        if end > size:
+            raise NdefDecodeError("Record at offset {} runs past the end of the message".format(offset))
+
+        record_type = view[offset:offset + type_length]
+        record_id = view[offset + type_length:offset + type_length + id_length]
+        payload = view[offset + type_length + id_length:end]
+        offset = end
+
+        tnf = header & 0x07
+        if chunks is not None:
+            if tnf != TNF_UNCHANGED:
+                raise NdefDecodeError("Chunk with TNF {} in the middle of a chunked record".format(tnf))
+            chunks += [payload]
+            if not header & FLAG_CF:
+                chunked_record.payload = b''.join(chunks)
+                chunks = None
+                yield chunked_record
+        elif header & FLAG_CF:
+            chunks = [payload]
+            chunked_record = Record(tnf, record_type, None, record_id)
+        else:
+            yield Record(tnf, record_type, payload, record_id)
+
+        if header & FLAG_ME:
+            break
+
+    if chunks is not None:
+        raise NdefDecodeError("Message ends inside a chunked record")
+
+
+def encode_message(records, chunk_size=None, compact=False, deflate=False):
+    """
+    Encode records into an NDEF message, setting the Message Begin/End flags
+    :param chunk_size: payloads larger than this are split into chunked records
+    :param compact: make the message as small as possible first, see compact_records
+    :param deflate: when compacting, also compress MIME payloads of registered types
+    :rtype bytes
+    """
+    records = list(records)
+    if compact:
+        records = compact_records(records, deflate=deflate)
+    if not records:
+        return Record(TNF_EMPTY).encode()
+    last = len(records) - 1
+    return b''.join(record.encode(index == 0, index == last, chunk_size) for index, record in enumerate(records))
+
+
+def uri_record(uri):
+    """URI record, with the URI abbreviated by the best matching identifier code"""
+    code, remainder = best_uri_prefix(uri)
+    return Record(TNF_WELL_KNOWN, RTD_URI, bytes([code]) + remainder.encode('utf-8'))
+
+
+def text_record(text, language='en', utf16=False):
+    """Text record in the given IANA language"""
+    language_bytes = language.encode('ascii')
+    if len(language_bytes) > 0x3F:
+        raise ValueError("Language code {} is too long".format(language))
+    status = len(language_bytes) | (0x80 if utf16 else 0x00)
+    encoded_text = text.encode('utf-16') if utf16 else text.encode('utf-8')
+    return Record(TNF_WELL_KNOWN, RTD_TEXT, bytes([status]) + language_bytes + encoded_text)
+
+
+def mime_record(mime_type, data):
+    """MIME record, eg. mime_record('application/json', b'{}')"""
+    return Record(TNF_MIME, mime_type.encode('ascii'), data)
+
+
+def external_record(external_type, data):
+    """NFC Forum external type record, external_type being 'domain:type', eg. 'example.com:serial'"""
+    return Record(TNF_EXTERNAL, external_type.encode('ascii'), data)
+
+
+def smart_poster_record(uri, title=None, language='en', action=None):
+    """Smart Poster record, with a URI, optionally a title and optionally a recommended action"""
+    records = [uri_record(uri)]
+    if title is not None:
+        records += [text_record(title, language)]
+    if action is not None:
+        records += [Record(TNF_WELL_KNOWN, RTD_ACTION, bytes([action]))]
+    return Record(TNF_WELL_KNOWN, RTD_SMART_POSTER, encode_message(records))
+
+
+class MessageTemplate(object):
+    """
+    Pre-encoded NDEF message in which a single fixed-length field is substituted.
+
+    All lengths and headers are computed once when the template is compiled, so rendering is a matter of splicing
+    the field into the byte image. This is meant for bulk encoding, eg. a URL with a serial number for every tag
+    in a print-and-encode run.
+
+    Example:
+        template = MessageTemplate.for_uri('https://example.com/t/{}', field_length=8, tlv=True)
+        read_writer.write_user_memory(template.render(b'00001234'), TagType.NTAG_213)
+    """
+
+    def __init__(self, image, field_offset, field_length):
+        """
+        :param image: the complete encoded message, with a placeholder at field_offset
+        :param field_offset: offset of the variable field in image
+        :param field_length: length of the variable field in bytes
+        """
+        self.image = bytes(image)
+        self.field_offset = field_offset
+        self.field_length = field_length
+        self._head = self.image[:field_offset]
+        self._tail = self.image[field_offset + field_length:]
+
+    @classmethod
+    def from_records(cls, records, placeholder, tlv=False, chunk_size=None):
+        """
+        Compile a template from records of which one contains placeholder in its payload.
+        The placeholder must occur exactly once in the encoded message and has the length of the field.
+
+        :param tlv: include the Type 2 Tag NDEF TLV header, so the rendered bytes can be written to user memory directly
+        """
+        message = encode_message(records, chunk_size)
+        if tlv:
+            message = NTagReadWrite._make_tag_length_header_for_value(message) + message
+
+        field_offset = message.find(placeholder)
+        if field_offset < 0 or message.find(placeholder, field_offset + 1) >= 0:
+            raise ValueError("Placeholder {!r} must occur exactly once in the message".format(placeholder))
+
+        return cls(message, field_offset, len(placeholder))
+
+    @classmethod
+    def for_uri(cls, uri_format, field_length, tlv=False):
+        """
+        Compile a template for a message with a single URI record
+        :param uri_format: the URI, with {} where the field goes, eg. 'https://example.com/t/{}'
+        :param field_length: length of the field in bytes
+        """
+        if uri_format.count('{}') != 1:
+            raise ValueError("URI format must contain {{}} exactly once: {!r}".format(uri_format))
+        record = uri_record(uri_format.replace('{}', '\x00' * field_length))
+        message = encode_message([record])
+        if tlv:
+            message = NTagReadWrite._make_tag_length_header_for_value(message) + message
+
+        # The field is located from the layout, the placeholder bytes may also occur elsewhere in the message.
+        # The payload ends the message and holds the identifier code, then the URI without its prefix
+        prefix = URI_PREFIXES[record.payload[0]]
+        before_field = uri_format[len(prefix):uri_format.index('{}')].encode('utf-8')
+        field_offset = len(message) - len(record.payload) + 1 + len(before_field)
+        return cls(message, field_offset, field_length)
+
+    def render(self, field):
+        """
+        :param field: the value of the variable field, exactly field_length bytes
+        :type field bytes
+        :rtype bytes
+        """
+        if len(field) != self.field_length:
+            raise ValueError("Field must be {} bytes, got {}".format(self.field_length, len(field)))
+        return b''.join((self._head, field, self._tail))
+
+    def render_many(self, fields):
+        """Render the template for every field in fields
+        :return: generator of bytes"""
+        head, tail, length = self._head, self._tail, self.field_length
+        for field in fields:
+            if len(field) != length:
+                raise ValueError("Field must be {} bytes, got {}".format(length, len(field)))
+            yield b''.join((head, field, tail))
+
+
+# MIME type -> external type under which its deflated payload is stored. See register_deflate_type
+_deflate_types = {}
+
+
+def register_deflate_type(mime_type, external_type):
+    """
+    Allow MIME records of mime_type to be stored deflated, as an external type record of external_type,
+    eg. register_deflate_type('application/json', 'example.com:json+deflate').
+    Readers must know about the registration to get the original record back, see inflate_record.
+    """
+    _deflate_types[mime_type] = external_type
+
+
+def inflate_record(record):
+    """
+    :return: the original MIME record if record holds a deflated payload of a registered type, otherwise record itself
+    """
+    if record.tnf == TNF_EXTERNAL:
+        external_type = bytes(record.type).decode('ascii')
+        for mime_type, registered in _deflate_types.items():
+            if registered == external_type:
+                return mime_record(mime_type, zlib.decompress(bytes(record.payload), -zlib.MAX_WBITS))
+    return record
+
+
+def compact_record(record, deflate=False, keep_id=False):
+    """
+    Return an equivalent record that encodes to as few bytes as possible:
+    - URI records use the identifier code that abbreviates the most, absolute-URI records become URI records
+    - Text records are stored as UTF-8 when that is shorter than UTF-16
+    - the ID field is dropped, unless keep_id
+    - with deflate, MIME payloads of a registered type (see register_deflate_type) are deflated when that saves bytes
+    The short record format is used automatically whenever the payload fits in 255 bytes.
+    """
+    record_id = record.id if keep_id else b''
+
+    if record.tnf == TNF_ABSOLUTE_URI or record.is_type(TNF_WELL_KNOWN, RTD_URI):
+        compacted = uri_record(record.uri)
+        if record.tnf == TNF_ABSOLUTE_URI and len(compacted.payload) + 1 > len(record.type):
+            compacted = Record(record.tnf, record.type, record.payload)
+    elif record.is_type(TNF_WELL_KNOWN, RTD_TEXT) and record.payload[0] & 0x80:
+        compacted = text_record(record.text, record.language)
+        if len(compacted.payload) > len(record.payload):
+            compacted = Record(record.tnf, record.type, record.payload)
+    elif record.is_type(TNF_WELL_KNOWN, RTD_SMART_POSTER):
+        compacted = Record(record.tnf, record.type,
+                           encode_message(compact_records(record.records(), deflate, keep_id)))
+    elif deflate and record.tnf == TNF_MIME and record.mime_type in _deflate_types:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(bytes(record.payload)) + compressor.flush()
+        external_type = _deflate_types[record.mime_type].encode('ascii')
+        if len(deflated) + len(external_type) < len(record.payload) + len(record.type):
+            compacted = Record(TNF_EXTERNAL, external_type, deflated)
+        else:
+            compacted = Record(record.tnf, record.type, record.payload)
+    else:
+        compacted = Record(record.tnf, record.type, record.payload)
+
+    compacted.id = record_id
+    return compacted
+
+
+def compact_records(records, deflate=False, keep_ids=False):
+    """compact_record for every record. See compact_record
+    :rtype list"""
+    return [compact_record(record, deflate, keep_ids) for record in records]
+
+
+def pages_needed(message):
+    """
+    Number of Type 2 Tag pages needed to store message, including its NDEF TLV header
+    :param message: an encoded NDEF message
+    """
+    tlv_length = len(NTagReadWrite._make_tag_length_header_for_value(message)) + len(message)
+    return int(math.ceil(tlv_length / float(NTagInfo.BYTES_PER_PAGE)))
+
+
+def page_report(message, tag_types=(TagType.NTAG_213, TagType.NTAG_215, TagType.NTAG_216)):
+    """
+    Report, before doing any RF I/O, how many pages message takes and whether it fits on each of the tag types
+    :return: dict of tag type name -> (pages needed, pages available, fits)
+    """
+    pages = pages_needed(message)
+    report = {}
+    for tag_type in tag_types:
+        available = tag_type['user_memory_end'] + 1 - tag_type['user_memory_start']
+        report[tag_type['name']] = (pages, available, pages <= available)
+    return report
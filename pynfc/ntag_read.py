@@ -3,11 +3,17 @@
 from . import pynfc as nfc
 import ctypes
 import binascii
+import collections
 import enum
 import logging
 # from builtins import bytes
 import math
 
+from .air_timing import SINGLE_FRAME_NTAG_COMMANDS, AirTiming
+from .context import acquire_context, default_registry, release_context
+from .event_ring import EVENT_NDEF
+from .timeouts import TimeoutManager, ntag_command_key
+
 def bin(i):
     return "0b{0:08b}".format(i)
 
@@ -46,6 +52,71 @@ class NTagInfo(object):
     BYTES_PER_PAGE = 4
 
 
+TargetInfo = collections.namedtuple('TargetInfo', ['uid', 'atqa', 'sak'])
+TargetResult = collections.namedtuple('TargetResult', ['uid', 'result', 'error'])
+
+
+def _uid_of(target):
+    """The UID of an ISO14443A nfc_target, using the UID length the target reported (4, 7 or 10 bytes)"""
+    return bytes([target.nti.nai.abtUid[i] for i in range(target.nti.nai.szUidLen)])
+
+
+class BulkReadResult(object):
+    """
+    Outcome of a resumable bulk read over a range of pages.
+    Pages that could not be read are zero-filled in data and listed in errors, so the read can be resumed later
+    by passing this object back into NTagReadWrite.read_pages_resumable
+    """
+
+    def __init__(self, start_page, end_page):
+        """
+        :param start_page: first page of the range
+        :param end_page: last page of the range (inclusive)
+        """
+        self.start_page = start_page
+        self.end_page = end_page
+        self.page_count = end_page - start_page + 1
+        self.buffer = bytearray(self.page_count * NTagInfo.BYTES_PER_PAGE)
+        self.received = bytearray(self.page_count)  # 1 for every page that was read successfully
+        self.errors = {}  # page -> description of the last error while reading that page
+        self.tag_lost = False
+
+    @property
+    def data(self):
+        """The bytes read so far, with missing pages zero-filled"""
+        return bytes(self.buffer)
+
+    @property
+    def complete(self):
+        return all(self.received)
+
+    def store(self, page, data):
+        """Store the data for one or more consecutive pages, starting at page"""
+        offset = (page - self.start_page) * NTagInfo.BYTES_PER_PAGE
+        pages = len(data) // NTagInfo.BYTES_PER_PAGE
+        self.buffer[offset:offset + pages * NTagInfo.BYTES_PER_PAGE] = data[:pages * NTagInfo.BYTES_PER_PAGE]
+        for index in range(page - self.start_page, page - self.start_page + pages):
+            self.received[index] = 1
+            self.errors.pop(self.start_page + index, None)
+        return pages
+
+    def missing_ranges(self):
+        """
+        :return: list of (first_page, last_page) tuples, inclusive, of the pages not read yet
+        """
+        ranges = []
+        first = None
+        for index, received in enumerate(self.received):
+            if not received and first is None:
+                first = index
+            elif received and first is not None:
+                ranges += [(self.start_page + first, self.start_page + index - 1)]
+                first = None
+        if first is not None:
+            ranges += [(self.start_page + first, self.end_page)]
+        return ranges
+
+
 class NTagReadWrite(object):
     """
     Allows to read/write to an NTag 21x device.
@@ -53,10 +124,28 @@ class NTagReadWrite(object):
     """
     card_timeout = 10
 
-    def __init__(self, logger=logging.getLogger("ntag_read_write")):
+    def __init__(self, logger=logging.getLogger("ntag_read_write"), adaptive_timeouts=False, event_ring=None,
+                 reader_id=0, connstring=None):
         """Initialize a ReadWrite object
-        :param logger: logging.Logger"""
+        :param logger: logging.Logger
+        :param adaptive_timeouts: use per-command timeouts learned from the latency of this reader, see pynfc.timeouts
+        :param event_ring: pynfc.event_ring.EventRing, or pynfc.event_export.EventExporter, to publish found tags and
+            read NDEF messages to
+        :param reader_id: identifies this reader in the published events
+        :param connstring: open only the device on this connstring, eg. b'pn532_uart:/dev/ttyUSB0'.
+            By default the first device found that is not open yet"""
         self.logger = logger
+        self.event_ring = event_ring
+        self.reader_id = reader_id
+        self.uid = None
+        self.adaptive_timeouts = adaptive_timeouts
+        self.timeouts = None
+        self.air_timing = None
+        self.tag_type = None  # As found by the last determine_tag_type()
+        self.context = None
+        self.device = None
+        self.connstring = connstring  # Of the opened device, tried first when reopening
+        self.fixed_connstring = connstring is not None
 
         mods = [(nfc.NMT_ISO14443A, nfc.NBR_106)]
         self.modulations = (nfc.nfc_modulation * len(mods))()
@@ -69,32 +158,32 @@ class NTagReadWrite(object):
     def open(self):
         """Open a connection with an NTag. Initializes pynfc context, the device.
         Call this after a close()"""
-        self.context = ctypes.pointer(nfc.nfc_context())
-        self.logger.info("Created NFC library context")
-        nfc.nfc_init(ctypes.byref(self.context))
-        self.logger.info("Initializing NFC library")
-
-        conn_strings = (nfc.nfc_connstring * 10)()
-        devices_found = nfc.nfc_list_devices(self.context, conn_strings, 10)
-        # import ipdb; ipdb.set_trace()
-        self.logger.info("{} devices found".format(devices_found))
-
-        if not devices_found:
-            self.logger.error("No devices found")
-            raise IOError("No devices found. " + SET_CONNSTRING)
-        else:
-            self.logger.info("Using conn_string[0] = {} to get a device. {}".format(conn_strings[0].value, SET_CONNSTRING))
-
-        self.device = nfc.nfc_open(self.context, conn_strings[0])
-
+        # The library context and the connstrings of the devices are shared by the process, so only the first
+        # open() initialises libnfc and probes for devices
+        self.context = acquire_context()
         try:
-            _ = self.device.contents  # This fails with a ValueError in case the device could not be opened
-
-            self.logger.info("Opened device {}, initializing NFC initiator".format(self.device))
-            _ = nfc.nfc_initiator_init(self.device)
-            self.logger.info("NFC initiator initialized")
-        except ValueError as error:
-            raise IOError("Could not open device on connstring {conn}: {err}".format(conn=conn_strings[0].value, err=error))
+            if self.fixed_connstring:
+                self.device, self.connstring = default_registry().open(connstring=self.connstring)
+            else:
+                self.device, self.connstring = default_registry().open(prefer=self.connstring)
+        except IOError as error:
+            release_context()
+            self.logger.error(str(error))
+            raise IOError("{}. {}".format(error, SET_CONNSTRING))
+
+        self.logger.info("Opened device {} on connstring {}, initializing NFC initiator".format(self.device,
+                                                                                               self.connstring))
+        _ = nfc.nfc_initiator_init(self.device)
+        self.logger.info("NFC initiator initialized")
+        if self.air_timing is not None:
+            self.air_timing.forget()  # nfc_initiator_init resets the framing
+
+        if self.adaptive_timeouts:
+            # Profiles learned before a close() still apply, it is the same reader
+            if self.timeouts is None:
+                self.timeouts = TimeoutManager(self.device)
+            else:
+                self.timeouts.reset_device(self.device)
 
     def list_targets(self, max_targets=10):
         """
@@ -102,16 +191,71 @@ class NTagReadWrite(object):
         :param max_targets: amount of targets to maximally find
         :return: list of bytes with the found UIDs
         """
+        return [target.uid for target in self.inventory(max_targets)]
+
+    def inventory(self, max_targets=10):
+        """
+        Enumerate all targets in the field. libnfc halts every target it finds, so they do not answer a select until
+        the field is switched off and on again, see reset_field()
+        :param max_targets: amount of targets to maximally find
+        :return: list of TargetInfo(uid, atqa, sak)
+        """
         targets = (nfc.nfc_target * max_targets)()
         count = nfc.nfc_initiator_list_passive_targets(self.device, self.modulations[0], targets, len(targets))
+        if count < 0:
+            raise IOError("NFC Error whilst listing targets")
 
-        uids = []
+        inventory = []
         for index in range(count):
-            uidLen = 7
-            uid = bytes([targets[index].nti.nai.abtUid[i] for i in range(uidLen)])
-            uids += [uid]
+            nai = targets[index].nti.nai
+            inventory += [TargetInfo(_uid_of(targets[index]), bytes(nai.abtAtqa), nai.btSak)]
+        return inventory
+
+    def for_each_target(self, operation, targets=None, max_targets=10):
+        """
+        Run an operation on every target in the field, in one pass.
+        Every target is selected by its UID, the operation is called and the target is deselected again,
+        so the next target can be selected. The device stays open and configured throughout.
+
+        Exceptions raised by the operation are caught and reported in the result for that target,
+        so one bad tag does not stop the pass.
 
-        return uids
+        :param operation: callable(read_writer, uid) whose return value is collected, eg.
+            lambda rw, uid: rw.read_ndef_message_bytes(TagType.NTAG_213)
+        :param targets: UIDs or TargetInfos to process. Defaults to the current inventory()
+        :return: list of TargetResult(uid, result, error), in the order the targets were processed
+        """
+        if targets is None:
+            targets = self.inventory(max_targets)
+
+        # Listing the targets left them halted, they only answer a select again after a field reset
+        self.reset_field()
+        self._configure_device()
+
+        results = []
+        for target in targets:
+            uid = target.uid if isinstance(target, TargetInfo) else bytes(target)
+
+            if self.select_target(uid) is None:
+                results += [TargetResult(uid, None, IOError("Target {} not in the field".format(binascii.hexlify(uid))))]
+                continue
+
+            self.uid = uid
+            try:
+                results += [TargetResult(uid, operation(self, uid), None)]
+            except Exception as error:
+                self.logger.warning("Operation on {} failed: {}".format(binascii.hexlify(uid), error))
+                results += [TargetResult(uid, None, error)]
+            finally:
+                nfc.nfc_initiator_deselect_target(self.device)
+
+        return results
+
+    def reset_field(self):
+        """Switch the RF field off and on, so all targets in the field return to their idle state"""
+        for enable in (False, True):
+            if nfc.nfc_device_set_property_bool(self.device, nfc.NP_ACTIVATE_FIELD, enable) < 0:
+                raise IOError("Error switching the field {}".format("on" if enable else "off"))
 
     def count_targets(self):
         """
@@ -137,10 +281,18 @@ class NTagReadWrite(object):
         if res < 0:
             raise IOError("NFC Error whilst polling")
 
-        uidLen = 7
-        uid = bytes([nt.nti.nai.abtUid[i] for i in range(uidLen)])
+        uid = _uid_of(nt)
+        self.uid = uid
+
+        self._configure_device()
+
+        if self.event_ring is not None and uid:
+            self.event_ring.publish(uid, reader=self.reader_id)
 
-        # setup device
+        return uid
+
+    def _configure_device(self):
+        """Set the device properties for talking to a selected NTag"""
         if nfc.nfc_device_set_property_bool(self.device, nfc.NP_ACTIVATE_CRYPTO1, True) < 0:
             raise Exception("Error setting Crypto1 enabled")
         if nfc.nfc_device_set_property_bool(self.device, nfc.NP_INFINITE_SELECT, False) < 0:
@@ -150,9 +302,9 @@ class NTagReadWrite(object):
         if nfc.nfc_device_set_property_bool(self.device, nfc.NP_HANDLE_PARITY, True) < 0:
             raise Exception("Error setting Easy Framing property")
 
-        return uid
-
     def set_easy_framing(self, enable=True):
+        if self.air_timing is not None:
+            return  # transceive_bytes sets the framing of every frame
         if nfc.nfc_device_set_property_bool(self.device, nfc.NP_EASY_FRAMING, enable) < 0:
             raise Exception("Error setting Easy Framing property")
 
@@ -172,22 +324,168 @@ class NTagReadWrite(object):
             abttx[index] = byte
 
         abtrx = (ctypes.c_uint8 * receive_length)()  # 16 is the minimum
-        res = nfc.nfc_initiator_transceive_bytes(self.device,
-                                                 ctypes.pointer(abttx), len(abttx),
-                                                 ctypes.pointer(abtrx), len(abtrx),
-                                                 0)
+        command = ntag_command_key(transmission)
+        if self.air_timing is not None and transmission[0] in SINGLE_FRAME_NTAG_COMMANDS:
+            tag_type = self.tag_type["name"] if self.tag_type else "TYPE_2"
+            transceive = lambda: self.air_timing.transceive(self.device, (tag_type, command), transmission, abtrx)
+        else:
+            if self.air_timing is not None:
+                # COMPATIBILITY_WRITE is two frames, the reader only sends the second after the ACK with easy framing
+                self.air_timing.configure(self.device, enabled=False)
+            # -1: use the command timeout of the device, which the timeout manager sets for this command
+            transceive = lambda: nfc.nfc_initiator_transceive_bytes(self.device,
+                                                                    ctypes.pointer(abttx), len(abttx),
+                                                                    ctypes.pointer(abtrx), len(abtrx),
+                                                                    0 if self.timeouts is None else -1)
+        res = transceive() if self.timeouts is None else self.timeouts.call(command, transceive)
         if res < 0:
             raise IOError("Error reading data")
 
         data = bytes(abtrx[:res])
         return data
 
+    def enable_air_timing(self, stats=None):
+        """
+        Send the single-frame commands (READ, FAST_READ, WRITE, PWD_AUTH, READ_SIG and GET_VERSION) with
+        nfc_initiator_transceive_bytes_timed and record their air timing per tag type and command. Easy framing and
+        CRC handling are switched off for those frames, the CRC is done on the host. COMPATIBILITY_WRITE is sent untimed
+        :param stats: pynfc.air_timing.AirTimingStats to record into, eg. one shared by several readers
+        :return: the AirTimingStats, see its report()
+        """
+        self.air_timing = AirTiming(stats)
+        return self.air_timing.stats
+
+    def disable_air_timing(self):
+        if self.air_timing is not None:
+            self.air_timing.configure(self.device, enabled=False)
+            self.air_timing = None
+
     def read_page(self, page):
         """Read the bytes at the given page"""
         received_data = self.transceive_bytes(bytes([int(Commands.MC_READ.value), page]), 16)
         data = received_data[:NTagInfo.BYTES_PER_PAGE]  # Only the first 4 bytes as a page is 4 bytes
         return data
 
+    def select_target(self, uid=None):
+        """
+        (Re)select a target, eg. after an RF error made the tag fall back to its IDLE state.
+        :param uid: if given, only the target with this UID is selected
+        :type uid bytes
+        :return: UID of the selected target or None when no (matching) target is in the field
+        """
+        nt = nfc.nfc_target()
+
+        if uid:
+            init_data = (ctypes.c_uint8 * len(uid))(*uid)
+            res = nfc.nfc_initiator_select_passive_target(self.device, self.modulations[0],
+                                                          init_data, len(uid), ctypes.byref(nt))
+        else:
+            res = nfc.nfc_initiator_select_passive_target(self.device, self.modulations[0],
+                                                          None, 0, ctypes.byref(nt))
+        if res <= 0:
+            return None
+
+        return _uid_of(nt)
+
+    def target_is_present(self):
+        """
+        Whether the target with UID self.uid is still in the field. Unlike select_target(), this leaves an active
+        target active
+        """
+        if not self.uid:
+            return False
+        nt = nfc.nfc_target()
+        nt.nm = self.modulations[0]
+        nt.nti.nai.szUidLen = len(self.uid)
+        for index, byte in enumerate(self.uid):
+            nt.nti.nai.abtUid[index] = byte
+        return nfc.nfc_initiator_target_is_present(self.device, nt) == nfc.NFC_SUCCESS
+
+    def fast_read_pages(self, start_page, end_page):
+        """Read the pages from start_page up to and including end_page with a single FAST_READ command.
+        The amount of pages is limited by the frame buffer of the reader, a PN532 handles 64 at most"""
+        page_count = end_page - start_page + 1
+        received_data = self.transceive_bytes(bytes([int(Commands.MC_FAST_READ.value), start_page, end_page]),
+                                              page_count * NTagInfo.BYTES_PER_PAGE)
+        return received_data
+
+    def read_pages_resumable(self, start_page, end_page, result=None, chunk_pages=16, min_chunk_pages=1,
+                             max_chunk_pages=32, grow_after=2, max_failures=3, uid=None):
+        """
+        Read a range of pages in FAST_READ chunks, keeping whatever was received when an RF error occurs.
+
+        After an error, the tag is reselected and the chunk size is halved, so marginal coupling does not keep failing
+        on big frames. After grow_after consecutive successful chunks, the chunk size is doubled again.
+        A single page that fails max_failures times in a row is given up on. When the tag can no longer be reselected,
+        it has left the field and the partial result is returned with tag_lost set.
+
+        Pass a previous, incomplete result back in to only read the pages that are still missing.
+
+        :param start_page: first page to read
+        :param end_page: last page to read (inclusive)
+        :param result: BulkReadResult of an earlier, incomplete read of the same range
+        :param chunk_pages: initial number of pages per FAST_READ
+        :param uid: UID of the tag, so that reselecting cannot pick up another tag in the field
+        :rtype BulkReadResult
+        """
+        if result is None:
+            result = BulkReadResult(start_page, end_page)
+        elif (result.start_page, result.end_page) != (start_page, end_page):
+            raise ValueError("Result covers pages {}-{}, not {}-{}".format(result.start_page, result.end_page,
+                                                                           start_page, end_page))
+        result.tag_lost = False
+
+        chunk_pages = max(min_chunk_pages, min(chunk_pages, max_chunk_pages))
+        successes = 0
+
+        for first, last in result.missing_ranges():
+            page = first
+            failures = 0
+            while page <= last:
+                chunk_end = min(page + chunk_pages - 1, last)
+                try:
+                    data = self.fast_read_pages(page, chunk_end)
+                except IOError as error:
+                    data = b''
+                    for failed_page in range(page, chunk_end + 1):
+                        result.errors[failed_page] = str(error)
+
+                pages_stored = result.store(page, data)
+                if pages_stored == chunk_end - page + 1:
+                    page = chunk_end + 1
+                    failures = 0
+                    successes += 1
+                    if successes >= grow_after and chunk_pages < max_chunk_pages:
+                        chunk_pages = min(chunk_pages * 2, max_chunk_pages)
+                        successes = 0
+                    continue
+
+                # Short or failed read: keep what arrived and continue with the rest using smaller frames
+                page += pages_stored
+                successes = 0
+                failures = 0 if pages_stored else failures + 1
+                chunk_pages = max(min_chunk_pages, chunk_pages // 2)
+                self.logger.info("RF error at page {}, continuing with {} pages per read".format(page, chunk_pages))
+
+                if self.select_target(uid) is None:
+                    self.logger.warning("Tag left the field at page {}".format(page))
+                    result.tag_lost = True
+                    return result
+
+                if failures >= max_failures and chunk_pages == min_chunk_pages:
+                    self.logger.warning("Giving up on page {}".format(page))
+                    page += chunk_pages
+                    failures = 0
+
+        return result
+
+    def read_user_memory_resumable(self, tag_type, result=None, **kwargs):
+        """Read the complete user memory like read_user_memory, but tolerate RF errors halfway.
+        See read_pages_resumable for the keyword arguments.
+        :rtype BulkReadResult"""
+        return self.read_pages_resumable(tag_type['user_memory_start'], tag_type['user_memory_end'],
+                                         result=result, **kwargs)
+
     def determine_tag_type(self):
         """
         According to the NTAG213/215/216 specification, the Capability Container byte 2 contains the memory size of the tag
@@ -210,6 +508,7 @@ class NTagReadWrite(object):
 
         try:
             tag_type = capability_byte_type_map[capability_byte]
+            self.tag_type = tag_type
 
             return tag_type, uid
         except KeyError as key_error:
@@ -224,10 +523,10 @@ class NTagReadWrite(object):
         start = tag_type['user_memory_start']
         end = tag_type['user_memory_end'] + 1  # + 1 because the Python range generator excluded the last value
 
-        user_memory = []
+        user_memory = bytearray()
 
         for page in range(start, end):
-            user_memory += list(self.read_page(page))
+            user_memory += self.read_page(page)
 
         return bytes(user_memory)
 
@@ -262,6 +561,9 @@ class NTagReadWrite(object):
             end = tag_type["user_memory_start"] + 1 + math.ceil(length/4)
             for page in range(start, end):
                 user_memory += list(self.read_page(page))
+            if self.event_ring is not None and self.uid:
+                self.event_ring.publish(self.uid, tag_type["name"], bytes(user_memory), kind=EVENT_NDEF,
+                                        reader=self.reader_id)
             return bytes(user_memory)
         else:
             raise ValueError("Tag does not contain NDEF message. Tag indicates {tag} in first byte".format(tag=tag_field))
@@ -344,14 +646,77 @@ class NTagReadWrite(object):
 
         self.write_user_memory(tag_content, *args, **kwargs)
 
-    def authenticate(self, password, acknowledge=b'\x00\x00'):
+    def write_ndef_message_bytes_journaled(self, message_bytes, tag_type, uid, journal, debug=False):
+        """Write an NDEF message so that pulling the tag away halfway never leaves a half-valid message behind,
+        and so that the write can be resumed when the tag is presented again.
+
+        The write goes in 3 stages:
+        1. The first page is written with the NDEF TLV length set to 0, so readers see an empty message from now on
+        2. The remaining pages of the message are written
+        3. The first page is written again, now with the real length
+
+        Every completed page is recorded in the journal for the tag's UID.
+        When the same message is written to the same tag again, the write continues at the first unwritten page.
+
+        :param message_bytes: the NDEF message
+        :param tag_type: Which type of tag are we dealing with? Used to figure out where the user memory is
+        :param uid: UID of the tag, as returned by setup_target
+        :param journal: where the progress is recorded
+        :type journal pynfc.write_journal.WriteJournal
+        :return: the number of pages actually written
+        """
+        header = self._make_tag_length_header_for_value(message_bytes)
+        tag_content = header + message_bytes
+        empty_header = header[:-1] + b'\x00' if len(header) == 2 else header[:2] + b'\x00\x00'
+
+        start = tag_type['user_memory_start']
+        mem_size = tag_type['user_memory_end'] + 1 - start
+        page_contents = [tag_content[i:i + NTagInfo.BYTES_PER_PAGE]
+                         for i in range(0, len(tag_content), NTagInfo.BYTES_PER_PAGE)]
+
+        if len(page_contents) > mem_size:
+            raise ValueError("{type} user memory ({mem_size} 4-byte pages) too small for content ({content_size} 4-byte pages)".
+                             format(type=tag_type, mem_size=mem_size, content_size=len(page_contents)))
+
+        first_page_empty = empty_header + page_contents[0][len(header):]
+        steps = [(start, first_page_empty)] + \
+                [(start + index, content) for index, content in enumerate(page_contents) if index > 0] + \
+                [(start, page_contents[0])]
+
+        completed = journal.completed_steps(uid, tag_content)
+        if completed:
+            self.logger.info("Resuming write to {} at step {} of {}".format(binascii.hexlify(uid), completed, len(steps)))
+
+        for step in range(completed, len(steps)):
+            page, content = steps[step]
+            self.write_page(page, content, debug)
+            journal.record(uid, tag_content, step + 1)
+
+        journal.finish(uid)
+        return len(steps) - completed
+
+    def _diversify(self, diversifier, uid=None):
+        """Derive password and acknowledge for uid, or else for the UID of the last setup_target()"""
+        uid = uid or self.uid
+        if not uid:
+            raise ValueError("No UID to diversify for, call setup_target() or pass uid=")
+        return diversifier.derive(uid)
+
+    def authenticate(self, password=None, acknowledge=b'\x00\x00', diversifier=None, uid=None):
         """After issuing this command correctly, the tag goes into the Authenticated-state,
         during which the protected bytes can be written
         :param password the 4-byte password with which the tag is protected
         :type password bytes
         :param acknowledge the 2 Password ACKnowledge bytes. If these are received, the password was correct
+        :param diversifier derive password and acknowledge from the UID instead
+        :type diversifier pynfc.diversification.PasswordDiversifier
+        :param uid UID to derive the password for. Defaults to the UID of the last setup_target()
         :returns whether the password was correct or not
         :rtype bool"""
+        if diversifier is not None:
+            password, acknowledge = self._diversify(diversifier, uid)
+        elif password is None:
+            raise ValueError("Either a password or a diversifier is required")
 
         # With easy framing enabled, there will be an "Application level error".
         # With easy-framing disabled, 'Chip error: "Timeout" (01), returned error: "RF Transmission Error" (-20))'
@@ -366,6 +731,7 @@ class NTagReadWrite(object):
         # But, this sets the timeout for the communication between host and PN532, not between PN532 and NTag.
         # On the other hand, this 5ms is the same for reading, to there should not be a need to set a different timeout
         # for PN532-to-NTag communication.
+        # With adaptive_timeouts, PWD_AUTH gets its own timeout profile, learned from the latency on this reader.
         self.set_easy_framing(False)
 
         if len(password) != 4:
@@ -376,20 +742,23 @@ class NTagReadWrite(object):
 
         cmd = int(Commands.MC_PWD_AUTH.value)
 
-        ctypes_key = (ctypes.c_uint8 * len(password))()  # command length
-        for index, byte in enumerate(password):
-            ctypes_key[index] = byte
-
-        crc = (ctypes.c_uint8 * 2)()
-
-        nfc.iso14443a_crc(ctypes.pointer(ctypes_key), len(password), ctypes.pointer(crc))
-
         abttx = bytes([cmd]) + password
 
         recv = self.transceive_bytes(bytes(abttx), 16)
 
         return recv == acknowledge
 
+    def read_signature(self):
+        """Read the 32 byte NXP originality signature (ECDSA over the UID) with the READ_SIG command.
+        Verify it with pynfc.originality.OriginalityVerifier
+        :rtype bytes"""
+        self.set_easy_framing(True)
+
+        signature = self.transceive_bytes(bytes([int(Commands.MC_READ_SIG.value), 0x00]), 32)
+        if len(signature) != 32:
+            raise IOError("Expected a 32 byte signature, got {} bytes".format(len(signature)))
+        return signature
+
     def enable_uid_mirror(self, tag_type, page, byte_in_page):
         """
         An NTAG 21x has the option to mirror its UID to a place in the user memory.
@@ -449,7 +818,8 @@ class NTagReadWrite(object):
             return None
 
     def set_password(self, tag_type, password=b'\xff\xff\xff\xff', acknowledge=b'\x00\x00', max_attempts=None,
-                     also_read=False, auth_from=0xFF, lock_config=False, enable_counter=False, protect_counter=False):
+                     also_read=False, auth_from=0xFF, lock_config=False, enable_counter=False, protect_counter=False,
+                     diversifier=None, uid=None):
         """
 
         The AUTH0-byte (byte 3 on page 0x29/0x83/0xE3 for resp Ntag 213,215,216) defines the page address from which the password verification is required.
@@ -469,7 +839,13 @@ class NTagReadWrite(object):
         With a password, writing is still possible but needs to be deliberate.
         The password must thus protect writing only, but for the whole tag so the start page in AUTH0 must be 0
         There's no need to lock the user configuration (i.e. these bytes generated here), so CGFLCK=0
+
+        With a diversifier (see pynfc.diversification), password and acknowledge are derived from the uid instead,
+        which defaults to the UID of the last setup_target()
         """
+        if diversifier is not None:
+            password, acknowledge = self._diversify(diversifier, uid)
+
         cfg0_page = tag_type['user_memory_end'] + 2
         cfg1_page = cfg0_page + 1
         pwd_page = cfg1_page + 1
@@ -514,11 +890,11 @@ class NTagReadWrite(object):
         self.write_page(cfg0_page, cfg0)
 
     def close(self):
-        """Close connection to the target NTag and de-initialize the pynfc context.
+        """Close connection to the target NTag and release the shared pynfc context.
         After a failed read/write due to password protection, call close(), then open() and then do the authenticate() call"""
         nfc.nfc_idle(self.device)
-        nfc.nfc_close(self.device)
-        nfc.nfc_exit(self.context)
+        default_registry().close(self.device)
+        release_context()
 
 
 def test_passwords():
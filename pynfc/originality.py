@@ -0,0 +1,326 @@
+"""Verification of the NXP originality signature of NTAG 21x tags.
+
+NTAG 21x tags carry a 32 byte ECDSA signature over their UID, made with an NXP private key on curve secp128r1.
+It is read with the READ_SIG command, see NTagReadWrite.read_signature.
+See NXP application note AN11350 "NTAG21x Originality Signature Validation".
+
+The UID is not hashed: it is used directly as the message integer of the ECDSA verification.
+
+Verifying is done with precomputed tables of the generator and of the public key, so a verification is 64 point
+additions and no doublings. Batches share the modular inversions (Montgomery's trick) and can be spread over
+a process pool.
+"""
+
+import binascii
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+# secp128r1, see SEC 2: Recommended Elliptic Curve Domain Parameters
+P = 0xFFFFFFFDFFFFFFFFFFFFFFFFFFFFFFFF
+A = 0xFFFFFFFDFFFFFFFFFFFFFFFFFFFFFFFC
+B = 0xE87579C11079F43DD824993C2CEE5ED3
+N = 0xFFFFFFFE0000000075A30D1B9038A115
+G = (0x161FF7528B899B2D0C28607CA52C5B86, 0xCF5AC8395BAFEB13C02DA292DDED7A83)
+
+# Uncompressed public key for the originality signature of NTAG 210/212/213/215/216, from AN11350
+NTAG21X_PUBLIC_KEY = binascii.unhexlify('04494E1A386D3D3CFE3DC10E5DE68A499B1C202DB5B132393E89ED19FE5BE8BC61')
+
+SIGNATURE_LENGTH = 32
+
+WINDOW_BITS = 4
+WINDOWS = 128 // WINDOW_BITS
+
+
+def _inverse(value, modulus):
+    return pow(value, modulus - 2, modulus)
+
+
+def _batch_inverse(values, modulus):
+    """Invert all values with a single modular exponentiation (Montgomery's trick). Values must be non-zero"""
+    prefix = [1] * (len(values) + 1)
+    for index, value in enumerate(values):
+        prefix[index + 1] = prefix[index] * value % modulus
+
+    inverse = _inverse(prefix[-1], modulus)
+    result = [0] * len(values)
+    for index in range(len(values) - 1, -1, -1):
+        result[index] = prefix[index] * inverse % modulus
+        inverse = inverse * values[index] % modulus
+    return result
+
+
+def _affine_add(first, second):
+    """Add two affine points, None being the point at infinity"""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    x1, y1 = first
+    x2, y2 = second
+    if x1 == x2:
+        if (y1 + y2) % P == 0:
+            return None
+        slope = (3 * x1 * x1 + A) * _inverse(2 * y1, P) % P
+    else:
+        slope = (y2 - y1) * _inverse(x2 - x1, P) % P
+    x3 = (slope * slope - x1 - x2) % P
+    return x3, (slope * (x1 - x3) - y1) % P
+
+
+def _jacobian_double(point):
+    x, y, z = point
+    if not y:
+        return None
+    yy = y * y % P
+    s = 4 * x * yy % P
+    zz = z * z % P
+    m = (3 * x * x + A * zz * zz) % P
+    x3 = (m * m - 2 * s) % P
+    return x3, (m * (s - x3) - 8 * yy * yy) % P, 2 * y * z % P
+
+
+def _jacobian_add_affine(point, affine):
+    """Add an affine point to a point in Jacobian coordinates, None being the point at infinity"""
+    if affine is None:
+        return point
+    if point is None:
+        return affine[0], affine[1], 1
+    x1, y1, z1 = point
+    x2, y2 = affine
+    z1z1 = z1 * z1 % P
+    h = (x2 * z1z1 - x1) % P
+    r = (y2 * z1 * z1z1 - y1) % P
+    if not h:
+        return _jacobian_double(point) if not r else None
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    return x3, (r * (v - x3) - y1 * hhh) % P, z1 * h % P
+
+
+def _is_on_curve(point):
+    x, y = point
+    return (y * y - (x * x * x + A * x + B)) % P == 0
+
+
+def decode_public_key(public_key):
+    """
+    :param public_key: uncompressed point, 0x04 followed by 16 bytes X and 16 bytes Y
+    :return: tuple (x, y)
+    """
+    if len(public_key) != 33 or public_key[0] != 0x04:
+        raise ValueError("Public key must be an uncompressed secp128r1 point of 33 bytes")
+    point = (int.from_bytes(public_key[1:17], byteorder='big'), int.from_bytes(public_key[17:], byteorder='big'))
+    if not _is_on_curve(point):
+        raise ValueError("Public key is not a point on secp128r1")
+    return point
+
+
+def _window_table(point):
+    """table[i][j] is j * 16**i * point, so a scalar multiplication only needs one addition per 4-bit window"""
+    table = []
+    base = point
+    for _ in range(WINDOWS):
+        row = [None, base]
+        for _ in range(2, 1 << WINDOW_BITS):
+            row += [_affine_add(row[-1], base)]
+        table += [row]
+        base = _affine_add(row[-1], base)  # 16 * base
+    return table
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _tables_for(public_key):
+    """The precomputed tables for G and the public key, built once per process"""
+    with _tables_lock:
+        if public_key not in _tables:
+            if G not in _tables:
+                _tables[G] = _window_table(G)
+            _tables[public_key] = _window_table(decode_public_key(public_key))
+        return _tables[G], _tables[public_key]
+
+
+def _split_signature(uid, signature):
+    """:return: tuple (e, r, s), or None when the signature is malformed"""
+    if len(signature) != SIGNATURE_LENGTH:
+        return None
+    r = int.from_bytes(signature[:16], byteorder='big')
+    s = int.from_bytes(signature[16:], byteorder='big')
+    if not (0 < r < N and 0 < s < N):
+        return None
+    return int.from_bytes(uid, byteorder='big') % N, r, s
+
+
+def verify_many(items, public_key=NTAG21X_PUBLIC_KEY):
+    """
+    Verify a batch of originality signatures in this process
+    :param items: iterable of (uid, signature) tuples, both bytes
+    :return: list of bools, in the order of items
+    """
+    g_table, q_table = _tables_for(bytes(public_key))
+    items = list(items)
+    parsed = [_split_signature(bytes(uid), bytes(signature)) for uid, signature in items]
+
+    valid_indices = [index for index, values in enumerate(parsed) if values]
+    s_inverses = _batch_inverse([parsed[index][2] for index in valid_indices], N)
+
+    points = {}
+    for index, w in zip(valid_indices, s_inverses):
+        e, r, _ = parsed[index]
+        u1 = e * w % N
+        u2 = r * w % N
+
+        accumulator = None
+        for window in range(WINDOWS):
+            shift = window * WINDOW_BITS
+            accumulator = _jacobian_add_affine(accumulator, g_table[window][(u1 >> shift) & 0xF])
+            accumulator = _jacobian_add_affine(accumulator, q_table[window][(u2 >> shift) & 0xF])
+        if accumulator is not None and accumulator[2]:
+            points[index] = accumulator
+
+    point_indices = list(points)
+    z_inverses = _batch_inverse([points[index][2] for index in point_indices], P)
+
+    results = [False] * len(items)
+    for index, z_inverse in zip(point_indices, z_inverses):
+        x = points[index][0] * z_inverse * z_inverse % P
+        results[index] = x % N == parsed[index][1]
+    return results
+
+
+def verify(uid, signature, public_key=NTAG21X_PUBLIC_KEY):
+    """Verify a single originality signature
+    :rtype bool"""
+    return verify_many([(uid, signature)], public_key)[0]
+
+
+class VerifiedUidCache(object):
+    """
+    LRU cache of (UID, signature) pairs whose verification result is known, so re-presented tags skip the crypto.
+    Optionally, successful verifications are persisted to a file, one hex digest per line, so they survive restarts.
+    """
+
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path, 'r') as cache_file:
+                for line in cache_file:
+                    if line.strip():
+                        self._store(line.strip(), True)
+
+    @staticmethod
+    def _key(uid, signature):
+        return hashlib.sha256(bytes(uid) + bytes(signature)).hexdigest()
+
+    def _store(self, key, valid):
+        self._entries[key] = valid
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, uid, signature):
+        """:return: True or False when the result is known, otherwise None"""
+        key = self._key(uid, signature)
+        with self._lock:
+            valid = self._entries.get(key)
+            if valid is not None:
+                self._entries.move_to_end(key)
+            return valid
+
+    def put(self, uid, signature, valid):
+        key = self._key(uid, signature)
+        with self._lock:
+            known = key in self._entries
+            self._store(key, valid)
+            if valid and self.path and not known:
+                with open(self.path, 'a') as cache_file:
+                    cache_file.write(key + '\n')
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class OriginalityVerifier(object):
+    """
+    Verifies originality signatures with a cache of known results, in batches and optionally over a process pool.
+
+    Usage:
+        verifier = OriginalityVerifier(cache=VerifiedUidCache(path='verified_uids.txt'))
+        genuine = verifier.verify(uid, read_writer.read_signature())
+    """
+
+    def __init__(self, public_key=NTAG21X_PUBLIC_KEY, cache=None, processes=None, min_batch_per_process=64):
+        """
+        :param public_key: uncompressed secp128r1 public key of the tag manufacturer
+        :param cache: known results, None to always verify
+        :type cache VerifiedUidCache
+        :param processes: spread batches over this many worker processes. None or 1 verifies in this process
+        :param min_batch_per_process: batches are only split over processes when every process gets at least this many
+        """
+        self.public_key = bytes(public_key)
+        decode_public_key(self.public_key)
+        self.cache = cache
+        self.processes = processes
+        self.min_batch_per_process = min_batch_per_process
+        self._pool = None
+
+    def verify(self, uid, signature):
+        """:rtype bool"""
+        return self.verify_many([(uid, signature)])[0]
+
+    def verify_many(self, items):
+        """
+        :param items: iterable of (uid, signature) tuples
+        :return: list of bools, in the order of items
+        """
+        items = [(bytes(uid), bytes(signature)) for uid, signature in items]
+        results = [None] * len(items)
+
+        if self.cache is not None:
+            for index, (uid, signature) in enumerate(items):
+                results[index] = self.cache.get(uid, signature)
+
+        todo = [index for index, result in enumerate(results) if result is None]
+        if not todo:
+            return results
+
+        verified = self._verify_uncached([items[index] for index in todo])
+        for index, valid in zip(todo, verified):
+            results[index] = valid
+            if self.cache is not None:
+                self.cache.put(items[index][0], items[index][1], valid)
+        return results
+
+    def _verify_uncached(self, items):
+        processes = self.processes or 1
+        if processes <= 1 or len(items) < 2 * self.min_batch_per_process:
+            return verify_many(items, self.public_key)
+
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+
+        chunk_count = min(processes, len(items) // self.min_batch_per_process)
+        chunk_size = -(-len(items) // chunk_count)
+        chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+        results = []
+        for chunk_results in self._pool.map(verify_many, chunks, [self.public_key] * len(chunks)):
+            results += chunk_results
+        return results
+
+    def close(self):
+        """Shut down the process pool, if one was started"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
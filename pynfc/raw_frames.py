@@ -0,0 +1,216 @@
+"""Raw ISO14443A frames with CRC and parity computed on the host.
+
+The CRC_A of ISO14443-3 (polynomial x^16 + x^12 + x^5 + 1, reflected, preset 0x6363) is computed byte-wise with a
+256-entry table. crc_a_many computes it for many frames at once, vectorised with NumPy when that is installed.
+
+RawFrameEngine switches off the reader's CRC (and optionally parity) handling and sends host-built frames
+through nfc_initiator_transceive_bits or nfc_initiator_transceive_bytes, checking the CRC and parity of the response
+in the same pass. It is the basis for custom command pipelines, and benchmark() compares host framing with
+libnfc's own CRC routine.
+"""
+
+import ctypes
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CRC_A_PRESET = 0x6363
+
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table += [crc]
+    return table
+
+
+CRC_TABLE = _make_crc_table()
+
+_PARITY_TABLE = bytes((bin(byte).count('1') & 1) ^ 1 for byte in range(256))
+
+
+def crc_a_value(data, crc=CRC_A_PRESET):
+    """CRC_A of data as an int"""
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def crc_a(data):
+    """CRC_A of data as the 2 bytes that are appended to a frame, least significant byte first"""
+    crc = crc_a_value(data)
+    return bytes([crc & 0xFF, crc >> 8])
+
+
+def append_crc_a(data):
+    return bytes(data) + crc_a(data)
+
+
+def check_crc_a(frame):
+    """Whether the last 2 bytes of frame are the CRC_A of the rest"""
+    return len(frame) > 2 and crc_a(frame[:-2]) == bytes(frame[-2:])
+
+
+def odd_parity(byte):
+    """The ISO14443A parity bit of a byte"""
+    return _PARITY_TABLE[byte]
+
+
+def parity_bits(data):
+    """The parity bits of a frame, one byte (0 or 1) per data byte, as nfc_initiator_transceive_bits expects them"""
+    return bytes(data).translate(_PARITY_TABLE)
+
+
+def crc_a_many(frames):
+    """
+    CRC_A of many frames. With NumPy, frames of the same length are processed as one array, a column at a time
+    :return: list of 2-byte CRCs, in the order of frames
+    """
+    frames = [bytes(frame) for frame in frames]
+    if numpy is None:
+        return [crc_a(frame) for frame in frames]
+
+    table = numpy.array(CRC_TABLE, dtype=numpy.uint16)
+    by_length = {}
+    for index, frame in enumerate(frames):
+        by_length.setdefault(len(frame), []).append(index)
+
+    results = [None] * len(frames)
+    for length, indices in by_length.items():
+        matrix = numpy.frombuffer(b''.join(frames[index] for index in indices), dtype=numpy.uint8)
+        matrix = matrix.reshape(len(indices), length)
+        crc = numpy.full(len(indices), CRC_A_PRESET, dtype=numpy.uint16)
+        for column in range(length):
+            crc = (crc >> 8) ^ table[(crc ^ matrix[:, column]) & 0xFF]
+        for index, value in zip(indices, crc.tolist()):
+            results[index] = bytes([value & 0xFF, value >> 8])
+    return results
+
+
+class FrameError(IOError):
+    """A response frame with a wrong CRC or parity"""
+    pass
+
+
+class RawFrameEngine(object):
+    """
+    Sends frames built on the host, with the reader's framing offload switched off.
+
+    With host_parity, parity bits are computed on the host too and frames go through nfc_initiator_transceive_bits.
+    Otherwise the reader still does parity and frames go through nfc_initiator_transceive_bytes.
+    """
+
+    def __init__(self, device, host_parity=True, max_frame=264):
+        """
+        :param device: an opened nfc_device pointer with a selected target
+        :param host_parity: compute parity bits on the host
+        :param max_frame: size of the receive buffers, which are allocated once
+        """
+        from . import pynfc as nfc
+        self._nfc = nfc
+        self.device = device
+        self.host_parity = host_parity
+
+        self._rx = (ctypes.c_uint8 * max_frame)()
+        self._rx_par = (ctypes.c_uint8 * max_frame)()
+        self.configure()
+
+    def configure(self):
+        """(Re)apply the device properties for raw frames, eg. after another user of the device changed them"""
+        nfc = self._nfc
+        for prop, value in ((nfc.NP_EASY_FRAMING, False), (nfc.NP_HANDLE_CRC, False),
+                            (nfc.NP_HANDLE_PARITY, not self.host_parity)):
+            if nfc.nfc_device_set_property_bool(self.device, prop, value) < 0:
+                raise IOError("Error setting device property {} to {}".format(prop, value))
+
+    def transceive_raw(self, frame, parity=None, bits=None):
+        """
+        Send a frame exactly as given
+        :param parity: parity bits, one per byte. Computed when not given; ignored without host_parity
+        :param bits: number of bits to send, for frames that do not end on a byte boundary, eg. 7 for REQA
+        :return: tuple (received bytes, received parity bits or None, number of received bits)
+        """
+        nfc = self._nfc
+        tx = (ctypes.c_uint8 * len(frame)).from_buffer_copy(bytes(frame))
+
+        if self.host_parity:
+            tx_par = (ctypes.c_uint8 * len(frame)).from_buffer_copy(parity_bits(frame) if parity is None else bytes(parity))
+            res = nfc.nfc_initiator_transceive_bits(self.device, tx, bits or len(frame) * 8, tx_par,
+                                                    self._rx, len(self._rx), self._rx_par)
+            if res < 0:
+                raise IOError("Error transceiving raw frame: {}".format(res))
+            received = (res + 7) // 8
+            return bytes(self._rx[:received]), bytes(self._rx_par[:received]), res
+
+        res = nfc.nfc_initiator_transceive_bytes(self.device, tx, len(frame), self._rx, len(self._rx), 0)
+        if res < 0:
+            raise IOError("Error transceiving raw frame: {}".format(res))
+        return bytes(self._rx[:res]), None, res * 8
+
+    def transceive(self, data, append_crc=True, check_crc=True):
+        """
+        Send a command, appending its CRC_A, and return the response without its CRC_A.
+        The parity and CRC of the response are checked in a single pass over its bytes.
+        Short responses (ACK/NAK nibbles) are returned as they are.
+        :raises FrameError: on a parity or CRC error in the response
+        """
+        frame = append_crc_a(data) if append_crc else bytes(data)
+        received, received_parity, bits = self.transceive_raw(frame)
+
+        if bits < 8 or not check_crc:
+            return received
+
+        table = CRC_TABLE
+        crc = CRC_A_PRESET
+        for index, byte in enumerate(received):
+            if received_parity is not None and received_parity[index] != _PARITY_TABLE[byte]:
+                raise FrameError("Parity error in byte {} of the response".format(index))
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+
+        # Running the CRC over the data and its own CRC leaves 0 when they match
+        if len(received) < 3 or crc != 0:
+            raise FrameError("CRC error in response {}".format(received))
+        return received[:-2]
+
+
+def benchmark(iterations=10000, frame_length=18):
+    """
+    Time the host CRC_A (single frames and crc_a_many) against libnfc's iso14443a_crc through ctypes
+    :return: dict of method -> frames per second
+    """
+    frames = [bytes((index + offset) & 0xFF for offset in range(frame_length)) for index in range(iterations)]
+    results = {}
+
+    start = time.time()
+    for frame in frames:
+        crc_a(frame)
+    results['host table'] = iterations / (time.time() - start)
+
+    start = time.time()
+    crc_a_many(frames)
+    results['host batch' + (' (numpy)' if numpy is not None else '')] = iterations / (time.time() - start)
+
+    try:
+        from . import pynfc as nfc
+    except ImportError:
+        return results
+
+    start = time.time()
+    for frame in frames:
+        buffer = (ctypes.c_uint8 * len(frame)).from_buffer_copy(frame)
+        crc = (ctypes.c_uint8 * 2)()
+        nfc.iso14443a_crc(buffer, len(frame), crc)
+    results['libnfc via ctypes'] = iterations / (time.time() - start)
+    return results
+
+
+if __name__ == "__main__":
+    for method, rate in sorted(benchmark().items()):
+        print("{:>20}: {:>12,.0f} frames/s".format(method, rate))
@@ -0,0 +1,180 @@
+"""Lazily fetched, page-aligned view on the memory of a Type 2 tag"""
+
+from .ntag_read import NTagInfo
+
+
+class TagMemory(object):
+    """
+    Byte-addressable view on a range of pages of an NTag or other Type 2 tag.
+
+    Nothing is read when the object is created. Indexing or slicing fetches only the pages covering the requested
+    bytes, the first time they are accessed. Adjacent pages that are not fetched yet are read together with
+    FAST_READ, in chunks of at most max_pages_per_read pages.
+
+    Assigning to an index or slice only changes the local copy and marks the pages as dirty.
+    flush() then writes just the modified pages.
+
+    The object supports the buffer protocol (Python 3.12+), eg. memoryview(tag_memory) or bytes(tag_memory).
+    Exporting the buffer fetches the complete range first. Changes made through such an exported buffer
+    are not tracked as dirty; use slice assignment for that.
+
+    Byte 0 of this view is the first byte of start_page.
+    """
+
+    def __init__(self, reader, start_page, end_page, max_pages_per_read=16):
+        """
+        :param reader: the device to read from and write to
+        :type reader pynfc.ntag_read.NTagReadWrite
+        :param start_page: first page of the view
+        :param end_page: last page of the view (inclusive)
+        :param max_pages_per_read: upper limit of pages in a single FAST_READ, limited by the reader's frame buffer
+        """
+        self.reader = reader
+        self.start_page = start_page
+        self.end_page = end_page
+        self.page_count = end_page - start_page + 1
+        self.max_pages_per_read = max_pages_per_read
+
+        self._buffer = bytearray(self.page_count * NTagInfo.BYTES_PER_PAGE)
+        self._fetched = bytearray(self.page_count)
+        self._dirty = set()
+
+    @classmethod
+    def user_memory(cls, reader, tag_type, **kwargs):
+        """View on the complete user memory of the given tag type"""
+        return cls(reader, tag_type['user_memory_start'], tag_type['user_memory_end'], **kwargs)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __repr__(self):
+        return "TagMemory(pages {}-{}, {} fetched, {} dirty)".format(self.start_page, self.end_page,
+                                                                   sum(self._fetched), len(self._dirty))
+
+    def _byte_range(self, key):
+        """Translate an index or slice into the (start, stop) range of bytes it covers"""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self._buffer))
+            if step < 0:
+                start, stop = stop + 1, start + 1
+            return start, max(start, stop)
+
+        index = key + len(self._buffer) if key < 0 else key
+        if not 0 <= index < len(self._buffer):
+            raise IndexError("TagMemory index out of range")
+        return index, index + 1
+
+    def fetch(self, start=0, stop=None):
+        """Make sure the bytes in range(start, stop) are available locally, reading the missing pages from the tag.
+        :return: the number of pages read"""
+        stop = len(self._buffer) if stop is None else stop
+        if stop <= start:
+            return 0
+
+        first = start // NTagInfo.BYTES_PER_PAGE
+        last = (stop - 1) // NTagInfo.BYTES_PER_PAGE
+
+        pages_read = 0
+        index = first
+        while index <= last:
+            if self._fetched[index]:
+                index += 1
+                continue
+
+            # Coalesce the run of missing pages into as few reads as possible
+            run_end = index
+            while run_end + 1 <= last and not self._fetched[run_end + 1] and \
+                    run_end + 1 - index < self.max_pages_per_read:
+                run_end += 1
+
+            data = self.reader.fast_read_pages(self.start_page + index, self.start_page + run_end)
+            expected = (run_end - index + 1) * NTagInfo.BYTES_PER_PAGE
+            if len(data) < expected:
+                raise IOError("Short read of pages {}-{}: {} of {} bytes".format(
+                    self.start_page + index, self.start_page + run_end, len(data), expected))
+
+            offset = index * NTagInfo.BYTES_PER_PAGE
+            self._buffer[offset:offset + expected] = data[:expected]
+            for fetched in range(index, run_end + 1):
+                self._fetched[fetched] = 1
+
+            pages_read += run_end - index + 1
+            index = run_end + 1
+
+        return pages_read
+
+    def __getitem__(self, key):
+        start, stop = self._byte_range(key)
+        self.fetch(start, stop)
+        if isinstance(key, slice):
+            return bytes(self._buffer[key])
+        return self._buffer[key]
+
+    def __setitem__(self, key, value):
+        start, stop = self._byte_range(key)
+        indices = range(start, stop)
+        if isinstance(key, slice):
+            value = bytes(value)
+            indices = range(*key.indices(len(self._buffer)))
+            if len(value) != len(indices):
+                raise ValueError("TagMemory cannot be resized, assign exactly {} bytes".format(len(indices)))
+        if not indices:
+            return
+
+        if indices.step == 1:
+            first = start // NTagInfo.BYTES_PER_PAGE
+            last = (stop - 1) // NTagInfo.BYTES_PER_PAGE
+            pages = range(first, last + 1)
+            # Pages that are only partially overwritten must be known before they can be written back
+            partial = [page for page in (first, last)
+                       if not (start <= page * NTagInfo.BYTES_PER_PAGE and
+                               stop >= (page + 1) * NTagInfo.BYTES_PER_PAGE)]
+        else:
+            # A stepped slice leaves the bytes in between as they are, so every page it touches is partial
+            pages = partial = sorted(set(index // NTagInfo.BYTES_PER_PAGE for index in indices))
+        for page in partial:
+            self.fetch(page * NTagInfo.BYTES_PER_PAGE, (page + 1) * NTagInfo.BYTES_PER_PAGE)
+
+        self._buffer[key] = value
+        for page in pages:
+            self._fetched[page] = 1
+            self._dirty.add(page)
+
+    def __buffer__(self, flags):
+        self.fetch()
+        return memoryview(self._buffer)
+
+    def __release_buffer__(self, view):
+        view.release()
+
+    def view(self, start=0, stop=None):
+        """Zero-copy memoryview on range(start, stop), fetching the pages it covers first"""
+        stop = len(self._buffer) if stop is None else stop
+        self.fetch(start, stop)
+        return memoryview(self._buffer)[start:stop]
+
+    def tobytes(self):
+        """Fetch everything and return it as bytes"""
+        self.fetch()
+        return bytes(self._buffer)
+
+    @property
+    def dirty_pages(self):
+        """Absolute page numbers that were modified but not written yet"""
+        return sorted(self.start_page + page for page in self._dirty)
+
+    def flush(self, debug=False):
+        """Write all modified pages to the tag, in ascending order.
+        :return: the number of pages written"""
+        written = 0
+        for page in sorted(self._dirty):
+            offset = page * NTagInfo.BYTES_PER_PAGE
+            self.reader.write_page(self.start_page + page, self._buffer[offset:offset + NTagInfo.BYTES_PER_PAGE], debug)
+            self._dirty.discard(page)
+            written += 1
+        return written
+
+    def invalidate(self):
+        """Forget everything fetched, eg. when another tag is presented. Unflushed changes are lost"""
+        self._fetched = bytearray(self.page_count)
+        self._dirty = set()
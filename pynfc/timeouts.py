@@ -0,0 +1,189 @@
+"""Per-command timeouts that adapt to the latency observed on a reader
+
+The command timeout (NP_TIMEOUT_COMMAND) covers the complete round trip host - reader - tag - reader - host, so what
+a command needs depends on the command, the amount of data and the reader (UART, USB, SPI). Every command gets a
+TimeoutProfile: it starts from a generous default and, once enough responses have been timed, follows a percentile of
+the measured latency times a margin. A missing tag then fails fast instead of stalling, while slow but valid responses
+are not cut off. A timeout widens the profile again until the next successful response.
+
+The property is only set when the timeout changes, so a stream of the same commands costs no extra device traffic.
+"""
+
+import collections
+import logging
+import time
+
+from . import pynfc as nfc
+
+# Defaults in ms, before any latency is measured. On a PN532 over UART, 10 ms is already too short for a single READ
+DEFAULT_TIMEOUTS = {
+    'READ': 100,
+    'FAST_READ': 100,  # Plus FAST_READ_MS_PER_PAGE per page
+    'WRITE': 100,
+    'PWD_AUTH': 100,
+    'READ_SIG': 100,
+    'GET_VERSION': 100,
+    'MIFARE_AUTH': 100,
+    'MIFARE_READ': 100,
+    'MIFARE_WRITE': 100,
+    'MIFARE_VALUE': 100,
+    'MIFARE_TRANSFER': 100,
+    'OTHER': 500,
+}
+FAST_READ_MS_PER_PAGE = 2
+FAST_READ_BUCKET_PAGES = 16
+
+_NTAG_COMMANDS = {0x30: 'READ', 0x3A: 'FAST_READ', 0xA2: 'WRITE', 0xA0: 'WRITE', 0x1B: 'PWD_AUTH',
+                  0x3C: 'READ_SIG', 0x60: 'GET_VERSION'}
+_MIFARE_COMMANDS = {0x60: 'MIFARE_AUTH', 0x61: 'MIFARE_AUTH', 0x30: 'MIFARE_READ', 0xA0: 'MIFARE_WRITE',
+                    0xC0: 'MIFARE_VALUE', 0xC1: 'MIFARE_VALUE', 0xC2: 'MIFARE_VALUE', 0xB0: 'MIFARE_TRANSFER'}
+
+# libnfc results that mean the tag did not answer in time
+_TIMEOUT_ERRORS = (nfc.NFC_ETIMEOUT, nfc.NFC_ERFTRANS)
+
+
+def ntag_command_key(frame):
+    """
+    The profile name for an NTAG command frame. FAST_READs are grouped by the number of pages they read,
+    eg. 'FAST_READ/32' for 17 to 32 pages
+    """
+    name = _NTAG_COMMANDS.get(frame[0], 'OTHER')
+    if name == 'FAST_READ' and len(frame) >= 3:
+        pages = frame[2] - frame[1] + 1
+        bucket = -(-pages // FAST_READ_BUCKET_PAGES) * FAST_READ_BUCKET_PAGES
+        return '{}/{}'.format(name, bucket)
+    return name
+
+
+def mifare_command_key(frame):
+    """The profile name for a Mifare Classic command frame"""
+    return _MIFARE_COMMANDS.get(frame[0], 'OTHER')
+
+
+class TimeoutProfile(object):
+    """The timeout of one kind of command, learned from its measured latencies"""
+
+    def __init__(self, default, minimum=20, maximum=None, percentile=0.98, margin=1.5, slack=5, window=256,
+                 min_samples=16):
+        """
+        :param default: timeout in ms until min_samples latencies have been measured
+        :param minimum: never go below this many ms, whatever the measurements say
+        :param maximum: never go above this many ms, also not after timeouts. 4 times the default when not given
+        :param percentile: the measured latency that a valid response may still take
+        :param margin: factor applied to the percentile
+        :param slack: ms added after the margin, for scheduling jitter on the host
+        :param window: number of most recent latencies to keep
+        """
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else 4 * default
+        self.percentile = percentile
+        self.margin = margin
+        self.slack = slack
+        self.min_samples = min_samples
+
+        self.latencies = collections.deque(maxlen=window)
+        self.timeouts = 0
+        self._backoff = 1
+        self._learned = None
+        self._dirty = False
+
+    def observe(self, latency):
+        """Record the latency of a successful command, in seconds"""
+        self.latencies.append(latency * 1000)
+        self._backoff = 1
+        self._dirty = True
+
+    def timed_out(self):
+        """Record a command that did not get an answer in time. The timeout doubles until the next success"""
+        self.timeouts += 1
+        self._backoff = min(self._backoff * 2, 16)
+
+    def latency_percentile(self, percentile):
+        """:return: the given percentile of the measured latencies in ms, or None without measurements"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(percentile * len(ordered)), len(ordered) - 1)]
+
+    @property
+    def timeout(self):
+        """The timeout to use for the next command, in whole ms"""
+        if len(self.latencies) < self.min_samples:
+            timeout = self.default
+        else:
+            if self._dirty or self._learned is None:
+                self._learned = self.latency_percentile(self.percentile) * self.margin + self.slack
+                self._dirty = False
+            timeout = self._learned
+        return int(min(max(timeout * self._backoff, self.minimum), self.maximum))
+
+
+class TimeoutManager(object):
+    """
+    Owns the NP_TIMEOUT_COMMAND property of a device and the TimeoutProfiles of the commands sent through it.
+    Everything that changes the command timeout of the device should go through one manager, so it knows the
+    current value and skips setting it again.
+    """
+
+    def __init__(self, device, defaults=None, logger=logging.getLogger("timeouts"), **profile_kwargs):
+        """
+        :param device: an opened nfc_device pointer
+        :param defaults: dict of profile name -> default timeout in ms, overriding DEFAULT_TIMEOUTS
+        :param profile_kwargs: passed to every TimeoutProfile, eg. percentile=0.99
+        """
+        self.device = device
+        self.logger = logger
+        self.defaults = dict(DEFAULT_TIMEOUTS)
+        self.defaults.update(defaults or {})
+        self.profile_kwargs = profile_kwargs
+        self.profiles = {}
+        self.current = None
+        self.property_writes = 0
+
+    def reset_device(self, device):
+        """Use another (eg. reopened) device. Its timeout is unknown, so it is set again on the next command"""
+        self.device = device
+        self.current = None
+
+    def profile(self, key):
+        profile = self.profiles.get(key)
+        if profile is None:
+            name, _, pages = key.partition('/')
+            default = self.defaults.get(name, self.defaults['OTHER'])
+            if pages:
+                default += int(pages) * FAST_READ_MS_PER_PAGE
+            profile = self.profiles[key] = TimeoutProfile(default, **self.profile_kwargs)
+        return profile
+
+    def set_timeout(self, timeout):
+        """Set the command timeout of the device in ms, unless it already has that value"""
+        if timeout != self.current:
+            if nfc.nfc_device_set_property_int(self.device, nfc.NP_TIMEOUT_COMMAND, timeout) < 0:
+                raise IOError("Error setting command timeout to {} ms".format(timeout))
+            self.current = timeout
+            self.property_writes += 1
+
+    def call(self, key, transceive):
+        """
+        Apply the timeout of profile key and call transceive, which must use the device's default timeout (-1)
+        and return a libnfc result. The latency of a successful call is added to the profile
+        :return: the result of transceive
+        """
+        profile = self.profile(key)
+        self.set_timeout(profile.timeout)
+
+        start = time.perf_counter()
+        result = transceive()
+        if result >= 0:
+            profile.observe(time.perf_counter() - start)
+        elif result in _TIMEOUT_ERRORS:
+            profile.timed_out()
+            self.logger.debug("{} timed out after {} ms".format(key, self.current))
+        return result
+
+    def report(self):
+        """:return: dict of profile name -> dict with the current timeout, sample count, timeouts, p50 and p98 in ms"""
+        return {key: {'timeout': profile.timeout, 'samples': len(profile.latencies), 'timeouts': profile.timeouts,
+                      'p50': profile.latency_percentile(0.5), 'p98': profile.latency_percentile(0.98)}
+                for key, profile in sorted(self.profiles.items())}
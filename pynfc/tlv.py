@@ -0,0 +1,72 @@
+"""TLV blocks as used in the data area of NFC Forum tags (Type 1, Type 2 and NDEF on Mifare Classic)
+
+See NFC Forum "Type 2 Tag Operation Specification", NFCForum-TS-Type-2-Tag_1.1, section 2.3
+and "Type 1 Tag Operation Specification", NFCForum-TS-Type-1-Tag_1.1, section 2.3
+"""
+
+TLV_NULL = 0x00
+TLV_LOCK_CONTROL = 0x01
+TLV_MEMORY_CONTROL = 0x02
+TLV_NDEF_MESSAGE = 0x03
+TLV_PROPRIETARY = 0xFD
+TLV_TERMINATOR = 0xFE
+
+
+def parse_tlvs(data):
+    """
+    Walk the TLV blocks in data, up to the Terminator TLV or the end of the data
+    :return: generator of (tag, value offset, value length) tuples. NULL TLVs are skipped
+    """
+    offset = 0
+    size = len(data)
+    while offset < size:
+        tag = data[offset]
+        if tag == TLV_NULL:
+            offset += 1
+            continue
+        if tag == TLV_TERMINATOR:
+            return
+
+        if offset + 1 >= size:
+            raise ValueError("TLV {:#04x} at offset {} has no length".format(tag, offset))
+        length = data[offset + 1]
+        if length == 0xFF:
+            if offset + 3 >= size:
+                raise ValueError("TLV {:#04x} at offset {} has a truncated length".format(tag, offset))
+            length = (data[offset + 2] << 8) | data[offset + 3]
+            value_offset = offset + 4
+        else:
+            value_offset = offset + 2
+
+        yield tag, value_offset, length
+        offset = value_offset + length
+
+
+def find_ndef_message(data):
+    """
+    :return: the value of the first NDEF Message TLV in data
+    :raises ValueError: when there is none, or when it is longer than data
+    """
+    for tag, value_offset, length in parse_tlvs(data):
+        if tag == TLV_NDEF_MESSAGE:
+            if value_offset + length > len(data):
+                raise ValueError("NDEF message of {} bytes does not fit in {} bytes of data".format(length, len(data)))
+            return bytes(data[value_offset:value_offset + length])
+    raise ValueError("Data does not contain an NDEF message TLV")
+
+
+def parse_control_tlv(value, size_in_bits=False):
+    """
+    Decode the 3-byte value of a Lock Control or Memory Control TLV into the memory area it describes
+    :param size_in_bits: the size of a Lock Control TLV counts lock bits, that of a Memory Control TLV bytes
+    :return: tuple (byte address, size in bytes)
+    """
+    if len(value) < 3:
+        raise ValueError("Control TLV value is {} bytes, expected 3".format(len(value)))
+    page_address = value[0] >> 4
+    byte_offset = value[0] & 0x0F
+    size = value[1] or 256
+    bytes_per_page = 1 << (value[2] & 0x0F)
+    if size_in_bits:
+        size = (size + 7) // 8
+    return page_address * bytes_per_page + byte_offset, size
@@ -0,0 +1,279 @@
+"""NFC Forum Type 1 tags: Innovision/Broadcom Jewel and Topaz
+
+Type 1 tags are addressed by byte or by 8-byte block instead of by page. Every command but RID carries the 4 UID bytes.
+Static memory (blocks 0x00 to 0x0E, 120 bytes) is read in one frame with RALL. Tags with dynamic memory (eg. Topaz 512)
+are read per 128-byte segment with RSEG and written per block with WRITE-E8, so a complete Topaz 512 takes 4 frames.
+
+Memory layout:
+- block 0x00: UID
+- bytes 0x08-0x0B: Capability Container, bytes 0x0C and up: data area, holding TLVs like on a Type 2 tag
+- blocks 0x0D and 0x0E: reserved, static lock bytes and OTP. They are not part of the data area
+- dynamic memory: blocks 0x0F and up, with lock and reserved bytes located by Lock/Memory Control TLVs
+
+See NFC Forum "Type 1 Tag Operation Specification", NFCForum-TS-Type-1-Tag_1.1
+"""
+
+import collections
+import ctypes
+import logging
+
+from . import pynfc as nfc
+from . import tlv
+from .ntag_read import NTagReadWrite
+
+# Commands
+T1_RID = 0x78
+T1_RALL = 0x00
+T1_READ = 0x01
+T1_WRITE_E = 0x53
+T1_RSEG = 0x10
+T1_READ8 = 0x02
+T1_WRITE_E8 = 0x54
+
+BLOCK_SIZE = 8
+SEGMENT_SIZE = 128
+STATIC_MEMORY_SIZE = 120  # Blocks 0x00 to 0x0E, as returned by RALL
+NDEF_MAGIC_NUMBER = 0xE1
+
+CC_OFFSET = 0x08
+DATA_AREA_OFFSET = 0x0C
+STATIC_RESERVED = range(0x68, 0x78)  # Blocks 0x0D and 0x0E
+
+HR0_STATIC = 0x11  # Header ROM byte 0 of a Topaz 96. 0x12 is Topaz 512, which has dynamic memory
+
+
+class Type1Tag(object):
+    """
+    Read and write Type 1 (Jewel/Topaz) tags on an opened device, eg. the one of an NTagReadWrite:
+        tag = Type1Tag(read_writer.device)
+        tag.select()
+        message = tag.read_ndef_message_bytes()
+    """
+
+    def __init__(self, device, logger=logging.getLogger("type1_tag")):
+        """
+        :param device: an opened and initiator-initialised nfc_device pointer
+        :param logger: logging.Logger
+        """
+        self.device = device
+        self.logger = logger
+        self.uid = None
+        self.header_rom = None
+        self.memory = None  # Content of the tag as of the last read_memory() and writes since
+
+        self.modulation = nfc.nfc_modulation()
+        self.modulation.nmt = nfc.NMT_JEWEL
+        self.modulation.nbr = nfc.NBR_106
+
+    def select(self):
+        """
+        Select a Type 1 tag in the field and read its Header ROM
+        :return: the 4 UID bytes of the tag or None when there is no Type 1 tag in the field
+        """
+        nt = nfc.nfc_target()
+        res = nfc.nfc_initiator_select_passive_target(self.device, self.modulation, None, 0, ctypes.byref(nt))
+        if res <= 0:
+            return None
+
+        for prop, value in ((nfc.NP_ACTIVATE_CRYPTO1, False), (nfc.NP_EASY_FRAMING, True),
+                            (nfc.NP_HANDLE_CRC, True), (nfc.NP_HANDLE_PARITY, True)):
+            if nfc.nfc_device_set_property_bool(self.device, prop, value) < 0:
+                raise IOError("Error setting device property {} to {}".format(prop, value))
+
+        self.uid = bytes(nt.nti.nji.btId)
+        self.memory = None
+        self.read_id()
+        return self.uid
+
+    @property
+    def has_dynamic_memory(self):
+        """Whether the tag supports the segment and 8-byte block commands and has memory beyond block 0x0E"""
+        return self.header_rom is not None and self.header_rom[0] != HR0_STATIC
+
+    def transceive(self, command, receive_length):
+        """Send a command and return the response"""
+        tx = (ctypes.c_uint8 * len(command)).from_buffer_copy(bytes(command))
+        rx = (ctypes.c_uint8 * receive_length)()
+        res = nfc.nfc_initiator_transceive_bytes(self.device, tx, len(tx), rx, len(rx), 0)
+        if res < 0:
+            raise IOError("Error transceiving Type 1 command {:#04x}: {}".format(command[0], res))
+        return bytes(rx[:res])
+
+    def _command(self, code, address=0, data=b'\x00'):
+        if self.uid is None:
+            raise IOError("No Type 1 tag selected")
+        return bytes([code, address]) + bytes(data) + self.uid
+
+    def read_id(self):
+        """RID: read the Header ROM and the UID. :return: tuple (header ROM, UID)"""
+        response = self.transceive(bytes([T1_RID, 0, 0, 0, 0, 0, 0]), 6)
+        if len(response) != 6:
+            raise IOError("RID returned {} bytes, expected 6".format(len(response)))
+        self.header_rom = response[:2]
+        return self.header_rom, response[2:]
+
+    def read_all(self):
+        """RALL: read the complete static memory, blocks 0x00 to 0x0E, in one frame. :return: 120 bytes"""
+        response = self.transceive(self._command(T1_RALL, 0, b'\x00'), 2 + STATIC_MEMORY_SIZE)
+        if len(response) != 2 + STATIC_MEMORY_SIZE:
+            raise IOError("RALL returned {} bytes, expected {}".format(len(response), 2 + STATIC_MEMORY_SIZE))
+        self.header_rom = response[:2]
+        return response[2:]
+
+    def read_segment(self, segment):
+        """RSEG: read a 128-byte segment (16 blocks) of a tag with dynamic memory"""
+        response = self.transceive(self._command(T1_RSEG, segment << 4, bytes(8)), 1 + SEGMENT_SIZE)
+        if len(response) != 1 + SEGMENT_SIZE:
+            raise IOError("Reading segment {} failed".format(segment))
+        return response[1:]
+
+    def read_block(self, block):
+        """READ8: read an 8-byte block of a tag with dynamic memory"""
+        response = self.transceive(self._command(T1_READ8, block, bytes(8)), 1 + BLOCK_SIZE)
+        if len(response) != 1 + BLOCK_SIZE:
+            raise IOError("Reading block {} failed".format(block))
+        return response[1:]
+
+    def write_block(self, block, data):
+        """WRITE-E8: erase and write an 8-byte block of a tag with dynamic memory"""
+        if len(data) != BLOCK_SIZE:
+            raise ValueError("Block data is {} bytes, expected {}".format(len(data), BLOCK_SIZE))
+        response = self.transceive(self._command(T1_WRITE_E8, block, data), 1 + BLOCK_SIZE)
+        if response[1:] != bytes(data):
+            raise IOError("Writing block {} failed".format(block))
+        self._update_memory(block * BLOCK_SIZE, data)
+
+    def write_byte(self, address, value):
+        """WRITE-E: erase and write a single byte of static memory (blocks 0x00 to 0x0F)"""
+        if not 0 <= address < 0x80:
+            raise ValueError("Byte address {:#x} is outside of blocks 0x00 to 0x0F".format(address))
+        response = self.transceive(self._command(T1_WRITE_E, address, bytes([value])), 2)
+        if len(response) != 2 or response[1] != value:
+            raise IOError("Writing byte {:#04x} failed".format(address))
+        self._update_memory(address, bytes([value]))
+
+    def _update_memory(self, address, data):
+        if self.memory is not None and address + len(data) <= len(self.memory):
+            self.memory[address:address + len(data)] = data
+
+    def read_memory(self):
+        """
+        Read the complete tag memory: one RALL for static tags, one RSEG per segment for tags with dynamic memory
+        :return: bytearray with the memory contents, also kept as self.memory
+        """
+        if self.has_dynamic_memory:
+            # Segment 0 holds the Capability Container, which tells how many segments follow
+            memory = bytearray(self.read_segment(0))
+            size = self.memory_size(memory)
+            for segment in range(1, (size + SEGMENT_SIZE - 1) // SEGMENT_SIZE):
+                memory += self.read_segment(segment)
+        else:
+            memory = bytearray(self.read_all())
+        self.memory = memory
+        return memory
+
+    @staticmethod
+    def memory_size(memory):
+        """Size of the tag memory in bytes according to the Capability Container, (CC2 + 1) * 8"""
+        if memory[CC_OFFSET] != NDEF_MAGIC_NUMBER:
+            return STATIC_MEMORY_SIZE
+        return (memory[CC_OFFSET + 2] + 1) * BLOCK_SIZE
+
+    def _reserved_addresses(self, memory):
+        """Byte addresses within the data area that hold lock bits or are reserved"""
+        reserved = set(STATIC_RESERVED)
+        static_data = memory[DATA_AREA_OFFSET:STATIC_RESERVED[0]]
+        for tag, offset, length in tlv.parse_tlvs(static_data):
+            if tag == tlv.TLV_NDEF_MESSAGE:
+                break  # Control TLVs precede the NDEF Message TLV
+            if tag in (tlv.TLV_LOCK_CONTROL, tlv.TLV_MEMORY_CONTROL):
+                address, size = tlv.parse_control_tlv(static_data[offset:offset + length],
+                                                      size_in_bits=tag == tlv.TLV_LOCK_CONTROL)
+                reserved.update(range(address, address + size))
+        return reserved
+
+    def data_area_addresses(self, memory=None):
+        """:return: the byte addresses of the data area, in order, skipping reserved and lock bytes"""
+        memory = self.memory if memory is None else memory
+        if memory is None:
+            memory = self.read_memory()
+        size = min(len(memory), self.memory_size(memory))
+        reserved = self._reserved_addresses(memory)
+        return [address for address in range(DATA_AREA_OFFSET, size) if address not in reserved]
+
+    def read_user_memory(self):
+        """Read the data area, ie. the actual content of the tag, as contiguous bytes"""
+        memory = self.read_memory()
+        return bytes(memory[address] for address in self.data_area_addresses(memory))
+
+    def read_ndef_message_bytes(self):
+        memory = self.read_memory()
+        if memory[CC_OFFSET] != NDEF_MAGIC_NUMBER:
+            raise ValueError("Tag is not NDEF formatted: Capability Container starts with {:#04x}".format(memory[CC_OFFSET]))
+        data = bytes(memory[address] for address in self.data_area_addresses(memory))
+        return tlv.find_ndef_message(data)
+
+    def write_user_memory(self, data, debug=False):
+        """
+        Write data to the start of the data area. Only the bytes that differ from the tag are written:
+        per block with WRITE-E8 on tags with dynamic memory, per byte with WRITE-E otherwise and for blocks that also
+        hold reserved or lock bytes
+        """
+        if self.memory is None:
+            self.read_memory()
+        self._write_data_area(self.data_area_addresses(), data, debug)
+
+    def _write_data_area(self, addresses, data, debug=False):
+        if len(data) > len(addresses):
+            raise ValueError("Data area of {} bytes too small for content of {} bytes".format(len(addresses), len(data)))
+
+        changed = collections.OrderedDict()
+        for address, value in zip(addresses, bytes(data)):
+            if self.memory[address] != value:
+                changed.setdefault(address // BLOCK_SIZE, []).append((address, value))
+
+        data_area = set(addresses)
+        self.logger.info("Writing {} blocks".format(len(changed)))
+        for block, values in changed.items():
+            block_addresses = range(block * BLOCK_SIZE, (block + 1) * BLOCK_SIZE)
+            whole_block = all(address in data_area for address in block_addresses) or block * BLOCK_SIZE >= 0x80
+            if self.has_dynamic_memory and whole_block:
+                content = bytearray(self.memory[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE])
+                for address, value in values:
+                    content[address - block * BLOCK_SIZE] = value
+                if debug:
+                    print("Write block {:3}: {}".format(block, bytes(content)))
+                self.write_block(block, bytes(content))
+            else:
+                for address, value in values:
+                    if debug:
+                        print("Write byte {:#04x}: {:#04x}".format(address, value))
+                    self.write_byte(address, value)
+
+    def write_ndef_message_bytes(self, message_bytes, debug=False):
+        """
+        Write an NDEF message TLV followed by a Terminator TLV. The NDEF magic number in the Capability Container is
+        cleared during the write, so a reader never sees a half-written message as valid
+        """
+        memory = self.read_memory()
+        if memory[CC_OFFSET] != NDEF_MAGIC_NUMBER:
+            raise ValueError("Tag is not NDEF formatted: Capability Container starts with {:#04x}".format(memory[CC_OFFSET]))
+
+        addresses = self.data_area_addresses(memory)
+        data = bytes(memory[address] for address in addresses)
+        ndef_offset = 0
+        for tag, offset, length in tlv.parse_tlvs(data):
+            if tag not in (tlv.TLV_LOCK_CONTROL, tlv.TLV_MEMORY_CONTROL):
+                break
+            ndef_offset = offset + length  # Keep the control TLVs in front of the message
+
+        content = NTagReadWrite._make_tag_length_header_for_value(message_bytes) + bytes(message_bytes)
+        content = data[:ndef_offset] + content + bytes([tlv.TLV_TERMINATOR])
+
+        if len(content) > len(addresses):
+            raise ValueError("Data area of {} bytes too small for content of {} bytes".format(len(addresses), len(content)))
+
+        # The data area is determined before clearing the magic number, which makes the CC invalid
+        self.write_byte(CC_OFFSET, 0x00)
+        self._write_data_area(addresses, content, debug)
+        self.write_byte(CC_OFFSET, NDEF_MAGIC_NUMBER)
@@ -0,0 +1,72 @@
+"""Small local journal to keep track of how far an interrupted tag write got"""
+
+import binascii
+import hashlib
+import json
+import os
+
+
+class WriteJournal(object):
+    """
+    Records, per tag UID, which steps of a journaled write were completed.
+    The journal is a small JSON file, rewritten atomically, so a crash of the host does not corrupt it.
+
+    A journal entry only applies to the content it was made for: a digest of the content is stored with it,
+    so presenting the tag with a different message starts the write from scratch.
+    """
+
+    def __init__(self, path, sync_every=1):
+        """
+        :param path: location of the JSON journal file. It is created when it does not exist yet
+        :param sync_every: save the journal to disk after this many completed steps.
+            Higher values mean less disk I/O, at the cost of rewriting a few more pages after an interruption
+        """
+        self.path = path
+        self.sync_every = max(1, sync_every)
+        self._unsynced = 0
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as journal_file:
+                self.entries = json.load(journal_file)
+
+    @staticmethod
+    def _key(uid):
+        return binascii.hexlify(bytes(uid)).decode('ascii')
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha1(bytes(content)).hexdigest()
+
+    def completed_steps(self, uid, content):
+        """
+        :return: the number of steps completed earlier for writing content to the tag with the given UID
+        :rtype int
+        """
+        entry = self.entries.get(self._key(uid))
+        if entry and entry['digest'] == self.digest(content):
+            return entry['completed']
+        return 0
+
+    def record(self, uid, content, completed):
+        """Record that the first completed steps of writing content to the tag with the given UID are done"""
+        self.entries[self._key(uid)] = {'digest': self.digest(content), 'completed': completed}
+
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def finish(self, uid):
+        """The write to the tag with the given UID has completed, so there is nothing left to resume"""
+        self.entries.pop(self._key(uid), None)
+        self.sync()
+
+    def sync(self):
+        """Write the journal to disk"""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as journal_file:
+            json.dump(self.entries, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+        self._unsynced = 0
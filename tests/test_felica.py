@@ -0,0 +1,38 @@
+import unittest
+
+from pynfc import felica
+
+
+class WriteCommandLengthTest(unittest.TestCase):
+    """Every Write Without Encryption command must fit in a frame of at most 255 bytes"""
+
+    def assert_chunks_fit(self, chunks):
+        for chunk in chunks:
+            payload = felica.block_payload(felica.SERVICE_NDEF_WRITE, chunk, bytes(len(chunk) * felica.BLOCK_SIZE))
+            self.assertLessEqual(felica.command_length(payload), felica.MAX_FRAME_LENGTH)
+
+    def test_two_byte_elements(self):
+        chunks = felica.write_chunks(range(1, 15))
+        self.assertEqual([len(chunk) for chunk in chunks], [13, 1])
+        self.assert_chunks_fit(chunks)
+
+    def test_three_byte_elements(self):
+        chunks = felica.write_chunks(range(0x100, 0x100 + 14))
+        self.assertEqual([len(chunk) for chunk in chunks], [12, 2])
+        self.assert_chunks_fit(chunks)
+
+    def test_mixed_elements(self):
+        chunks = felica.write_chunks(range(0xF8, 0xF8 + 40))
+        self.assertEqual(sum(chunks, []), list(range(0xF8, 0xF8 + 40)))
+        self.assert_chunks_fit(chunks)
+
+    def test_max_blocks(self):
+        self.assertEqual([len(chunk) for chunk in felica.write_chunks(range(10), max_blocks=4)], [4, 4, 2])
+
+    def test_thirteen_blocks_fill_the_frame(self):
+        payload = felica.block_payload(felica.SERVICE_NDEF_WRITE, list(range(13)), bytes(13 * felica.BLOCK_SIZE))
+        self.assertEqual(felica.command_length(payload), 248)
+
+
+if __name__ == '__main__':
+    unittest.main()